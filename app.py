@@ -3,6 +3,9 @@ from flask import Flask, render_template, request  # <-- 已在此处添加 requ
 from handlers import host_map_api
 from handlers.alert_handler import alert_bp
 from handlers.api_handler import api_bp, get_servers_data
+from services import balloon_tuner, forecaster, inventory, metric_store
+from services.change_feed import FEED
+from utils.leader import LEADER
 import logging
 
 app = Flask(__name__)
@@ -15,16 +18,32 @@ app.logger.setLevel(logging.INFO)
 app.register_blueprint(api_bp, url_prefix='/api')
 app.register_blueprint(alert_bp, url_prefix='/api')  # 👈 注册告警蓝图
 app.register_blueprint(host_map_api.host_map_bp, url_prefix='/api')
+
+# 启动事件驱动的虚拟机清单服务
+inventory.start()
+# 启动基于预测的提前扩容
+forecaster.start()
+# 启动气球内存自动调整
+balloon_tuner.start()
+# 启动指标历史的落盘与保留期清理
+metric_store.start()
+# 启动向页面推送清单与指标变更的后台线程
+FEED.start()
+# 参与采集者选举：多个 worker 中只有当选者执行 SSH 采集、预测扩容与气球调整
+LEADER.start()
+
 @app.route('/')
 def index():
     """渲染主页面，显示服务器列表。"""
     try:
         data = get_servers_data()
         servers = data.get("servers", [])
+        age_seconds = data.get("age_seconds")
     except Exception as e:
         app.logger.error(f"Error getting server data for index page: {e}")
         servers = []
-    return render_template('index.html', servers=servers, active_page='servers')
+        age_seconds = None
+    return render_template('index.html', servers=servers, age_seconds=age_seconds, active_page='servers')
 
 
 @app.route('/kvm/list')
@@ -1,116 +1,384 @@
 # handlers/alert_handler.py
 
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import redis
+import yaml
+
 from flask import Blueprint, jsonify, request
-from pip._internal.utils import logging
 
 from services.scaler import scale_vm_cpu, scale_vm_memory
-from services.kvm_inspector import get_all_vms_on_host
+from services import forecaster, inventory, scale_cooldown
+from services.capacity_ledger import LEDGER
+from services.vm_locator import find_host_by_vm_ip, locate_vm, redis_client
+from utils.queue_manager import JOB_QUEUE
+
 alert_bp = Blueprint('alert', __name__)
 
+config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(config_path, "r") as f:
+    config = yaml.safe_load(f)
+
 logger = logging.getLogger(__name__)
-last_scale_time = {}  # 防止重复扩容的缓存 { "host_vm": timestamp }
+# 去重状态存放在 Redis 中，由所有 worker 共享；Redis 不可用时退回进程内缓存。
+# 扩容冷却期与预测扩容共用，见 scale_cooldown
+FINGERPRINT_KEY_PREFIX = "kvm_scale:alert:"
 
 MAX_CPU = 10
 MAX_MEM_GB = 32
-SCALE_COOLDOWN = 300  # 冷却时间，单位秒
-def process_alert(alert_type, instance, severity, description):
-    print(f"[ALERT] Type: {alert_type}, VM IP: {instance}, Severity: {severity}")
-
-    if alert_type not in ["cpu", "memory"]:
-        print("[INFO] Only CPU/Memory alerts are handled.")
-        return
-
-    # 步骤一：查找宿主机
-    host_ip = find_host_by_vm_ip(instance)
+ALERT_DEDUPE_WINDOW = (config.get('alerts', {}) or {}).get('dedupe_window', 300)  # 告警去重窗口，单位秒
+
+_SEEN_FINGERPRINTS = {}  # { fingerprint: 首次处理时间 }
+_SEEN_LOCK = threading.Lock()
+
+# 告警级别 -> 任务优先级（数值越小越先执行）
+SEVERITY_PRIORITY = {
+    "critical": 1,
+    "warning": 5,
+    "info": 8,
+}
+
+
+def _scale_reserved(host_ip, target_vm, scale, vcpu=0, mem_kb=0):
+    """
+    在容量账本中预留增量后再扩容，并发的扩容任务不会超卖同一台宿主机：
+    成功按实际生效的规格提交，失败释放。容量不足时返回 None。
+    """
+    reservation = LEDGER.reserve(host_ip, vcpu=vcpu, mem_kb=mem_kb, uuid=target_vm["uuid"])
+    if reservation is None:
+        print(f"[WARN] Host {host_ip} has no capacity for +{vcpu} vCPU / +{mem_kb} KiB")
+        return None
+    try:
+        result = scale()
+    except Exception:
+        LEDGER.release(reservation["id"])
+        raise
+    if not result["success"]:
+        LEDGER.release(reservation["id"])
+    elif result["resource"] == "vcpu":
+        LEDGER.commit(reservation["id"], vcpu=result["applied"] - target_vm["curr_vcpu"])
+    else:
+        LEDGER.commit(reservation["id"], mem_kb=result["applied"] - target_vm["curr_mem_kb"])
+    return result
+
+
+def _locate_target(instance, host_ip=None):
+    """
+    定位告警对应的宿主机与虚拟机，返回 (host_ip, target_vm, error)，定位失败时 error 为结果字典
+    """
+    # 通过内存中的 IP / MAC 索引定位宿主机与虚拟机（O(1)，无远程调用）
+    located = locate_vm(instance)
+    if located and (not host_ip or located["host"] == host_ip):
+        host_ip = located["host"]
+        target_vm = inventory.get_vm(host_ip, located["uuid"])
+        if target_vm is not None:
+            return host_ip, target_vm, None
+
+    # 索引未命中（如清单尚未加载）时回退到 Redis / ARP 查找宿主机并遍历其清单
+    host_ip = host_ip or find_host_by_vm_ip(instance)
     if not host_ip:
         print(f"[ERROR] Could not find host for VM {instance}")
-        return
+        return None, None, {"status": "failed", "message": f"Could not find host for VM {instance}"}
+
+    vms = inventory.get_host_vms(host_ip)
+    target_vm = next((vm for vm in vms if instance in (vm.get("ip_addresses") or [vm.get("ip_address")])), None)
+    if not target_vm:
+        print(f"[INFO] No VM found with IP {instance} on host {host_ip}")
+        return host_ip, None, {"status": "failed", "message": f"No VM found with IP {instance} on host {host_ip}"}
+    return host_ip, target_vm, None
+
+
+def _scale_for_alert(alert_type, host_ip, target_vm):
+    """
+    按一种告警类型扩容一台已定位的 VM（调用方已占用冷却期）。返回处理结果
+    """
+    vm_name = target_vm["name"]
+    # 目标规格按预测峰值计算；没有足够历史、或预测峰值已低于目标利用率（推荐值不高于当前规格）时，
+    # 告警仍在触发，沿用固定的 +2 vCPU / 1.5 倍内存
+    recommended = forecaster.recommend(target_vm, alert_type)
+
+    if alert_type == "cpu":
+        new_cpu = target_vm["curr_vcpu"] + 2
+        if recommended and recommended > target_vm["curr_vcpu"]:
+            new_cpu = recommended
+        if new_cpu <= target_vm["curr_vcpu"] or new_cpu > MAX_CPU:
+            print(f"[WARN] Max CPU limit reached for {vm_name}")
+            return {"status": "skipped", "message": f"Max CPU limit reached for {vm_name}"}
+
+        result = _scale_reserved(host_ip, target_vm, lambda: scale_vm_cpu(vm_name, host_ip, new_cpu),
+                                 vcpu=new_cpu - target_vm["curr_vcpu"])
+        if result is None:
+            return {"status": "failed",
+                    "message": f"Host {host_ip} has no capacity to scale {vm_name} to {new_cpu} CPUs"}
+        if result["success"]:
+            print(f"[SUCCESS] CPU scaled to {new_cpu} cores for {vm_name} on {host_ip}")
+        else:
+            print(f"[ERROR] Failed to scale CPU for {vm_name}: [{result['error_class']}] {result['error']}")
+        return {"status": "success" if result["success"] else "failed", "result": result}
+
+    new_mem = max(target_vm["curr_mem_gb"] + 2, int(target_vm["curr_mem_gb"] * 1.5))
+    if recommended and recommended > target_vm["curr_mem_gb"]:
+        # 推荐值按 GB 向上取整，可能略超上限，截断到上限而不是放弃扩容
+        new_mem = min(recommended, MAX_MEM_GB)
+    if new_mem <= target_vm["curr_mem_gb"] or new_mem > MAX_MEM_GB:
+        print(f"[WARN] Max memory limit reached for {vm_name}")
+        return {"status": "skipped", "message": f"Max memory limit reached for {vm_name}"}
+
+    result = _scale_reserved(host_ip, target_vm, lambda: scale_vm_memory(vm_name, host_ip, new_mem),
+                             mem_kb=int(new_mem * 1024 * 1024) - target_vm["curr_mem_kb"])
+    if result is None:
+        return {"status": "failed",
+                "message": f"Host {host_ip} has no capacity to scale {vm_name} to {new_mem} GB"}
+    if result["success"]:
+        print(f"[SUCCESS] Memory scaled to {new_mem} GB for {vm_name} on {host_ip}")
+    else:
+        print(f"[ERROR] Failed to scale memory for {vm_name}: [{result['error_class']}] {result['error']}")
+    return {"status": "success" if result["success"] else "failed", "result": result}
+
+
+def process_alerts(alert_types, instance, severity, description, host_ip=None):
+    """
+    处理同一台 VM 的 CPU / 内存告警：定位宿主机与虚拟机，只占用一次冷却期，再依次按每种类型扩容。
+    返回 { alert_type: 处理结果 }，供任务状态查询。都没有扩容成功时释放冷却期，下一条告警可以立即重试。
+    已在批量接收时解析出宿主机的，通过 host_ip 传入，不再重复查找。
+    """
+    print(f"[ALERT] Types: {', '.join(alert_types)}, VM IP: {instance}, Severity: {severity}")
+
+    results = {}
+    for alert_type in alert_types:
+        if alert_type not in ["cpu", "memory"]:
+            print("[INFO] Only CPU/Memory alerts are handled.")
+            results[alert_type] = {"status": "ignored", "message": f"Alert type '{alert_type}' is not handled"}
+    alert_types = [alert_type for alert_type in alert_types if alert_type not in results]
+    if not alert_types:
+        return results
+
+    host_ip, target_vm, error = _locate_target(instance, host_ip)
+    if error is not None:
+        return dict(results, **{alert_type: error for alert_type in alert_types})
 
     print(f"[INFO] Found host: {host_ip} for VM {instance}")
+    vm_name = target_vm["name"]
+
+    # 先占用冷却期再扩容，多个 worker 同时处理同一 VM 的告警、或与预测扩容撞上时只有一个会执行
+    if not scale_cooldown.claim(target_vm["uuid"]):
+        print(f"[INFO] {vm_name} on {host_ip} is cooling down. Skipping.")
+        skipped = {"status": "skipped", "message": f"{vm_name} is cooling down"}
+        return dict(results, **{alert_type: skipped for alert_type in alert_types})
+
+    print(f"[INFO] Found running VM: {target_vm['name']}")
+    try:
+        for alert_type in alert_types:
+            results[alert_type] = _scale_for_alert(alert_type, host_ip, target_vm)
+    finally:
+        if not any(results.get(alert_type, {}).get("status") == "success" for alert_type in alert_types):
+            scale_cooldown.release(target_vm["uuid"])
+    return results
+
+
+def _run_scaling_job(payload):
+    """
+    扩容任务：合并进来的各种告警类型共用一次冷却期，依次处理
+    """
+    return process_alerts(payload["alert_types"], payload["instance"], payload["severity"],
+                          payload["description"], host_ip=payload.get("host_ip"))
+
+
+def _merge_scaling_payload(old, new):
+    """
+    同一台 VM 的多条告警合并为一个任务：告警类型取并集，描述保留最新一条
+    """
+    merged = dict(new)
+    merged["alert_types"] = sorted(set(old["alert_types"]) | set(new["alert_types"]))
+    if SEVERITY_PRIORITY.get(old["severity"], 5) < SEVERITY_PRIORITY.get(new["severity"], 5):
+        merged["severity"] = old["severity"]
+    return merged
+
+
+JOB_QUEUE.register_handler("scale_vm", _run_scaling_job)
+
+
+def notify_alert(alert_type, instance, severity, description):
+    """
+    不需要扩容的告警只做记录
+    """
+    if alert_type == "disk":
+        print(f"[ACTION] 磁盘空间不足告警 ({instance}, {severity}): {description}")
+        # TODO: 清理缓存、扩展磁盘配额、通知用户
+
+    else:
+        print(f"[ACTION] 未知告警 ({instance}, {severity}): {description}")
+
+
+def _alert_fingerprint(alert):
+    """
+    Alertmanager 提供 fingerprint；旧格式的单条告警按标签计算一个
+    """
+    fingerprint = alert.get("fingerprint")
+    if fingerprint:
+        return fingerprint
+    labels = alert.get("labels", {})
+    return hashlib.sha1(json.dumps(labels, sort_keys=True).encode()).hexdigest()[:16]
 
-    # 步骤二：获取该宿主机上的所有虚拟机
+
+def _is_duplicate(fingerprint, now):
+    """
+    去重窗口内已处理过的 fingerprint 直接丢弃。Alertmanager 重发到其他 worker 时
+    也能识别，Redis 不可用时退回进程内去重，并清理过期条目。只查询不记录，见 _mark_handled
+    """
+    try:
+        return bool(redis_client.exists(f"{FINGERPRINT_KEY_PREFIX}{fingerprint}"))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for alert dedupe, using local state: {e}")
+    with _SEEN_LOCK:
+        for fp in [fp for fp, ts in _SEEN_FINGERPRINTS.items() if now - ts >= ALERT_DEDUPE_WINDOW]:
+            del _SEEN_FINGERPRINTS[fp]
+        return fingerprint in _SEEN_FINGERPRINTS
+
+
+def _mark_handled(fingerprints, now):
+    """
+    告警已通知或扩容任务已提交后才记录 fingerprint；
+    定位不到虚拟机或宿主机不可用的告警不记录，Alertmanager 重发时会再次处理
+    """
+    if not fingerprints:
+        return
     try:
-        vms = get_all_vms_on_host(host_ip)
-        if not vms or len(vms) == 0:
-            print(f"[INFO] No VMs found on host {host_ip}")
-            return
-
-        # 查找对应虚拟机
-        target_vm = next((vm for vm in vms if vm.get("ip") == instance), None)
-        if not target_vm:
-            print(f"[INFO] No VM found with IP {instance} on host {host_ip}")
-            return
-
-        vm_name = target_vm["name"]
-        vm_key = f"{host_ip}_{vm_name}"
-
-        now = time.time()
-        last_time = last_scale_time.get(vm_key, 0)
-        if now - last_time < SCALE_COOLDOWN:
-            print(f"[INFO] {vm_key} is cooling down. Skipping.")
-            return
-
-        print(f"[INFO] Found running VM: {vm_name}")
-
-        if alert_type == "cpu":
-            new_cpu = target_vm["curr_vcpu"] + 2
-            if new_cpu > MAX_CPU:
-                print(f"[WARN] Max CPU limit reached for {vm_name}")
-                return
-
-            success = scale_vm_cpu(vm_name, host_ip, new_cpu)
-            if success:
-                print(f"[SUCCESS] CPU scaled to {new_cpu} cores for {vm_name} on {host_ip}")
-                last_scale_time[vm_key] = now
-            else:
-                print(f"[ERROR] Failed to scale CPU for {vm_name}")
-
-        elif alert_type == "memory":
-            new_mem = max(target_vm["curr_mem_gb"] + 2, int(target_vm["curr_mem_gb"] * 1.5))
-            if new_mem > MAX_MEM_GB:
-                print(f"[WARN] Max memory limit reached for {vm_name}")
-                return
-
-            success = scale_vm_memory(vm_name, host_ip, new_mem)
-            if success:
-                print(f"[SUCCESS] Memory scaled to {new_mem} GB for {vm_name} on {host_ip}")
-                last_scale_time[vm_key] = now
-            else:
-                print(f"[ERROR] Failed to scale memory for {vm_name}")
-
-    except Exception as e:
-        print(f"[ERROR] Error during scaling: {str(e)}")
+        pipe = redis_client.pipeline()
+        for fingerprint in fingerprints:
+            pipe.set(f"{FINGERPRINT_KEY_PREFIX}{fingerprint}", now, ex=ALERT_DEDUPE_WINDOW)
+        pipe.execute()
+        return
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for alert dedupe, using local state: {e}")
+    with _SEEN_LOCK:
+        for fingerprint in fingerprints:
+            _SEEN_FINGERPRINTS[fingerprint] = now
+
 
 @alert_bp.route('/alerts', methods=['POST'])
 def handle_prometheus_alert():
+    """
+    接收 Alertmanager webhook，一次处理整批告警：
+    1. 按 fingerprint 在去重窗口内去重，忽略已恢复的告警
+    2. 按宿主机分组，每台宿主机每批只读取一次虚拟机清单
+    3. CPU / 内存告警按 VM 放入后台扩容任务队列，立即返回 202
+    兼容旧的单条告警格式（顶层 labels / annotations）。
+    """
     data = request.json
     print("[INFO] Received alert:", data)
 
     if not data or 'status' not in data:
         return jsonify({"error": "Invalid alert format"}), 400
 
-    # 提取关键字段
-    labels = data.get("labels", {})
-    annotations = data.get("annotations", {})
-
-    alert_name = labels.get("alertname", "unknown")
-    instance = labels.get("instance", "").split(":")[0]
-    severity = labels.get("severity", "unknown")
-    summary = annotations.get("summary", "")
-    description = annotations.get("description", "")
-
-    # 分类告警类型
-    alert_type = classify_alert(alert_name, summary, description)
-
-    # 执行后续动作（可扩展）
-    process_alert(alert_type, instance, severity, description)
-
-    return jsonify({
+    # 显式判断 alerts 键：空的 alerts 列表表示本批没有告警，而不是旧的单条告警格式
+    alerts = data["alerts"] if "alerts" in data else [data]
+    now = time.time()
+    response = {
         "status": "received",
-        "alert_type": alert_type,
-        "instance": instance,
-        "severity": severity
-    })
+        "received": len(alerts),
+        "duplicates": 0,
+        "resolved": 0,
+        "jobs": [],
+        "unresolved": [],
+        "notified": []
+    }
+
+    # { host_ip: { instance: {"alert_types": set, "severity", "description"} } }
+    by_host = {}
+    batch_fingerprints = set()
+    for alert in alerts:
+        if alert.get("status", data.get("status")) == "resolved":
+            response["resolved"] += 1
+            continue
+        fingerprint = _alert_fingerprint(alert)
+        if fingerprint in batch_fingerprints or _is_duplicate(fingerprint, now):
+            response["duplicates"] += 1
+            continue
+        batch_fingerprints.add(fingerprint)
+
+        # 提取关键字段
+        labels = alert.get("labels", {})
+        annotations = alert.get("annotations", {})
+
+        alert_name = labels.get("alertname", "unknown")
+        instance = labels.get("instance", "").split(":")[0]
+        severity = labels.get("severity", "unknown")
+        summary = annotations.get("summary", "")
+        description = annotations.get("description", "")
+
+        # 分类告警类型
+        alert_type = classify_alert(alert_name, summary, description)
+        if alert_type not in ["cpu", "memory"]:
+            notify_alert(alert_type, instance, severity, description)
+            _mark_handled([fingerprint], now)
+            response["notified"].append({"instance": instance, "alert_type": alert_type})
+            continue
+
+        located = locate_vm(instance)
+        host_ip = located["host"] if located else find_host_by_vm_ip(instance)
+        if not host_ip:
+            print(f"[ERROR] Could not find host for VM {instance}")
+            response["unresolved"].append({"instance": instance, "reason": "host not found"})
+            continue
+
+        entry = by_host.setdefault(host_ip, {}).setdefault(
+            instance, {"alert_types": set(), "severity": severity, "description": description,
+                       "uuid": located["uuid"] if located else None, "fingerprints": []})
+        entry["alert_types"].add(alert_type)
+        entry["fingerprints"].append(fingerprint)
+        if SEVERITY_PRIORITY.get(severity, 5) < SEVERITY_PRIORITY.get(entry["severity"], 5):
+            entry["severity"] = severity
+
+    for host_ip, instances in by_host.items():
+        # 每台宿主机每批只读取一次清单
+        try:
+            vms = inventory.get_host_vms(host_ip)
+            uuid_by_ip = {ip: vm["uuid"] for vm in vms for ip in vm.get("ip_addresses") or [vm.get("ip_address")]}
+            vm_uuids = {vm["uuid"] for vm in vms}
+        except Exception as e:
+            print(f"[ERROR] Failed to read inventory of {host_ip}: {e}")
+            response["unresolved"].extend(
+                {"instance": instance, "reason": f"host {host_ip} unavailable"} for instance in instances)
+            continue
+
+        for instance, entry in instances.items():
+            # 没有 GA 的 VM 清单里没有 IP，按 MAC 索引定位到的 UUID 判断
+            vm_uuid = entry["uuid"] if entry["uuid"] in vm_uuids else uuid_by_ip.get(instance)
+            if vm_uuid is None:
+                response["unresolved"].append({"instance": instance, "reason": f"no VM with this IP on {host_ip}"})
+                continue
+            # 扩容放入后台任务队列，避免 Alertmanager 超时；与预测扩容使用同一个任务键，不会同时调整同一台 VM
+            job = JOB_QUEUE.submit(
+                "scale_vm",
+                key=scale_cooldown.job_key(vm_uuid),
+                payload={
+                    "instance": instance,
+                    "host_ip": host_ip,
+                    "alert_types": sorted(entry["alert_types"]),
+                    "severity": entry["severity"],
+                    "description": entry["description"]
+                },
+                priority=SEVERITY_PRIORITY.get(entry["severity"], 5),
+                merge=_merge_scaling_payload
+            )
+            _mark_handled(entry["fingerprints"], now)
+            response["jobs"].append({
+                "instance": instance,
+                "host": host_ip,
+                "alert_types": sorted(entry["alert_types"]),
+                "job_id": job["id"]
+            })
+
+    if response["jobs"]:
+        response["status"] = "accepted"
+        return jsonify(response), 202
+    return jsonify(response)
 
 
 def classify_alert(alert_name, summary, description):
@@ -135,22 +403,3 @@ def classify_alert(alert_name, summary, description):
 
     else:
         return "unknown"
-
-
-def process_alert(alert_type, instance, severity, description):
-    print(f"[ALERT] Type: {alert_type}, Host: {instance}, Severity: {severity}")
-
-    if alert_type == "cpu":
-        print(f"[ACTION] CPU 高负载告警: {description}")
-        # TODO: 这里可以调用扩容函数或发送通知
-
-    elif alert_type == "memory":
-        print(f"[ACTION] 内存高使用告警: {description}")
-        # TODO: 检查是否支持弹性内存，决定是否扩容
-
-    elif alert_type == "disk":
-        print(f"[ACTION] 磁盘空间不足告警: {description}")
-        # TODO: 清理缓存、扩展磁盘配额、通知用户
-
-    else:
-        print(f"[ACTION] 未知告警: {description}")
@@ -1,15 +1,19 @@
 # handlers/api_handler.py
 
 import os
-import asyncio
-import asyncssh
-from datetime import datetime, timedelta
+from datetime import datetime
 import yaml
-from flask import Blueprint, jsonify, request
-import threading
-import time
-from services.kvm_inspector import get_all_vms_on_host
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from services import (balloon_tuner, compression_planner, forecaster, inventory, libvirt_pool, metric_store,
+                      migrator, usage_sampler, vm_policy)
+from services.change_feed import FEED
 from services.server_manager import get_server_list
+from services.host_metrics import SNAPSHOT_COMMAND, parse_snapshot, compute_metrics
+from services.host_scheduler import HostCollectionScheduler
+from utils.leader import LEADER
+from utils.queue_manager import JOB_QUEUE
+from utils.shared_snapshot import build_snapshot
+from utils.ssh_pool import SSH_POOL, get_loop
 
 # Load configuration
 config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
@@ -17,10 +21,13 @@ with open(config_path, "r") as f:
     config = yaml.safe_load(f)
 
 # Cache for server metrics with timestamp control
+# { "hosts": { server_ip: {"data": dict, "timestamp": datetime} } }，每台宿主机独立更新
+# 只有当选的采集者写入本地缓存，并发布到共享快照供其他 worker 读取
+# hosts 字典发布后不再原地修改：写入方复制后整体替换，读取方拿到的引用可以安全遍历
 SERVER_CACHE = {
-    "data": None,
-    "timestamp": None
+    "hosts": {}
 }
+SHARED_SERVER_CACHE = build_snapshot("server_cache")
 CACHE_TTL = 180  # seconds
 
 api_bp = Blueprint('api', __name__)
@@ -34,173 +41,428 @@ def list_kvm_vms():
         return jsonify({"error": "Host IP is required"}), 400
 
     try:
-        vms = get_all_vms_on_host(host_ip)
+        vms = inventory.get_host_vms(host_ip)
         return jsonify(vms)
     except Exception as e:
         print(f"[ERROR] Failed to get VM list from {host_ip}: {str(e)}")
         return jsonify({"error": f"Failed to get VM list from {host_ip}"}), 500
-async def _async_get_remote_metric(host, command, port=22, retries=3):
-    import textwrap
 
-    cmd = textwrap.dedent(command).strip()
 
-    username = config.get('default_ssh_username', 'root')
-    key_path = os.path.expanduser(config.get('default_ssh_key_path', '~/.ssh/id_rsa'))
+@api_bp.route('/kvm/all')
+def list_cluster_vms():
+    """
+    返回所有宿主机的虚拟机清单，带每台宿主机的状态；单台宿主机故障只影响其自身条目
+    """
+    timeout = request.args.get('timeout', type=float)
+    try:
+        return jsonify(inventory.get_cluster_vms(timeout=timeout))
+    except Exception as e:
+        print(f"[ERROR] Failed to get cluster VM list: {str(e)}")
+        return jsonify({"error": "Failed to get cluster VM list"}), 500
+
+
+@api_bp.route('/jobs/<job_id>')
+def get_job(job_id):
+    """
+    查询后台任务（如告警触发的扩容）的状态与结果
+    """
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job)
+
+
+@api_bp.route('/jobs')
+def get_job_stats():
+    return jsonify(JOB_QUEUE.stats())
+
+
+@api_bp.route('/compression/plan', methods=['POST'])
+def plan_compression():
+    """
+    为目标 VM 规划需要压缩的其他 VM：{"host", "vm_uuid", "vcpu", "mem_mb", "dry_run"}。
+    dry_run 默认为 true，只返回方案；为 false 时并行执行方案并返回每台 VM 的结果。
+    """
+    data = request.get_json() or {}
+    host_ip = data.get("host")
+    vm_uuid = data.get("vm_uuid")
+    if not host_ip or not vm_uuid:
+        return jsonify({"error": "Missing host or vm_uuid"}), 400
+
+    try:
+        plan = compression_planner.plan_for_vm(host_ip, vm_uuid, need_vcpu=int(data.get("vcpu", 0)),
+                                               need_mem_kb=int(data.get("mem_mb", 0)) * 1024)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        print(f"[ERROR] Failed to plan compression on {host_ip}: {str(e)}")
+        return jsonify({"error": f"Failed to plan compression on {host_ip}"}), 500
+
+    dry_run = data.get("dry_run", True)
+    if dry_run or not plan["feasible"]:
+        # 不可行的方案不执行，避免压缩了其他 VM 却仍然无法扩容
+        return jsonify({"dry_run": dry_run, "executed": False, "plan": plan})
+    return jsonify({"dry_run": False, "executed": True, "plan": plan,
+                    "results": compression_planner.execute_plan(plan)})
+
+
+@api_bp.route('/placement/plan', methods=['POST'])
+def plan_placement():
+    """
+    为容量不足的目标 VM 规划跨宿主机迁移：{"host", "vm_uuid", "vcpu", "mem_mb", "execute"}。
+    execute 默认为 false，只返回建议；为 true 时执行迁移。
+    """
+    data = request.get_json() or {}
+    host_ip = data.get("host")
+    vm_uuid = data.get("vm_uuid")
+    if not host_ip or not vm_uuid:
+        return jsonify({"error": "Missing host or vm_uuid"}), 400
 
-    for attempt in range(retries):
+    try:
+        proposal = migrator.propose_relief(host_ip, vm_uuid, need_vcpu=int(data.get("vcpu", 0)),
+                                           need_mem_kb=int(data.get("mem_mb", 0)) * 1024)
+    except Exception as e:
+        print(f"[ERROR] Failed to plan placement for {vm_uuid}: {str(e)}")
+        return jsonify({"error": f"Failed to plan placement for {vm_uuid}"}), 500
+    if proposal is None:
+        return jsonify({"proposal": None, "executed": False})
+    if not data.get("execute", False):
+        return jsonify({"proposal": proposal, "executed": False})
+    return jsonify({"proposal": proposal, "executed": True, "result": migrator.migrate(proposal)})
+
+
+@api_bp.route('/balloon/<host_ip>', methods=['GET', 'POST'])
+def tune_balloons(host_ip):
+    """
+    GET 预览一台宿主机的气球调整方案，POST 立即执行一轮调整
+    """
+    try:
+        return jsonify(balloon_tuner.tune_host(host_ip, dry_run=request.method == 'GET'))
+    except Exception as e:
+        print(f"[ERROR] Balloon tuning failed for {host_ip}: {str(e)}")
+        return jsonify({"error": f"Balloon tuning failed for {host_ip}"}), 500
+
+
+@api_bp.route('/policies', methods=['POST'])
+def set_vm_policies():
+    """
+    批量设置 VM 伸缩策略（写入域元数据）：
+    {"policies": [{"host", "uuid", "policy": {...}}, ...]}
+    未给出的字段使用 default_vm_policy。返回每台 VM 的结果。
+    """
+    data = request.get_json() or {}
+    items = data.get("policies")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing policies"}), 400
+    if any(not item.get("host") or not item.get("uuid") or not isinstance(item.get("policy"), dict)
+           for item in items):
+        return jsonify({"error": "Every entry needs host, uuid and policy"}), 400
+
+    by_host = {}
+    for item in items:
+        by_host.setdefault(item["host"], {})[item["uuid"]] = item["policy"]
+
+    results = {}
+    for host_ip, policies in by_host.items():
         try:
-            async with asyncssh.connect(
-                host, port=port,
-                username=username,
-                client_keys=[key_path],
-                known_hosts=None
-            ) as conn:
-
-                result = await conn.run(cmd, check=True)
-                return result.stdout.strip()
+            conn = libvirt_pool.get_connection(host_ip)
         except Exception as e:
-            print(f"[ERROR] SSH connection failed for {host} (attempt {attempt+1}/{retries}): {e}")
-            await asyncio.sleep(1)
-    return None
+            print(f"[ERROR] Failed to connect to {host_ip}: {str(e)}")
+            results.update({uuid: {"success": False, "error": f"host {host_ip} unavailable"} for uuid in policies})
+            continue
+        results.update(vm_policy.set_policies(conn, policies))
 
+    failed = sum(1 for r in results.values() if not r["success"])
+    return jsonify({"updated": len(results) - failed, "failed": failed, "results": results})
 
-async def _collect_single_server(server_ip, server_config):
-    ssh_port = server_config.get('ssh_port', 22)
 
-    # 同时发起多个命令
-    cpu_task = _async_get_remote_metric(
-        server_ip,
-        "grep '^cpu ' /proc/stat | awk '{usage=($2+$4)*100/($2+$4+$5)} END {printf \"%.2f%%\", usage}'",
-        port=ssh_port
-    )
-
-    mem_task = _async_get_remote_metric(
-        server_ip,
-        "free -m | grep Mem | awk '{print $3,$2}'",
-        port=ssh_port
-    )
-
-    disk_task = _async_get_remote_metric(
-        server_ip,
-        """
-        df -h --output=source,target,size,used,pcent 2>/dev/null |
-        awk '$1 ~ /^\\/dev\\// && $2 !~ /^\\/(boot|media)/ && $1 !~ /swap/ {
-            gsub(/%/, "", $5);
-            print $2, $3, $4, $5
-        }'
-        """,
-        port=ssh_port
-    )
-
-
-    cpu_str, mem_output, disk_output = await asyncio.gather(cpu_task, mem_task, disk_task)
-
-    # Parse CPU
-    cpu_percent = float(cpu_str.strip('%')) if cpu_str and cpu_str != "N/A" else 0.0
-
-    # Parse Memory
-    mem_used_mb, mem_total_mb = 0, 0
-    if mem_output:
-        try:
-            used, total = map(int, mem_output.split())
-            mem_used_mb = used
-            mem_total_mb = total
-        except:
-            pass
-    mem_usage_percent = round(mem_used_mb * 100.0 / mem_total_mb, 2) if mem_total_mb else 0
-
-    # Parse Disk
-    # Parse Disk Info (Multiple Mount Points)
-    disk_info = []
-    if disk_output:
-        try:
-            for line in disk_output.strip().splitlines():
-                if not line.strip():
-                    continue
-                parts = line.split()
-                mount_point = parts[0]
-                total = parts[1]
-                used = parts[2]
-                percent = int(parts[3])
-
-                # 单位转换 G/T -> GB
-                def parse_size(s):
-                    if s.endswith("G"):
-                        return float(s[:-1])
-                    elif s.endswith("T"):
-                        return float(s[:-1]) * 1024
-                    elif s.endswith("M"):
-                        return float(s[:-1]) / 1024
-                    else:
-                        return float(s) / 1024 / 1024  # KB to GB
-
-                total_gb = round(parse_size(total), 2)
-                used_gb = round(parse_size(used), 2)
-
-                disk_info.append({
-                    "mount_point": mount_point,
-                    "total_gb": total_gb,
-                    "used_gb": used_gb,
-                    "usage_percent": percent
-                })
-        except Exception as e:
-            print(f"[WARN] Failed to parse disk info: {e}")
+@api_bp.route('/policies/<vm_uuid>')
+def get_vm_policy(vm_uuid):
+    """
+    查询 VM 当前生效的策略（读取清单，不访问宿主机）
+    """
+    host_ip = request.args.get('host')
+    if not host_ip:
+        return jsonify({"error": "Host IP is required"}), 400
+    vm = inventory.get_vm(host_ip, vm_uuid)
+    if vm is None:
+        return jsonify({"error": f"VM {vm_uuid} not found on host {host_ip}"}), 404
+    return jsonify(vm.get("policy") or vm_policy.DEFAULT_POLICY)
+
+
+@api_bp.route('/forecast/<vm_uuid>')
+def get_vm_forecast(vm_uuid):
+    """
+    返回 VM 未来 forecast.horizon 秒内预测的 CPU / 内存利用率峰值
+    """
+    peak = forecaster.cached_peak(vm_uuid)
+    if peak is None:
+        return jsonify({"error": f"No usage history for VM {vm_uuid}"}), 404
+    return jsonify({"uuid": vm_uuid, "horizon_seconds": forecaster.HORIZON, "peak": peak})
+
+
+@api_bp.route('/forecast/backtest')
+def backtest_forecast():
+    """
+    在已记录的历史上回测预测扩容：?threshold=90&horizon=1800（秒），返回可避免的饱和分钟数等。
+    长周期历史只保存在领导者进程中，其他 worker 返回 503
+    """
+    if not LEADER.is_leader():
+        return jsonify({"error": "Usage history is kept by the collector worker only, retry later"}), 503
+    threshold = request.args.get('threshold', 90, type=float)
+    horizon = request.args.get('horizon', forecaster.HORIZON, type=int)
+    result = forecaster.backtest_recorded(threshold=threshold,
+                                          horizon=max(horizon // usage_sampler.HISTORY_BUCKET, 1))
+    if result is None:
+        return jsonify({"error": "No usage history recorded yet"}), 404
+    return jsonify(result)
+
+
+@api_bp.route('/kvm/<vm_uuid>/cpu_history')
+def get_vm_cpu_history(vm_uuid):
+    """
+    返回单台虚拟机环形缓冲区内的 CPU 利用率历史及各窗口利用率。
+    只有领导者采样，其他 worker 读取领导者发布的共享快照
+    """
+    if LEADER.is_leader():
+        history, usage = usage_sampler.get_history(vm_uuid), usage_sampler.get_usage(vm_uuid)
+    else:
+        shared = usage_sampler.read_shared(vm_uuid) or {}
+        history, usage = shared.get("history"), shared.get("usage")
+    if history is None:
+        return jsonify({"error": f"No CPU samples for VM {vm_uuid}"}), 404
+    return jsonify({
+        "uuid": vm_uuid,
+        "sample_interval": usage_sampler.SAMPLE_INTERVAL,
+        "usage": usage,
+        "history": [{"timestamp": ts, "cpu_percent": percent} for ts, percent in history]
+    })
+
+
+@api_bp.route('/metrics/history')
+def get_metrics_history():
+    """
+    宿主机 / VM 指标的历史范围查询：
+    ?kind=host|vm&id=<host_ip 或 vm_uuid>&start=<epoch 秒>&end=<epoch 秒>&resolution=raw|1m|10m|1h
+    start 默认一小时前，end 默认当前；未指定 resolution 时按时间跨度自动选择
+    """
+    kind = request.args.get('kind', 'host')
+    series_id = request.args.get('id')
+    if kind not in metric_store.FIELDS:
+        return jsonify({"error": f"kind must be one of {sorted(metric_store.FIELDS)}"}), 400
+    if not series_id:
+        return jsonify({"error": "id is required"}), 400
+    try:
+        end = float(request.args.get('end') or datetime.now().timestamp())
+        start = float(request.args.get('start') or end - 3600)
+    except ValueError:
+        return jsonify({"error": "start and end must be epoch seconds"}), 400
+    if start > end:
+        return jsonify({"error": "start must not be after end"}), 400
+
+    try:
+        result = metric_store.STORE.query(kind, series_id, start, end, request.args.get('resolution'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(result, kind=kind, id=series_id, start=int(start), end=int(end)))
+
 
+async def _async_get_remote_metric(host, command, port=22):
+    import textwrap
+
+    cmd = textwrap.dedent(command).strip()
+
+    try:
+        # 命令作为 channel 跑在该主机的长连接上，连接失效时由连接池重建
+        output = await SSH_POOL.run(host, cmd, port=port)
+        return output.strip()
+    except Exception as e:
+        print(f"[ERROR] SSH command failed for {host}: {e}")
+    return None
+
+
+def _offline_server(server_ip):
     return {
         "ip": server_ip,
-        "cpu_percent": cpu_percent,
-        "mem_used_mb": mem_used_mb,
-        "mem_total_mb": mem_total_mb,
-        "mem_usage_percent": mem_usage_percent,
-        "disk_info": disk_info,  # 👈 新增字段
-        "status": "active" if cpu_percent > 0 else "offline"
+        "cpu_percent": 0.0,
+        "mem_used_mb": 0,
+        "mem_total_mb": 0,
+        "mem_usage_percent": 0,
+        "disk_info": [],
+        "status": "offline"
     }
 
 
-async def _collect_all_servers(servers):
-    tasks = []
-    for server_ip in servers:
-        server_config = config.get('servers', {}).get(server_ip, {})
-        task = _collect_single_server(server_ip, server_config)
-        tasks.append(task)
+async def _collect_single_server(server_ip, server_config):
+    ssh_port = server_config.get('ssh_port', 22)
 
-    results = await asyncio.gather(*tasks)
-    return {"servers": list(results)}
-def _background_cache_updater():
-    while True:
-        try:
-            servers = get_server_list()
-            loop = asyncio.new_event_loop()
-            data = loop.run_until_complete(_collect_all_servers(servers))
-            global SERVER_CACHE
-            SERVER_CACHE = {
-                "data": data,
-                "timestamp": datetime.now()
-            }
-            print("[INFO] Server metrics cache updated.")
-        except Exception as e:
-            print(f"[ERROR] Failed to update server metrics: {e}")
-        time.sleep(CACHE_TTL //2)  # 每隔一半 TTL 更新一次
+    # 一次往返读取 /proc/stat、/proc/meminfo、/proc/loadavg、/proc/diskstats 与 df 字节数，在本地解析
+    output = await _async_get_remote_metric(server_ip, SNAPSHOT_COMMAND, port=ssh_port)
+    if not output:
+        return _offline_server(server_ip)
+
+    try:
+        snapshot = parse_snapshot(output)
+    except (ValueError, IndexError) as e:
+        print(f"[WARN] Failed to parse metrics snapshot from {server_ip}: {e}")
+        return _offline_server(server_ip)
+    # CPU 与 IO 由与上一次快照的差值得出，反映当前负载
+    return compute_metrics(server_ip, snapshot)
+
+
+async def _collect_host(server_ip):
+    server_config = config.get('servers', {}).get(server_ip, {})
+    return await _collect_single_server(server_ip, server_config)
+
+
+def _on_host_result(server_ip, result):
+    """
+    单台宿主机采集完成后立即写回缓存，不等待其他宿主机。
+    在调度器的回写线程上逐个执行（不占用事件循环），请求线程可能正在遍历当前的 hosts，因此复制后整体替换
+    """
+    hosts = dict(SERVER_CACHE["hosts"])
+    hosts[server_ip] = {
+        "data": result,
+        "timestamp": datetime.now()
+    }
+    SERVER_CACHE["hosts"] = hosts
+    metric_store.record_host(server_ip, result)
+    FEED.notify()
+    # 共享快照中时间戳存为 epoch 秒，由读取方换算
+    SHARED_SERVER_CACHE.publish({
+        "hosts": {ip: {"data": entry["data"], "timestamp": entry["timestamp"].timestamp()}
+                  for ip, entry in hosts.items()},
+        "refreshing": any(state["in_flight"] for state in SCHEDULER.status().values()),
+    })
+
+
+collector_config = config.get('collector', {}) or {}
+SCHEDULER = HostCollectionScheduler(
+    _collect_host,
+    _on_host_result,
+    interval=collector_config.get('interval', CACHE_TTL // 2),
+    fast_interval=collector_config.get('fast_interval', 30),
+    max_backoff=collector_config.get('max_backoff', 600),
+    jitter=collector_config.get('jitter', 0.1),
+    timeout=collector_config.get('timeout', 60),
+    pressure_cpu_percent=collector_config.get('pressure_cpu_percent', 80),
+    pressure_mem_percent=collector_config.get('pressure_mem_percent', 85),
+)
+
+# 只有当选的 worker 启动按宿主机独立调度的后台采集，SSH 负载不随 worker 数增加
+LEADER.on_elected(lambda: SCHEDULER.start(get_loop(), get_server_list()))
+LEADER.on_demoted(SCHEDULER.stop)
+
+
+def _read_server_cache():
+    """
+    领导者直接读本地缓存；其他 worker 读取共享快照（快照未变化时不重复解析）。
+    返回 (hosts, refreshing)，hosts 不会再被修改，调用方可以直接遍历
+    """
+    if LEADER.is_leader():
+        return SERVER_CACHE["hosts"], any(state["in_flight"] for state in SCHEDULER.status().values())
+    try:
+        shared = SHARED_SERVER_CACHE.read()
+    except Exception as e:
+        print(f"[WARN] Failed to read shared server cache: {e}")
+        shared = None
+    if not shared:
+        return {}, False
+    hosts = {ip: {"data": entry["data"], "timestamp": datetime.fromtimestamp(entry["timestamp"])}
+             for ip, entry in shared["hosts"].items()}
+    return hosts, shared.get("refreshing", False)
 
-# 启动后台采集线程
-threading.Thread(target=_background_cache_updater, daemon=True).start()
 
 def get_servers_data():
-    global SERVER_CACHE
+    """
+    stale-while-revalidate：总是立即返回各宿主机最近一次的采集结果，从不在请求中执行 SSH。
+    某台宿主机的数据缺失或超过 CACHE_TTL 时提醒调度器尽快采集它（同一主机不会重复发起，
+    只有领导者持有调度器，其他 worker 只读共享快照）。
+    每条服务器记录附带 age_seconds，整体的 age_seconds 取最旧的一台。
+    """
     now = datetime.now()
+    hosts, refreshing = _read_server_cache()
+    servers = []
+    ages = []
+    stale = False
+
+    for server_ip in get_server_list():
+        entry = hosts.get(server_ip)
+        if entry is None:
+            stale = True
+            SCHEDULER.poke(server_ip)
+            continue
+        age_seconds = round((now - entry["timestamp"]).total_seconds(), 1)
+        if age_seconds >= CACHE_TTL:
+            stale = True
+            SCHEDULER.poke(server_ip)
+        ages.append(age_seconds)
+        servers.append(dict(entry["data"], age_seconds=age_seconds))
 
-    # Check cache validity
-    if SERVER_CACHE["data"] and SERVER_CACHE["timestamp"]:
-        if (now - SERVER_CACHE["timestamp"]).total_seconds() < CACHE_TTL:
-            return SERVER_CACHE["data"]
+    return {
+        "servers": servers,
+        "age_seconds": max(ages) if ages else None,
+        "stale": stale,
+        "refreshing": refreshing
+    }
 
-    servers = get_server_list()
-    loop = asyncio.new_event_loop()
-    data = loop.run_until_complete(_collect_all_servers(servers))
 
-    SERVER_CACHE = {
-        "data": data,
-        "timestamp": now
-    }
+@api_bp.route('/servers')
+def list_servers():
+    return jsonify(get_servers_data())
+
+
+def _servers_topic(_):
+    """
+    推送主题 servers：各宿主机最近一次的采集结果，以采集时间作为版本
+    """
+    hosts, _ = _read_server_cache()
+    if not hosts:
+        return None, None
+    items = {ip: dict(entry["data"], timestamp=entry["timestamp"].timestamp()) for ip, entry in hosts.items()}
+    return (len(items), max(item["timestamp"] for item in items.values())), items
+
+
+def _vms_topic(host_ip):
+    """
+    推送主题 vms:<host_ip>：该宿主机的虚拟机清单（纯内存读取），尚未加载时在后台加载
+    """
+    records, updated_at = inventory.get_host_snapshot(host_ip)
+    if records is None:
+        inventory.load_async(host_ip)
+        return None, None
+    return updated_at, {vm["uuid"]: vm for vm in records}
+
+
+FEED.register("servers", _servers_topic)
+FEED.register("vms", _vms_topic)
+
+
+@api_bp.route('/stream')
+def stream_changes():
+    """
+    Server-Sent Events：?topics=servers,vms:<host_ip>
+    每个主题先推送一次 snapshot 事件（完整数据），之后只推送 patch 事件（字段级变更）
+    """
+    topics = [topic for topic in request.args.get('topics', 'servers').split(',') if topic]
+    servers = set(get_server_list())
+    for topic in topics:
+        prefix, _, host_ip = topic.partition(':')
+        if prefix == "vms" and host_ip not in servers:
+            return jsonify({"error": f"Unknown host in topic '{topic}'"}), 400
+    try:
+        subscription = FEED.subscribe(topics)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    return data
+    def generate():
+        try:
+            # 断线后浏览器 3 秒后重连，重连时重新收到快照
+            yield "retry: 3000\n\n"
+            for message in subscription.events():
+                yield message
+        finally:
+            FEED.unsubscribe(subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
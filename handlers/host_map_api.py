@@ -1,10 +1,12 @@
 # handlers/host_map_api.py
 
 from flask import Blueprint, request, jsonify
-from services.vm_locator import KVMMAP_KEY, redis_client
+from services.vm_locator import HOST_MAP
 
 host_map_bp = Blueprint('host_map', __name__)
 
+MAX_PAGE_SIZE = 5000
+
 
 @host_map_bp.route('/map/kvm', methods=['POST'])
 def add_kvm_mapping():
@@ -15,7 +17,7 @@ def add_kvm_mapping():
     if not kvm_ip or not host_ip:
         return jsonify({"error": "Missing kvm_ip or host_ip"}), 400
 
-    redis_client.hset(KVMMAP_KEY, kvm_ip, host_ip)
+    HOST_MAP.set_many({kvm_ip: host_ip})
     return jsonify({
         "status": "success",
         "message": f"Mapped KVM {kvm_ip} to Host {host_ip}"
@@ -24,7 +26,7 @@ def add_kvm_mapping():
 
 @host_map_bp.route('/map/kvm/<kvm_ip>', methods=['DELETE'])
 def remove_kvm_mapping(kvm_ip):
-    result = redis_client.hdel(KVMMAP_KEY, kvm_ip)
+    result = HOST_MAP.delete_many([kvm_ip])
     if result == 1:
         return jsonify({"status": "success", "message": f"Removed mapping for {kvm_ip}"})
     else:
@@ -33,5 +35,47 @@ def remove_kvm_mapping(kvm_ip):
 
 @host_map_bp.route('/map/kvm', methods=['GET'])
 def get_all_mappings():
-    mappings = redis_client.hgetall(KVMMAP_KEY)
-    return jsonify(mappings)
+    """
+    HSCAN 分页列出映射：?cursor=0&count=500，返回的 cursor 为 0 表示已到末尾
+    """
+    cursor = request.args.get('cursor', 0, type=int)
+    count = min(request.args.get('count', 500, type=int), MAX_PAGE_SIZE)
+    next_cursor, mappings = HOST_MAP.scan_page(cursor=cursor, count=count)
+    return jsonify({"cursor": next_cursor, "mappings": mappings})
+
+
+@host_map_bp.route('/map/kvm/import', methods=['POST'])
+def import_kvm_mappings():
+    """
+    批量导入映射，支持 {"mappings": {kvm_ip: host_ip}} 或 {"mappings": [{"kvm_ip", "host_ip"}]}
+    """
+    data = request.get_json() or {}
+    mappings = data.get("mappings")
+    if isinstance(mappings, list):
+        if any(not item.get("kvm_ip") or not item.get("host_ip") for item in mappings):
+            return jsonify({"error": "Every mapping needs kvm_ip and host_ip"}), 400
+        mappings = {item["kvm_ip"]: item["host_ip"] for item in mappings}
+    if not isinstance(mappings, dict) or not mappings:
+        return jsonify({"error": "Missing mappings"}), 400
+    if any(not kvm_ip or not host_ip for kvm_ip, host_ip in mappings.items()):
+        return jsonify({"error": "Every mapping needs kvm_ip and host_ip"}), 400
+
+    imported = HOST_MAP.set_many(mappings)
+    return jsonify({"status": "success", "imported": imported})
+
+
+@host_map_bp.route('/map/kvm/export', methods=['GET'])
+def export_kvm_mappings():
+    mappings = HOST_MAP.export()
+    return jsonify({"count": len(mappings), "mappings": mappings})
+
+
+@host_map_bp.route('/map/kvm/bulk_delete', methods=['POST'])
+def bulk_delete_kvm_mappings():
+    data = request.get_json() or {}
+    kvm_ips = data.get("kvm_ips")
+    if not isinstance(kvm_ips, list) or not kvm_ips:
+        return jsonify({"error": "Missing kvm_ips"}), 400
+
+    removed = HOST_MAP.delete_many(kvm_ips)
+    return jsonify({"status": "success", "requested": len(kvm_ips), "removed": removed})
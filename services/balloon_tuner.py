@@ -0,0 +1,203 @@
+# services/balloon_tuner.py
+
+import logging
+import os
+import threading
+import time
+
+import libvirt
+import yaml
+
+from services import kvm_inspector, libvirt_pool, vm_policy
+from services.capacity_ledger import LEDGER
+from services.domain_desc import get_domain_desc
+from services.server_manager import get_server_list
+from utils.leader import LEADER
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+BALLOON_CONFIG = CONFIG.get('balloon', {}) or {}
+ENABLED = BALLOON_CONFIG.get('enabled', True)
+INTERVAL = BALLOON_CONFIG.get('interval', 60)  # 调整周期，单位秒
+HEADROOM = BALLOON_CONFIG.get('headroom', 0.25)  # 在客户机已用内存之上保留的余量比例
+MIN_FREE_MB = BALLOON_CONFIG.get('min_free_mb', 256)  # 余量下限（MiB）
+HYSTERESIS = BALLOON_CONFIG.get('hysteresis', 0.1)  # 目标与当前相差不足该比例时不调整
+SHRINK_ROUNDS = BALLOON_CONFIG.get('shrink_rounds', 3)  # 连续多少轮都可回收才真正收缩
+RECLAIM_FREE_RATIO = BALLOON_CONFIG.get('reclaim_free_ratio', 0.25)  # 宿主机空闲内存低于该比例时才回收
+STATS_PERIOD = BALLOON_CONFIG.get('stats_period', 10)  # 客户机气球统计上报周期，单位秒
+
+# 只需要状态和气球统计
+TUNER_STATS = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON
+
+_SHRINK_STREAK = {}  # { uuid: 连续可回收的轮数 }
+_STATS_ENABLED = set()  # 已开启气球统计上报的 VM
+_LOCK = threading.Lock()
+_started = False
+_start_lock = threading.Lock()
+
+
+def balloon_target_kb(stats, policy):
+    """
+    由气球统计计算目标内存（KiB）：客户机已用内存加余量。
+    - 扩容时不超过策略 max 与最大内存，但也不低于当前大小
+    - 回收时不低于策略 min，且无论上限如何都不低于已用内存加余量
+    缺少客户机内部统计（未装 virtio-balloon 驱动或未开启上报）时返回 None。
+    """
+    available = stats.get("balloon.available")
+    # usable 扣除了可回收的页缓存，比 unused 更接近真正可以还给宿主机的量
+    free = stats.get("balloon.usable", stats.get("balloon.unused"))
+    if not available or free is None:
+        return None
+    used = max(available - free, 0)
+    needed = used + max(int(used * HEADROOM), MIN_FREE_MB * 1024)
+    current = stats.get("balloon.current", needed)
+    upper = min(policy["max_mem_mb"] * 1024, stats.get("balloon.maximum", needed))
+    if needed >= current:
+        # 上限只限制扩容幅度，已经超过上限的 VM 保持当前大小
+        return max(min(needed, upper), current)
+    target = max(needed, min(policy["min_mem_mb"] * 1024, current))
+    return max(min(target, upper), needed)
+
+
+def plan_host(domain_stats, host_free_ratio, dry_run=False):
+    """
+    计算一台宿主机的调整方案（纯计算，不修改任何 VM）。
+    - 客户机内存不足（目标高于当前）时立即放气扩容
+    - 可回收时需连续 SHRINK_ROUNDS 轮都满足，且宿主机空闲内存低于 RECLAIM_FREE_RATIO，才充气回收
+    - 相差不足 HYSTERESIS 的不调整，避免来回抖动
+    dry_run 时不更新连续可回收轮数。返回 [{"domain", "uuid", "name", "from_kb", "to_kb"}]，回收在前、扩容在后
+    """
+    reclaim = host_free_ratio < RECLAIM_FREE_RATIO
+    shrinks, grows = [], []
+    seen = set()
+    for domain, stats in domain_stats:
+        if stats.get("state.state") != libvirt.VIR_DOMAIN_RUNNING:
+            continue
+        uuid = domain.UUIDString()
+        seen.add(uuid)
+        policy = vm_policy.policy_for_desc(get_domain_desc(domain))
+        if policy["policy"] == "fixed":
+            continue
+        current = stats.get("balloon.current", 0)
+        target = balloon_target_kb(stats, policy)
+        if not current or target is None:
+            continue
+        if abs(target - current) < current * HYSTERESIS:
+            if not dry_run:
+                with _LOCK:
+                    _SHRINK_STREAK.pop(uuid, None)
+            continue
+
+        change = {"domain": domain, "uuid": uuid, "name": domain.name(), "from_kb": current, "to_kb": target}
+        if target > current:
+            if not dry_run:
+                with _LOCK:
+                    _SHRINK_STREAK.pop(uuid, None)
+            grows.append(change)
+            continue
+        with _LOCK:
+            streak = _SHRINK_STREAK.get(uuid, 0) + 1
+            if not dry_run:
+                _SHRINK_STREAK[uuid] = streak
+        if reclaim and streak >= SHRINK_ROUNDS:
+            shrinks.append(change)
+
+    if not dry_run:
+        with _LOCK:
+            for uuid in [u for u in _SHRINK_STREAK if u not in seen]:
+                del _SHRINK_STREAK[uuid]
+    # 先回收再扩容，扩容需要的内存优先来自本轮回收的部分
+    return shrinks + grows
+
+
+def _enable_stats(domain_stats):
+    """
+    没有客户机内部统计的 VM 开启气球统计上报（每台 VM 只尝试一次），下一轮起即可参与调整
+    """
+    for domain, stats in domain_stats:
+        if stats.get("state.state") != libvirt.VIR_DOMAIN_RUNNING or "balloon.available" in stats:
+            continue
+        uuid = domain.UUIDString()
+        with _LOCK:
+            if uuid in _STATS_ENABLED:
+                continue
+            _STATS_ENABLED.add(uuid)
+        try:
+            domain.setMemoryStatsPeriod(STATS_PERIOD, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        except libvirt.libvirtError as e:
+            logger.debug(f"Cannot enable balloon stats for {domain.name()}: {e}")
+
+
+def _apply_change(host_ip, domain, change):
+    """执行单台 VM 的气球调整；扩容先在容量账本中预留，回收直接记账"""
+    delta = change["to_kb"] - change["from_kb"]
+    reservation = LEDGER.reserve(host_ip, mem_kb=delta, uuid=change["uuid"])
+    if reservation is None:
+        change["error"] = f"host {host_ip} has no capacity for +{delta} KiB"
+        return
+    try:
+        domain.setMemoryFlags(change["to_kb"], libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    except libvirt.libvirtError as e:
+        LEDGER.release(reservation["id"])
+        change["error"] = str(e)
+        logger.warning(f"Balloon resize of {change['name']} on {host_ip} failed: {e}")
+        return
+    LEDGER.commit(reservation["id"])
+    change["applied"] = True
+
+
+def tune_host(host_ip, dry_run=False):
+    """
+    对一台宿主机做一轮气球调整：一次 getAllDomainStats 取全部 VM 的气球统计，
+    计算方案后在同一个连接上批量 setMemoryFlags（只改运行时，不改持久化定义）。
+    返回 {"host", "host_free_ratio", "changes": [...]}
+    """
+    conn = libvirt_pool.get_connection(host_ip)
+    domain_stats = kvm_inspector.collect_domain_stats(conn, TUNER_STATS,
+                                                      libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    total_kb = conn.getInfo()[1] * 1024
+    host_free_ratio = conn.getFreeMemory() / 1024 / total_kb if total_kb else 1.0
+    if not dry_run:
+        _enable_stats(domain_stats)
+
+    changes = []
+    for change in plan_host(domain_stats, host_free_ratio, dry_run=dry_run):
+        domain = change.pop("domain")
+        change["applied"] = False
+        change["error"] = None
+        if not dry_run:
+            _apply_change(host_ip, domain, change)
+        changes.append(change)
+
+    if changes and not dry_run:
+        logger.info(f"Balloon tuning on {host_ip}: {sum(c['applied'] for c in changes)}/{len(changes)} VMs resized")
+    return {"host": host_ip, "host_free_ratio": round(host_free_ratio, 4), "dry_run": dry_run, "changes": changes}
+
+
+def _tune_loop():
+    while True:
+        time.sleep(INTERVAL)
+        # 多 worker 部署时只由当选的采集者执行
+        if not LEADER.is_leader():
+            continue
+        for host_ip in get_server_list():
+            try:
+                tune_host(host_ip)
+            except Exception as e:
+                logger.warning(f"Balloon tuning failed for {host_ip}: {e}")
+
+
+def start():
+    """
+    启动周期性气球调整线程（配置中 balloon.enabled 为 false 时不启动）
+    """
+    global _started
+    with _start_lock:
+        if _started or not ENABLED:
+            return
+        threading.Thread(target=_tune_loop, name="balloon-tuner", daemon=True).start()
+        _started = True
@@ -0,0 +1,236 @@
+# services/capacity_ledger.py
+
+import logging
+import os
+import threading
+import time
+import uuid as uuid_lib
+from contextlib import contextmanager
+
+import yaml
+
+from services import inventory, libvirt_pool
+from utils.shared_snapshot import LocalSharedState, build_shared_state
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+CAPACITY_CONFIG = CONFIG.get('capacity', {}) or {}
+
+
+class CapacityLedger:
+    """
+    宿主机容量账本，扩缩容决策只做内存检查，多个工作线程、多个 worker 进程并发决策也不会超卖。
+    - 物理容量：getInfo 的内存、getCPUMap 的在线 CPU 数，按 host_info_ttl 缓存（每个进程各自缓存）
+    - 已分配：清单中运行中 VM 的 vCPU / 内存之和（纯内存读取）
+    - 可分配 = 物理容量 × 超分比 - 已分配 - 未完成的预留
+    - 预留与已提交的规格存放在 state（所有 worker 共享，见 build_shared_state）中，
+      reserve 在 state 的事务内检查并占用容量；执行成功后 commit，失败则 release
+    - commit 后该 VM 的新规格先记在账本里，直到清单通过事件 / 对账反映出变化（或超过 reservation_ttl）
+    """
+
+    def __init__(self, cpu_overcommit=4.0, mem_overcommit=1.0, host_reserved_mem_kb=0,
+                 reservation_ttl=120, host_info_ttl=600, state=None):
+        self.cpu_overcommit = cpu_overcommit
+        self.mem_overcommit = mem_overcommit
+        self.host_reserved_mem_kb = host_reserved_mem_kb
+        self.reservation_ttl = reservation_ttl
+        self.host_info_ttl = host_info_ttl
+        self._lock = threading.Lock()
+        self._hosts = {}  # { host_ip: {"cpus", "online_cpus", "mem_kb", "refreshed_at"} }
+        # 共享状态：
+        # "reservations": { id: {"id", "host", "uuid", "vcpu", "mem_kb", "base", "expires_at"} }
+        # "pending": { uuid: {"host", "vcpu", "mem_kb", "expires_at"} }，已提交但清单尚未反映的规格
+        self._state = state or LocalSharedState()
+
+    @contextmanager
+    def _transaction(self):
+        """在共享状态的事务内产出 (reservations, pending)，并先清理过期条目"""
+        with self._state.transaction() as state:
+            reservations = state.setdefault("reservations", {})
+            pending = state.setdefault("pending", {})
+            self._expire(reservations, pending, time.time())
+            yield reservations, pending
+
+    def _physical(self, host_ip):
+        with self._lock:
+            info = self._hosts.get(host_ip)
+        if info and time.time() - info["refreshed_at"] < self.host_info_ttl:
+            return info
+
+        conn = libvirt_pool.get_connection(host_ip)
+        node = conn.getInfo()  # [model, memory(MiB), cpus, mhz, nodes, sockets, cores, threads]
+        _, _, online = conn.getCPUMap()
+        info = {
+            "cpus": node[2],
+            "online_cpus": online,
+            "mem_kb": node[1] * 1024,
+            "refreshed_at": time.time(),
+        }
+        with self._lock:
+            self._hosts[host_ip] = info
+        return info
+
+    @staticmethod
+    def _expire(reservations, pending, now):
+        for res_id in [r for r, res in reservations.items() if res["expires_at"] <= now]:
+            logger.warning(f"Capacity reservation {res_id} expired without commit/release")
+            del reservations[res_id]
+        for uuid in [u for u, p in pending.items() if p["expires_at"] <= now]:
+            del pending[uuid]
+
+    @staticmethod
+    def _allocated(pending_specs, host_ip, vms):
+        """
+        统计已分配的 vCPU / 内存（在事务内调用）。清单已反映的已提交规格在这里清除。
+        """
+        vcpu = mem_kb = 0
+        seen = set()
+        for vm in vms:
+            if vm["state"] != "running":
+                continue
+            seen.add(vm["uuid"])
+            pending = pending_specs.get(vm["uuid"])
+            if pending is not None and pending["host"] == host_ip:
+                if pending["vcpu"] == vm["curr_vcpu"] and pending["mem_kb"] == vm["curr_mem_kb"]:
+                    del pending_specs[vm["uuid"]]
+                else:
+                    vcpu += pending["vcpu"]
+                    mem_kb += pending["mem_kb"]
+                    continue
+            vcpu += vm["curr_vcpu"]
+            mem_kb += vm["curr_mem_kb"]
+        # 已提交但清单里还没有的 VM（如刚启动）
+        for uuid, pending in pending_specs.items():
+            if pending["host"] == host_ip and uuid not in seen:
+                vcpu += pending["vcpu"]
+                mem_kb += pending["mem_kb"]
+        return vcpu, mem_kb
+
+    def _summary(self, reservations, pending, host_ip, physical, vms):
+        """
+        计算宿主机容量汇总（在事务内调用）
+        """
+        allocated_vcpu, allocated_mem_kb = self._allocated(pending, host_ip, vms)
+        reserved = [res for res in reservations.values() if res["host"] == host_ip]
+        reserved_vcpu = sum(max(res["vcpu"], 0) for res in reserved)
+        reserved_mem_kb = sum(max(res["mem_kb"], 0) for res in reserved)
+        total_vcpu = int(physical["online_cpus"] * self.cpu_overcommit)
+        total_mem_kb = int((physical["mem_kb"] - self.host_reserved_mem_kb) * self.mem_overcommit)
+        return {
+            "host": host_ip,
+            "physical_cpus": physical["online_cpus"],
+            "physical_mem_kb": physical["mem_kb"],
+            "total_vcpu": total_vcpu,
+            "total_mem_kb": total_mem_kb,
+            "allocated_vcpu": allocated_vcpu,
+            "allocated_mem_kb": allocated_mem_kb,
+            "reserved_vcpu": reserved_vcpu,
+            "reserved_mem_kb": reserved_mem_kb,
+            "free_vcpu": total_vcpu - allocated_vcpu - reserved_vcpu,
+            "free_mem_kb": total_mem_kb - allocated_mem_kb - reserved_mem_kb,
+        }
+
+    def snapshot(self, host_ip):
+        """
+        返回宿主机当前的容量汇总
+        """
+        physical = self._physical(host_ip)
+        vms = inventory.get_host_vms(host_ip)
+        with self._transaction() as (reservations, pending):
+            return self._summary(reservations, pending, host_ip, physical, vms)
+
+    def reserve(self, host_ip, vcpu=0, mem_kb=0, uuid=None):
+        """
+        原子地检查并预留容量，成功返回预留记录（含 id），容量不足返回 None。
+        vcpu / mem_kb 为增量，可为负数（缩容不需要检查容量）。
+        """
+        physical = self._physical(host_ip)
+        vms = inventory.get_host_vms(host_ip)
+        now = time.time()
+        with self._transaction() as (reservations, pending_specs):
+            summary = self._summary(reservations, pending_specs, host_ip, physical, vms)
+            if (vcpu > 0 and summary["free_vcpu"] < vcpu) or (mem_kb > 0 and summary["free_mem_kb"] < mem_kb):
+                return None
+
+            base = None
+            if uuid is not None:
+                pending = pending_specs.get(uuid)
+                vm = next((vm for vm in vms if vm["uuid"] == uuid), None)
+                if pending is not None:
+                    base = [pending["vcpu"], pending["mem_kb"]]
+                elif vm is not None:
+                    base = [vm["curr_vcpu"], vm["curr_mem_kb"]] if vm["state"] == "running" else [0, 0]
+            reservation = {
+                "id": uuid_lib.uuid4().hex,
+                "host": host_ip,
+                "uuid": uuid,
+                "vcpu": vcpu,
+                "mem_kb": mem_kb,
+                "base": base,
+                "expires_at": now + self.reservation_ttl,
+            }
+            reservations[reservation["id"]] = reservation
+            return dict(reservation)
+
+    def renew(self, reservation_id):
+        """
+        延长未完成预留的有效期（再给一个 reservation_ttl），用于耗时较长的操作（如在线迁移）。
+        预留已过期或不存在时返回 False
+        """
+        with self._transaction() as (reservations, _):
+            reservation = reservations.get(reservation_id)
+            if reservation is None:
+                return False
+            reservation["expires_at"] = time.time() + self.reservation_ttl
+            return True
+
+    def commit(self, reservation_id, vcpu=None, mem_kb=None):
+        """
+        操作成功后提交预留。实际生效的增量与预留不同时（如内存按气球粒度取整），通过 vcpu / mem_kb 传入。
+        """
+        with self._transaction() as (reservations, pending):
+            reservation = reservations.pop(reservation_id, None)
+            if reservation is None:
+                return False
+            vcpu = reservation["vcpu"] if vcpu is None else vcpu
+            mem_kb = reservation["mem_kb"] if mem_kb is None else mem_kb
+            if reservation["base"] is None:
+                # 未关联到清单中的 VM，只能在有效期内继续占用
+                reservations[reservation_id] = dict(reservation, vcpu=vcpu, mem_kb=mem_kb)
+                return True
+            base_vcpu, base_mem_kb = reservation["base"]
+            pending[reservation["uuid"]] = {
+                "host": reservation["host"],
+                "vcpu": base_vcpu + vcpu,
+                "mem_kb": base_mem_kb + mem_kb,
+                "expires_at": time.time() + self.reservation_ttl,
+            }
+            return True
+
+    def release(self, reservation_id):
+        """
+        操作失败或放弃时释放预留
+        """
+        with self._transaction() as (reservations, _):
+            return reservations.pop(reservation_id, None) is not None
+
+    def record_change(self, host_ip, uuid, vcpu=0, mem_kb=0):
+        """
+        记录一次已完成的规格变更（如压缩其他 VM 释放出的资源），让账本立即可见
+        """
+        reservation = self.reserve(host_ip, vcpu=min(vcpu, 0), mem_kb=min(mem_kb, 0), uuid=uuid)
+        self.commit(reservation["id"], vcpu=vcpu, mem_kb=mem_kb)
+
+
+LEDGER = CapacityLedger(
+    cpu_overcommit=CAPACITY_CONFIG.get('cpu_overcommit', 4.0),
+    mem_overcommit=CAPACITY_CONFIG.get('mem_overcommit', 1.0),
+    host_reserved_mem_kb=CAPACITY_CONFIG.get('host_reserved_mem_mb', 2048) * 1024,
+    reservation_ttl=CAPACITY_CONFIG.get('reservation_ttl', 120),
+    host_info_ttl=CAPACITY_CONFIG.get('host_info_ttl', 600),
+    state=build_shared_state("capacity_ledger"),
+)
@@ -0,0 +1,202 @@
+# services/change_feed.py
+
+import json
+import logging
+import os
+import queue
+import threading
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+STREAM_CONFIG = CONFIG.get('stream', {}) or {}
+POLL_INTERVAL = STREAM_CONFIG.get('poll_interval', 2)  # 没有通知时检查内存状态的周期，单位秒
+QUEUE_SIZE = STREAM_CONFIG.get('queue_size', 256)  # 单个订阅者积压的事件上限，超过则断开让其重连
+KEEPALIVE = STREAM_CONFIG.get('keepalive', 15)  # 空闲时发送心跳注释的间隔，单位秒
+
+
+def diff_items(old, new):
+    """
+    比较两个 {key: record} 快照，返回字段级变更：
+    [{"op": "add", "key", "value"}, {"op": "remove", "key"}, {"op": "update", "key", "fields": {...}}]
+    update 只包含值发生变化的顶层字段，被删除的字段值为 None
+    """
+    changes = []
+    for key, record in new.items():
+        previous = old.get(key)
+        if previous is None:
+            changes.append({"op": "add", "key": key, "value": record})
+            continue
+        if previous == record:
+            continue
+        fields = {field: value for field, value in record.items() if previous.get(field) != value}
+        fields.update({field: None for field in previous if field not in record})
+        changes.append({"op": "update", "key": key, "fields": fields})
+    for key in old:
+        if key not in new:
+            changes.append({"op": "remove", "key": key})
+    return changes
+
+
+def format_event(event, data):
+    """按 SSE 格式编码一条事件；同一事件只编码一次，所有订阅者共享"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+
+
+class Subscription:
+    """
+    单个订阅者（一条 SSE 连接）的事件队列
+    """
+
+    def __init__(self, topics):
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.closed = False
+
+    def events(self):
+        """
+        阻塞地逐条产出已编码的事件，空闲时产出心跳注释；订阅被关闭后结束
+        """
+        while not self.closed:
+            try:
+                message = self.queue.get(timeout=KEEPALIVE)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if message is None:
+                return
+            yield message
+
+
+class ChangeFeed:
+    """
+    把清单与采集结果的变化转成字段级增量，广播给所有订阅者（如 SSE 连接）。
+    - 主题的数据来自注册的数据源，只读内存中的状态，不访问宿主机；打开多少个页面都不增加宿主机负载
+    - 后台线程每 POLL_INTERVAL 秒检查一次，或被 notify() 提前唤醒；数据源版本未变化的主题不做比较
+    - 增量对每个主题只计算和编码一次，所有订阅者共享
+    - 主题首次有数据时广播完整快照，之后只广播变更；新订阅者先收到当前快照
+    """
+
+    def __init__(self):
+        # { 主题前缀: source(arg) -> (version, {key: record})，数据尚未就绪时返回 (None, None) }
+        self._sources = {}
+        # { topic: {"version", "items", "seq"} }
+        self._state = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+
+    def register(self, prefix, source):
+        """
+        注册数据源：主题 "servers" 对应 source(None)，主题 "vms:10.0.0.1" 对应 source("10.0.0.1")
+        """
+        self._sources[prefix] = source
+
+    def _read(self, topic):
+        prefix, _, arg = topic.partition(':')
+        source = self._sources.get(prefix)
+        if source is None:
+            raise ValueError(f"Unknown topic '{topic}'")
+        return source(arg or None)
+
+    def notify(self):
+        """数据可能已变化，提前唤醒后台线程检查"""
+        self._wake.set()
+
+    def subscribe(self, topics):
+        """
+        订阅若干主题，返回 Subscription；已有数据的主题立即放入当前快照
+        :raises ValueError: 主题没有注册数据源时
+        """
+        for topic in topics:
+            if topic.partition(':')[0] not in self._sources:
+                raise ValueError(f"Unknown topic '{topic}'")
+        subscription = Subscription(topics)
+        with self._lock:
+            self._subscribers.add(subscription)
+            for topic in subscription.topics:
+                state = self._state.get(topic)
+                if state is not None and state["items"] is not None:
+                    subscription.queue.put_nowait(self._snapshot_event(topic, state))
+        self.notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @staticmethod
+    def _snapshot_event(topic, state):
+        return format_event("snapshot", {"topic": topic, "seq": state["seq"], "items": state["items"]})
+
+    def _publish(self, topic, message):
+        """在持有 _lock 时调用：把事件放入订阅该主题的各队列，积压过多的订阅者直接断开"""
+        for subscription in list(self._subscribers):
+            if topic not in subscription.topics:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                logger.info(f"Dropping slow stream subscriber on {topic}")
+                subscription.closed = True
+                self._subscribers.discard(subscription)
+
+    def poll(self):
+        """
+        检查所有被订阅的主题，有变化时广播快照或增量；没有订阅者的主题不再跟踪
+        """
+        with self._lock:
+            topics = set().union(*(s.topics for s in self._subscribers)) if self._subscribers else set()
+            for topic in [t for t in self._state if t not in topics]:
+                del self._state[topic]
+
+        for topic in topics:
+            try:
+                version, items = self._read(topic)
+            except Exception as e:
+                logger.warning(f"Failed to read stream topic {topic}: {e}")
+                continue
+            with self._lock:
+                state = self._state.setdefault(topic, {"version": None, "items": None, "seq": 0})
+                if items is None or (version is not None and version == state["version"]):
+                    continue
+                if state["items"] is None:
+                    state.update(version=version, items=items, seq=state["seq"] + 1)
+                    self._publish(topic, self._snapshot_event(topic, state))
+                    continue
+                changes = diff_items(state["items"], items)
+                state["version"] = version
+                if not changes:
+                    continue
+                state["items"] = items
+                state["seq"] += 1
+                self._publish(topic, format_event("patch", {"topic": topic, "seq": state["seq"],
+                                                            "changes": changes}))
+
+    def _run(self):
+        while True:
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            if not self._subscribers:
+                continue
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning(f"Change feed poll failed: {e}")
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="change-feed", daemon=True).start()
+
+
+FEED = ChangeFeed()
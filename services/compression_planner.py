@@ -0,0 +1,192 @@
+# services/compression_planner.py
+
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services import inventory, scaler, usage_sampler, vm_policy
+from services.capacity_ledger import LEDGER
+
+logger = logging.getLogger(__name__)
+
+# 并行执行压缩时的最大并发数
+MAX_PARALLEL = 8
+
+
+def _policy(vm):
+    # 清单记录中带有由域元数据解析出的策略
+    return vm.get("policy") or vm_policy.DEFAULT_POLICY
+
+
+def _has_cpu_samples(vm):
+    """
+    是否已有 CPU 利用率样本；没有样本时 cpu_usage_percent 为 0.0，不能当作空闲
+    """
+    usage = vm.get("cpu_usage") or {}
+    return usage.get(usage_sampler.window_label(usage_sampler.WINDOWS[0])) is not None
+
+
+def _has_mem_samples(vm):
+    """
+    是否有气球内存统计；客户机没有上报 available 时 mem_usage_percent 为 0.0，不能当作空闲
+    """
+    return vm["mem_usage_percent"] > 0
+
+
+def _step_up(amount, step):
+    """按步长向上取整"""
+    return int(math.ceil(amount / step) * step) if amount > 0 else 0
+
+
+def _candidate(vm, policy, need_vcpu, need_mem_kb):
+    """
+    计算单台 VM 最多可释放的 vCPU / 内存（按步长取整且不低于下限），不可压缩返回 None。
+    没有利用率数据的资源不参与压缩
+    """
+    offer_vcpu = offer_mem_kb = 0
+    if need_vcpu > 0 and _has_cpu_samples(vm) and vm["cpu_usage_percent"] < policy["cpu_threshold_low"]:
+        step = policy["scale_step_cpu"]
+        offer_vcpu = (max(vm["curr_vcpu"] - policy["min_vcpu"], 0) // step) * step
+    if need_mem_kb > 0 and _has_mem_samples(vm) and vm["mem_usage_percent"] < policy["mem_threshold_low"]:
+        step = policy["scale_step_mem_mb"] * 1024
+        offer_mem_kb = (max(vm["curr_mem_kb"] - policy["min_mem_mb"] * 1024, 0) // step) * step
+    if not offer_vcpu and not offer_mem_kb:
+        return None
+    return {
+        "vm": vm,
+        "policy": policy,
+        "offer_vcpu": offer_vcpu,
+        "offer_mem_kb": offer_mem_kb,
+        # 影响度：压缩对该 VM 的影响，用当前利用率近似
+        "impact": max(vm["cpu_usage_percent"] if offer_vcpu else 0, vm["mem_usage_percent"] if offer_mem_kb else 0),
+    }
+
+
+def _take(candidate, remaining_vcpu, remaining_mem_kb):
+    """从候选 VM 上按步长取刚好够用的资源"""
+    policy = candidate["policy"]
+    take_vcpu = min(_step_up(remaining_vcpu, policy["scale_step_cpu"]), candidate["offer_vcpu"])
+    take_mem_kb = min(_step_up(remaining_mem_kb, policy["scale_step_mem_mb"] * 1024), candidate["offer_mem_kb"])
+    return take_vcpu, take_mem_kb
+
+
+def plan_compression(host_ip, need_vcpu=0, need_mem_kb=0, target_uuid=None, target_priority=None):
+    """
+    一次性规划压缩方案：只读取一次清单（含策略与利用率），不访问宿主机。
+    1. 候选：运行中、可压缩、优先级低于目标、有利用率样本且低于阈值的 VM
+    2. 按 (优先级从低到高, 影响从小到大, 可释放量从大到小) 贪心选取，直到满足需求
+    3. 逆序剪枝：去掉不影响满足需求的 VM，再收紧剩余 VM 的压缩量
+    这是启发式规划，不保证压缩的 VM 数或总影响全局最优。
+    返回方案字典，feasible 为 False 表示压缩所有候选也不够。
+    """
+    started = time.perf_counter()
+    candidates = []
+    for vm in inventory.get_host_vms(host_ip):
+        if vm["state"] != "running" or vm["uuid"] == target_uuid:
+            continue
+        policy = _policy(vm)
+        if policy["policy"] != "compressible":
+            continue
+        if target_priority is not None and policy["priority"] <= target_priority:
+            continue
+        candidate = _candidate(vm, policy, need_vcpu, need_mem_kb)
+        if candidate:
+            candidates.append(candidate)
+    candidates.sort(key=lambda c: (-c["policy"]["priority"], c["impact"],
+                                   -(c["offer_vcpu"] + c["offer_mem_kb"] // (1024 * 1024))))
+
+    # 贪心选取
+    selected = []
+    remaining_vcpu, remaining_mem_kb = need_vcpu, need_mem_kb
+    for candidate in candidates:
+        if remaining_vcpu <= 0 and remaining_mem_kb <= 0:
+            break
+        take_vcpu, take_mem_kb = _take(candidate, remaining_vcpu, remaining_mem_kb)
+        if not take_vcpu and not take_mem_kb:
+            continue
+        selected.append([candidate, take_vcpu, take_mem_kb])
+        remaining_vcpu -= take_vcpu
+        remaining_mem_kb -= take_mem_kb
+    feasible = remaining_vcpu <= 0 and remaining_mem_kb <= 0
+
+    # 剪枝：从优先级最高 / 影响最大的一端开始，去掉多余的 VM，再把剩余 VM 的压缩量收紧到刚好够用
+    if feasible:
+        for entry in list(reversed(selected)):
+            if -remaining_vcpu >= entry[1] and -remaining_mem_kb >= entry[2]:
+                selected.remove(entry)
+                remaining_vcpu += entry[1]
+                remaining_mem_kb += entry[2]
+        for entry in reversed(selected):
+            candidate, take_vcpu, take_mem_kb = entry
+            trimmed_vcpu, trimmed_mem_kb = _take(candidate, take_vcpu + remaining_vcpu, take_mem_kb + remaining_mem_kb)
+            remaining_vcpu += take_vcpu - trimmed_vcpu
+            remaining_mem_kb += take_mem_kb - trimmed_mem_kb
+            entry[1], entry[2] = trimmed_vcpu, trimmed_mem_kb
+
+    actions = []
+    for candidate, take_vcpu, take_mem_kb in selected:
+        if not take_vcpu and not take_mem_kb:
+            continue
+        vm = candidate["vm"]
+        actions.append({
+            "uuid": vm["uuid"],
+            "name": vm["name"],
+            "priority": candidate["policy"]["priority"],
+            "impact": candidate["impact"],
+            "from_vcpu": vm["curr_vcpu"],
+            "to_vcpu": vm["curr_vcpu"] - take_vcpu,
+            "from_mem_kb": vm["curr_mem_kb"],
+            "to_mem_kb": vm["curr_mem_kb"] - take_mem_kb,
+        })
+    return {
+        "host": host_ip,
+        "target": target_uuid,
+        "need_vcpu": need_vcpu,
+        "need_mem_kb": need_mem_kb,
+        "feasible": feasible,
+        "freed_vcpu": need_vcpu - remaining_vcpu,
+        "freed_mem_kb": need_mem_kb - remaining_mem_kb,
+        "candidates": len(candidates),
+        "actions": actions,
+        "planning_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
+
+
+def plan_for_vm(host_ip, target_uuid, need_vcpu=0, need_mem_kb=0):
+    """
+    为宿主机上的某台目标 VM 规划压缩：目标的优先级取自清单中的策略
+    """
+    target = inventory.get_vm(host_ip, target_uuid)
+    if target is None:
+        raise ValueError(f"VM {target_uuid} not found on host {host_ip}")
+    return plan_compression(host_ip, need_vcpu=need_vcpu, need_mem_kb=need_mem_kb,
+                            target_uuid=target_uuid, target_priority=_policy(target)["priority"])
+
+
+def _execute_action(host_ip, action):
+    """执行单台 VM 的压缩，成功的部分立即记入容量账本"""
+    results = []
+    if action["to_vcpu"] < action["from_vcpu"]:
+        result = scaler.adjust_vcpu(host_ip, action["uuid"], action["to_vcpu"])
+        if result["success"]:
+            LEDGER.record_change(host_ip, action["uuid"], vcpu=action["to_vcpu"] - action["from_vcpu"])
+        results.append(result)
+    if action["to_mem_kb"] < action["from_mem_kb"]:
+        result = scaler.adjust_memory(host_ip, action["uuid"], action["to_mem_kb"])
+        if result["success"]:
+            LEDGER.record_change(host_ip, action["uuid"], mem_kb=result["applied"] - action["from_mem_kb"])
+        results.append(result)
+    return {"uuid": action["uuid"], "name": action["name"],
+            "success": all(r["success"] for r in results), "results": results}
+
+
+def execute_plan(plan):
+    """
+    并行执行压缩方案（各 VM 相互独立），返回每台 VM 的执行结果
+    """
+    if not plan["actions"]:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(plan["actions"]), MAX_PARALLEL),
+                            thread_name_prefix="compression") as executor:
+        return list(executor.map(lambda action: _execute_action(plan["host"], action), plan["actions"]))
@@ -0,0 +1,124 @@
+# services/domain_desc.py
+
+import threading
+from xml.etree import ElementTree as ET
+
+GUEST_AGENT_CHANNEL = 'org.qemu.guest_agent.0'
+
+# { uuid: (signature, desc) }，按 UUID 缓存解析后的域描述
+_DESC_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def parse_domain_xml(xml_desc):
+    """
+    解析域 XML，一次性提取所需字段，返回精简的描述记录：
+    {
+        'uuid', 'name',
+        'max_mem_kb', 'curr_mem_kb',
+        'max_vcpu', 'curr_vcpu',
+        'has_qemu_ga': bool,
+        'interfaces': [{'mac', 'type', 'source', 'target'}],
+        'macs': [mac, ...],
+        'metadata': { namespace_uri: xml_string }
+    }
+    :raises ET.ParseError: XML 无法解析时
+    """
+    root = ET.fromstring(xml_desc)
+
+    mem_elem = root.find("memory")
+    curr_mem_elem = root.find("currentMemory")
+    max_mem_kb = int(mem_elem.text) if mem_elem is not None else 0
+    curr_mem_kb = int(curr_mem_elem.text) if curr_mem_elem is not None else max_mem_kb
+
+    vcpu_elem = root.find("vcpu")
+    max_vcpu = int(vcpu_elem.text) if vcpu_elem is not None else 0
+    curr_vcpu = int(vcpu_elem.get('current', max_vcpu)) if vcpu_elem is not None else 0
+
+    has_qemu_ga = False
+    for channel in root.findall("./devices/channel"):
+        target = channel.find("target")
+        if target is not None and target.get('name') == GUEST_AGENT_CHANNEL:
+            has_qemu_ga = True
+            break
+
+    interfaces = []
+    for iface in root.findall("./devices/interface"):
+        mac_elem = iface.find("mac")
+        source_elem = iface.find("source")
+        target_elem = iface.find("target")
+        source = ""
+        if source_elem is not None:
+            # bridge / network / dev 三种来源取其一
+            source = (source_elem.get('bridge') or source_elem.get('network')
+                      or source_elem.get('dev') or "")
+        interfaces.append({
+            'mac': mac_elem.get('address', '').lower() if mac_elem is not None else "",
+            'type': iface.get('type', ''),
+            'source': source,
+            'target': target_elem.get('dev', '') if target_elem is not None else "",
+        })
+
+    metadata = {}
+    metadata_elem = root.find("metadata")
+    if metadata_elem is not None:
+        for child in metadata_elem:
+            # 带命名空间的标签形如 {uri}name
+            if child.tag.startswith('{'):
+                ns_uri = child.tag[1:].split('}', 1)[0]
+                metadata[ns_uri] = ET.tostring(child, encoding='unicode')
+
+    return {
+        'uuid': root.findtext("uuid", ""),
+        'name': root.findtext("name", ""),
+        'max_mem_kb': max_mem_kb,
+        'curr_mem_kb': curr_mem_kb,
+        'max_vcpu': max_vcpu,
+        'curr_vcpu': curr_vcpu,
+        'has_qemu_ga': has_qemu_ga,
+        'interfaces': interfaces,
+        'macs': [i['mac'] for i in interfaces if i['mac']],
+        'metadata': metadata,
+    }
+
+
+def desc_signature(stats):
+    """
+    由 getAllDomainStats 的结果计算定义签名。
+    最大 vCPU、最大内存、网卡/磁盘数量变化时说明域定义已变更，需要重新拉取 XML。
+    元数据、MAC 等变更不反映在统计中，依靠域事件失效缓存，并由全量对账重新读取兜底。
+    """
+    return (
+        stats.get("vcpu.maximum"),
+        stats.get("balloon.maximum"),
+        stats.get("net.count"),
+        stats.get("block.count"),
+    )
+
+
+def get_domain_desc(domain, signature=None):
+    """
+    获取域描述，按 UUID 缓存。
+    - 未缓存，或给定的 signature 与缓存时不一致时，才重新执行 XMLDesc 并解析
+    - signature 为 None 时直接使用缓存（由 invalidate_domain_desc 负责失效）
+    """
+    uuid = domain.UUIDString()
+    with _CACHE_LOCK:
+        cached = _DESC_CACHE.get(uuid)
+    if cached is not None and (signature is None or cached[0] == signature):
+        return cached[1]
+
+    desc = parse_domain_xml(domain.XMLDesc(0))
+    with _CACHE_LOCK:
+        # 未带签名的首次加载记为 None，后续带签名的调用会顺带刷新一次
+        _DESC_CACHE[uuid] = (signature, desc)
+    return desc
+
+
+def invalidate_domain_desc(uuid):
+    """
+    域定义变更（重新定义、热插拔设备、修改元数据、删除）时使缓存失效
+    """
+    with _CACHE_LOCK:
+        _DESC_CACHE.pop(uuid, None)
+
@@ -0,0 +1,404 @@
+# services/forecaster.py
+
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import yaml
+
+from services import inventory, scale_cooldown, scaler, usage_sampler
+from services.capacity_ledger import LEDGER
+from utils.leader import LEADER
+from utils.queue_manager import JOB_QUEUE
+from utils.shared_snapshot import build_snapshot
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+FORECAST_CONFIG = CONFIG.get('forecast', {}) or {}
+ENABLED = FORECAST_CONFIG.get('enabled', True)
+INTERVAL = FORECAST_CONFIG.get('interval', usage_sampler.HISTORY_BUCKET)  # 预测周期，单位秒
+HORIZON = FORECAST_CONFIG.get('horizon', 1800)  # 提前量：预测未来多少秒内的峰值
+ALPHA = FORECAST_CONFIG.get('alpha', 0.3)  # 水平平滑系数
+BETA = FORECAST_CONFIG.get('beta', 0.05)  # 趋势平滑系数
+GAMMA = FORECAST_CONFIG.get('gamma', 0.2)  # 季节平滑系数
+SEASON = FORECAST_CONFIG.get('season', 86400)  # 季节周期（日周期），单位秒
+TARGET_PERCENT = FORECAST_CONFIG.get('target_percent', 70)  # 扩容后期望的峰值利用率
+
+BUCKET = usage_sampler.HISTORY_BUCKET
+SEASON_BUCKETS = max(SEASON // BUCKET, 1)
+HORIZON_BUCKETS = max(HORIZON // BUCKET, 1)
+
+# 预测扩容的任务优先级低于告警触发的扩容
+PREDICTIVE_PRIORITY = 6
+
+_LAST_PEAKS = {}  # { uuid: {"cpu", "mem"} }，最近一轮预测的峰值
+_LAST_PEAKS_AT = {}  # { uuid: 预测时间 }
+_PEAKS_LOCK = threading.Lock()
+# 历史只在领导者上采集，领导者每轮预测后发布峰值，其他 worker 从共享快照读取
+SHARED_PEAKS = build_snapshot("forecast_peaks")
+_started = False
+_start_lock = threading.Lock()
+
+
+def build_matrix(histories, end_bucket, length):
+    """
+    把各 VM 的环形历史对齐成矩阵：返回 (uuids, cpu, mem)，形状为 (V, length)，
+    列对应桶 end_bucket-length+1 .. end_bucket，缺失的桶为 NaN
+    """
+    uuids = list(histories)
+    wanted = np.arange(end_bucket - length + 1, end_bucket + 1, dtype=np.int64)
+    cpu = np.full((len(uuids), length), np.nan, dtype=np.float32)
+    mem = np.full((len(uuids), length), np.nan, dtype=np.float32)
+    for row, uuid in enumerate(uuids):
+        buckets, cpu_values, mem_values = histories[uuid]
+        buckets = np.frombuffer(buckets, dtype=np.int64)
+        slots = wanted % len(buckets)
+        valid = buckets[slots] == wanted
+        cpu[row, valid] = np.frombuffer(cpu_values, dtype=np.float32)[slots[valid]]
+        mem[row, valid] = np.frombuffer(mem_values, dtype=np.float32)[slots[valid]]
+    return uuids, cpu, mem
+
+
+class HoltWinters:
+    """
+    对 V 条序列同时做加法 Holt-Winters 平滑（numpy 向量化，每个时间步一次数组运算）。
+    历史不足两个完整季节时退化为带趋势的指数平滑（不估计季节项）。
+    缺失值用一步预测值代替，不会打断平滑。
+    """
+
+    def __init__(self, season=SEASON_BUCKETS, alpha=ALPHA, beta=BETA, gamma=GAMMA):
+        self.season = season
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+
+    def _init_state(self, y):
+        v, t = y.shape
+        seasonal = t >= 2 * self.season
+        span = 2 * self.season if seasonal else min(t, self.season)
+        with np.errstate(all='ignore'):
+            head = y[:, :span]
+            level = np.nan_to_num(np.nanmean(head, axis=1))
+            trend = np.zeros(v)
+            season = np.zeros((v, self.season))
+            if seasonal:
+                first = np.nanmean(y[:, :self.season], axis=1)
+                second = np.nanmean(y[:, self.season:span], axis=1)
+                trend = np.nan_to_num((second - first) / self.season)
+                season = np.nan_to_num(np.nanmean(head.reshape(v, 2, self.season), axis=1) - level[:, None])
+        return level, trend, season, seasonal
+
+    def _forecast(self, level, trend, season, phases):
+        steps = np.arange(1, len(phases) + 1)
+        return level[:, None] + trend[:, None] * steps + season[:, phases]
+
+    def run(self, y, first_bucket, horizon=0, threshold=None):
+        """
+        平滑整段序列。季节相位按绝对桶序号计算，保证与一天中的时刻对齐。
+        给定 threshold 时，额外返回每个时间步“未来 horizon 个桶内预测峰值 >= threshold”的布尔矩阵（回测用）。
+        返回 (level, trend, season, flags)
+        """
+        y = y.astype(np.float64)
+        level, trend, season, seasonal = self._init_state(y)
+        gamma = self.gamma if seasonal else 0.0
+        v, t = y.shape
+        flags = np.zeros((v, t), dtype=bool) if threshold is not None else None
+        for i in range(t):
+            phase = (first_bucket + i) % self.season
+            s = season[:, phase]
+            predicted = level + trend + s
+            observed = y[:, i]
+            observed = np.where(np.isnan(observed), predicted, observed)
+            new_level = self.alpha * (observed - s) + (1 - self.alpha) * (level + trend)
+            trend = self.beta * (new_level - level) + (1 - self.beta) * trend
+            season[:, phase] = gamma * (observed - new_level) + (1 - gamma) * s
+            level = new_level
+            if flags is not None:
+                phases = (first_bucket + i + 1 + np.arange(horizon)) % self.season
+                flags[:, i] = self._forecast(level, trend, season, phases).max(axis=1) >= threshold
+        return level, trend, season, flags
+
+    def forecast(self, y, first_bucket, horizon):
+        """
+        返回未来 horizon 个桶的预测值，形状 (V, horizon)，裁剪到 0~100
+        """
+        level, trend, season, _ = self.run(y, first_bucket)
+        phases = (first_bucket + y.shape[1] + np.arange(horizon)) % self.season
+        return np.clip(self._forecast(level, trend, season, phases), 0, 100)
+
+
+def recorded_matrix(uuids=None):
+    """
+    导出采样器记录的历史并对齐成矩阵，去掉所有 VM 都没有数据的前导桶。
+    返回 (uuids, cpu, mem, first_bucket)，没有历史时返回 None
+    """
+    histories = usage_sampler.export_history(uuids)
+    if not histories:
+        return None
+    end_bucket = usage_sampler.current_bucket() - 1
+    length = usage_sampler.HISTORY_CAPACITY
+    uuids, cpu, mem = build_matrix(histories, end_bucket, length)
+    has_data = ~np.isnan(cpu).all(axis=0)
+    if not has_data.any():
+        return None
+    start = int(np.argmax(has_data))
+    return uuids, cpu[:, start:], mem[:, start:], end_bucket - length + 1 + start
+
+
+def forecast_peaks(uuids=None, horizon=HORIZON_BUCKETS):
+    """
+    对所有（或指定）VM 一次性预测未来 horizon 个桶内的 CPU / 内存利用率峰值。
+    返回 {uuid: {"cpu": peak, "mem": peak}}，没有历史的 VM 不包含在内。
+    """
+    recorded = recorded_matrix(uuids)
+    if recorded is None:
+        return {}
+    uuids, cpu, mem, first_bucket = recorded
+    model = HoltWinters()
+    cpu_peak = model.forecast(cpu, first_bucket, horizon).max(axis=1)
+    mem_peak = model.forecast(mem, first_bucket, horizon).max(axis=1)
+    peaks = {uuid: {"cpu": round(float(cpu_peak[i]), 2), "mem": round(float(mem_peak[i]), 2)}
+             for i, uuid in enumerate(uuids)}
+    with _PEAKS_LOCK:
+        _LAST_PEAKS.update(peaks)
+        _LAST_PEAKS_AT.update({uuid: time.time() for uuid in peaks})
+    return peaks
+
+
+def cached_peak(uuid):
+    """
+    读取最近一轮预测的峰值（不超过两个预测周期），过期或没有时现算一次。
+    其他 worker 没有历史，读取领导者发布的峰值
+    """
+    with _PEAKS_LOCK:
+        if time.time() - _LAST_PEAKS_AT.get(uuid, 0) < 2 * INTERVAL:
+            return _LAST_PEAKS[uuid]
+    if not LEADER.is_leader():
+        entry = (SHARED_PEAKS.read() or {}).get(uuid)
+        if entry is not None and time.time() - entry["at"] < 2 * INTERVAL:
+            return entry["peak"]
+        return None
+    return forecast_peaks([uuid]).get(uuid)
+
+
+def _publish_peaks():
+    """领导者发布最近一轮预测的峰值"""
+    with _PEAKS_LOCK:
+        data = {uuid: {"peak": peak, "at": _LAST_PEAKS_AT[uuid]} for uuid, peak in _LAST_PEAKS.items()}
+    SHARED_PEAKS.publish(data)
+
+
+def _step_up(value, step):
+    return int(math.ceil(value / step) * step)
+
+
+def size_vcpu(vm, peak_percent):
+    """
+    按预测峰值计算 vCPU 数：使峰值利用率回落到 TARGET_PERCENT，按步长取整，不超过策略与热插拔上限
+    """
+    policy = vm.get("policy") or {}
+    wanted = _step_up(vm["curr_vcpu"] * peak_percent / TARGET_PERCENT, policy.get("scale_step_cpu", 1))
+    return min(max(wanted, vm["curr_vcpu"]), policy.get("max_vcpu", vm["max_vcpu"]), vm["max_vcpu"])
+
+
+def size_memory_kb(vm, peak_percent):
+    """
+    按预测峰值计算内存（KiB），按步长取整，不超过策略上限与最大内存
+    """
+    policy = vm.get("policy") or {}
+    step_kb = policy.get("scale_step_mem_mb", 1024) * 1024
+    wanted = _step_up(vm["curr_mem_kb"] * peak_percent / TARGET_PERCENT, step_kb)
+    max_kb = policy.get("max_mem_mb", vm["max_mem_kb"] // 1024) * 1024
+    return min(max(wanted, vm["curr_mem_kb"]), max_kb, vm["max_mem_kb"])
+
+
+def recommend(vm, alert_type):
+    """
+    告警触发扩容时按预测峰值给出目标规格（vCPU 数或内存 GB），没有预测数据时返回 None
+    """
+    peak = cached_peak(vm["uuid"])
+    if peak is None:
+        return None
+    if alert_type == "cpu":
+        return size_vcpu(vm, max(peak["cpu"], vm["cpu_usage_percent"]))
+    return math.ceil(size_memory_kb(vm, max(peak["mem"], vm["mem_usage_percent"])) / 1024 / 1024)
+
+
+def plan_predictive_scaling(vms, peaks):
+    """
+    找出预测峰值超过策略上阈值的 VM，按预测值计算目标规格。
+    vms 为带 host 字段的清单记录列表，返回 [{"host", "uuid", "name", "vcpu", "mem_kb", "peak_cpu", "peak_mem"}]
+    """
+    actions = []
+    for vm in vms:
+        peak = peaks.get(vm["uuid"])
+        if peak is None or vm["state"] != "running":
+            continue
+        policy = vm.get("policy") or {}
+        vcpu = vm["curr_vcpu"]
+        mem_kb = vm["curr_mem_kb"]
+        if peak["cpu"] >= policy.get("cpu_threshold_high", 80):
+            vcpu = size_vcpu(vm, peak["cpu"])
+        if peak["mem"] >= policy.get("mem_threshold_high", 85):
+            mem_kb = size_memory_kb(vm, peak["mem"])
+        if vcpu == vm["curr_vcpu"] and mem_kb == vm["curr_mem_kb"]:
+            continue
+        actions.append({
+            "host": vm["host"],
+            "uuid": vm["uuid"],
+            "name": vm["name"],
+            "vcpu": vcpu,
+            "mem_kb": mem_kb,
+            "peak_cpu": peak["cpu"],
+            "peak_mem": peak["mem"],
+        })
+    return actions
+
+
+def _resize_reserved(host_ip, uuid, resource, current, target):
+    """在容量账本中预留增量后执行扩容，成功提交、失败释放"""
+    delta = target - current
+    reservation = LEDGER.reserve(host_ip, uuid=uuid, **({"vcpu": delta} if resource == "vcpu" else {"mem_kb": delta}))
+    if reservation is None:
+        return {"success": False, "resource": resource, "error_class": "capacity",
+                "error": f"host {host_ip} has no capacity for +{delta} {resource}"}
+    try:
+        if resource == "vcpu":
+            result = scaler.adjust_vcpu(host_ip, uuid, target)
+        else:
+            result = scaler.adjust_memory(host_ip, uuid, target)
+    except Exception:
+        LEDGER.release(reservation["id"])
+        raise
+    if result["success"]:
+        LEDGER.commit(reservation["id"], **({"vcpu": result["applied"] - current} if resource == "vcpu"
+                                            else {"mem_kb": result["applied"] - current}))
+    else:
+        LEDGER.release(reservation["id"])
+    return result
+
+
+def _run_predictive_job(payload):
+    """
+    预测扩容任务：与告警扩容共用冷却期，执行前按最新清单复核，避免在刚被扩容过的 VM 上重复操作
+    """
+    uuid = payload["uuid"]
+    vm = inventory.get_vm(payload["host"], uuid)
+    if vm is None:
+        return {"status": "skipped", "message": f"VM {uuid} is no longer on {payload['host']}"}
+    if not scale_cooldown.claim(uuid):
+        return {"status": "skipped", "message": f"{payload['name']} is cooling down"}
+
+    results = []
+    try:
+        if payload["vcpu"] > vm["curr_vcpu"]:
+            results.append(_resize_reserved(payload["host"], uuid, "vcpu", vm["curr_vcpu"], payload["vcpu"]))
+        if payload["mem_kb"] > vm["curr_mem_kb"]:
+            results.append(_resize_reserved(payload["host"], uuid, "memory", vm["curr_mem_kb"], payload["mem_kb"]))
+    finally:
+        if not any(r["success"] for r in results):
+            scale_cooldown.release(uuid)
+    return {"status": "success" if results and all(r["success"] for r in results) else "failed",
+            "results": results}
+
+
+JOB_QUEUE.register_handler("predictive_scale", _run_predictive_job)
+
+
+def run_once():
+    """
+    一轮预测：全集群一次性预测，把需要提前扩容的 VM 放入任务队列，返回提交的任务
+    """
+    vms = inventory.get_cluster_vms()["vms"]
+    peaks = forecast_peaks([vm["uuid"] for vm in vms])
+    _publish_peaks()
+    jobs = []
+    for action in plan_predictive_scaling(vms, peaks):
+        if scale_cooldown.is_cooling(action["uuid"]):
+            continue
+        logger.info(f"Forecast peak for {action['name']}: cpu {action['peak_cpu']}%, mem {action['peak_mem']}%, "
+                    f"scheduling {action['vcpu']} vCPUs / {action['mem_kb']} KiB")
+        job = JOB_QUEUE.submit("predictive_scale", key=scale_cooldown.job_key(action["uuid"]), payload=action,
+                               priority=PREDICTIVE_PRIORITY)
+        jobs.append(dict(action, job_id=job["id"]))
+    return jobs
+
+
+def _forecast_loop():
+    while True:
+        time.sleep(INTERVAL)
+        # 多 worker 部署时只由当选的采集者执行，避免重复扩容
+        if not LEADER.is_leader():
+            continue
+        try:
+            run_once()
+        except Exception as e:
+            logger.warning(f"Predictive scaling round failed: {e}")
+
+
+def start():
+    """
+    启动周期性预测线程（配置中 forecast.enabled 为 false 时不启动）
+    """
+    global _started
+    with _start_lock:
+        if _started or not ENABLED:
+            return
+        threading.Thread(target=_forecast_loop, name="forecaster", daemon=True).start()
+        _started = True
+
+
+def backtest(cpu, first_bucket, threshold=90, horizon=HORIZON_BUCKETS, model=None):
+    """
+    在记录的历史上回测预测扩容的效果（只回放数据，不执行任何操作）。
+    cpu 为 (V, T) 利用率矩阵。某个桶实际利用率 >= threshold 记为饱和；
+    若此前 horizon 个桶内任一时刻的预测峰值已超过 threshold（即会提前扩容），则记为避免的饱和。
+    返回饱和分钟数、可避免的饱和分钟数、提前扩容次数及其中的误报次数。
+    """
+    model = model or HoltWinters()
+    _, _, _, flags = model.run(cpu, first_bucket, horizon=horizon, threshold=threshold)
+    saturated = np.nan_to_num(cpu, nan=0.0) >= threshold
+
+    # covered[:, t] = flags[:, t-horizon .. t-1] 中是否有 True（前缀和求滑动窗口）
+    prefix = np.concatenate([np.zeros((flags.shape[0], 1), dtype=np.int64), np.cumsum(flags, axis=1)], axis=1)
+    t = np.arange(flags.shape[1])
+    covered = (prefix[:, t] - prefix[:, np.maximum(t - horizon, 0)]) > 0
+
+    # 预测由否转是的时刻视为一次提前扩容；之后 horizon 个桶内没有饱和即为误报
+    events = flags & ~np.concatenate([np.zeros((flags.shape[0], 1), dtype=bool), flags[:, :-1]], axis=1)
+    sat_prefix = np.concatenate([np.zeros((flags.shape[0], 1), dtype=np.int64), np.cumsum(saturated, axis=1)], axis=1)
+    upcoming = sat_prefix[:, np.minimum(t + 1 + horizon, flags.shape[1])] - sat_prefix[:, t + 1]
+    false_alarms = events & (upcoming == 0)
+
+    minutes = BUCKET / 60
+    saturated_minutes = float(saturated.sum() * minutes)
+    avoided_minutes = float((saturated & covered).sum() * minutes)
+    return {
+        "vms": int(cpu.shape[0]),
+        "buckets": int(cpu.shape[1]),
+        "threshold": threshold,
+        "horizon_minutes": horizon * minutes,
+        "saturated_minutes": saturated_minutes,
+        "avoided_minutes": avoided_minutes,
+        "avoided_ratio": round(avoided_minutes / saturated_minutes, 4) if saturated_minutes else None,
+        "scale_events": int(events.sum()),
+        "false_alarms": int(false_alarms.sum()),
+    }
+
+
+def backtest_recorded(threshold=90, horizon=HORIZON_BUCKETS):
+    """
+    对采样器中记录的全部 VM 历史回测 CPU 预测扩容
+    """
+    recorded = recorded_matrix()
+    if recorded is None:
+        return None
+    _, cpu, _, first_bucket = recorded
+    return backtest(cpu, first_bucket, threshold=threshold, horizon=horizon)
@@ -0,0 +1,179 @@
+# services/host_metrics.py
+
+import threading
+
+# 一次远程往返读取全部原始数据，分段标记后在本地解析
+SNAPSHOT_COMMAND = (
+    "echo '@@uptime'; cat /proc/uptime; "
+    "echo '@@stat'; grep '^cpu ' /proc/stat; "
+    "echo '@@meminfo'; cat /proc/meminfo; "
+    "echo '@@loadavg'; cat /proc/loadavg; "
+    "echo '@@diskstats'; cat /proc/diskstats; "
+    "echo '@@blockdevs'; ls /sys/block; "
+    "echo '@@df'; df -P -B1 2>/dev/null; "
+    # df 在任一挂载点不可读（如失效的 NFS）时返回 1，已输出的部分仍然可用，不能让整个快照失败
+    "true"
+)
+
+SECTOR_BYTES = 512
+
+# { host_ip: 上一次快照 }，用于计算差值
+_PREV_SNAPSHOTS = {}
+_LOCK = threading.Lock()
+
+
+def parse_snapshot(output):
+    """
+    解析 SNAPSHOT_COMMAND 的输出，返回纯数值的快照：
+    {
+        'uptime': float,                      # 秒，用作差值计算的时间基准
+        'cpu': [user, nice, system, idle, iowait, irq, softirq, steal],
+        'meminfo': { 'MemTotal': kB, ... },
+        'loadavg': (1m, 5m, 15m),
+        'diskstats': { dev: (sectors_read, sectors_written, io_ticks_ms) },  # 只含整块磁盘
+        'filesystems': [{'source', 'mount_point', 'total_bytes', 'used_bytes', 'avail_bytes'}]
+    }
+    """
+    sections = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith('@@'):
+            current = line[2:].strip()
+            sections[current] = []
+        elif current is not None and line.strip():
+            sections[current].append(line)
+
+    snapshot = {
+        'uptime': 0.0,
+        'cpu': [],
+        'meminfo': {},
+        'loadavg': (0.0, 0.0, 0.0),
+        'diskstats': {},
+        'filesystems': [],
+    }
+
+    if sections.get('uptime'):
+        snapshot['uptime'] = float(sections['uptime'][0].split()[0])
+
+    if sections.get('stat'):
+        snapshot['cpu'] = [int(v) for v in sections['stat'][0].split()[1:9]]
+
+    for line in sections.get('meminfo', []):
+        key, _, value = line.partition(':')
+        parts = value.split()
+        if parts:
+            snapshot['meminfo'][key] = int(parts[0])
+
+    if sections.get('loadavg'):
+        parts = sections['loadavg'][0].split()
+        snapshot['loadavg'] = (float(parts[0]), float(parts[1]), float(parts[2]))
+
+    # /sys/block 只列出整块磁盘，分区（sda1、nvme0n1p1 等）不在其中，避免与所在磁盘重复计数
+    block_devs = set(sections.get('blockdevs', []))
+    for line in sections.get('diskstats', []):
+        parts = line.split()
+        if len(parts) < 14:
+            continue
+        dev = parts[2]
+        if dev not in block_devs:
+            continue
+        # 跳过虚拟块设备
+        if dev.startswith(('loop', 'ram', 'dm-', 'sr')):
+            continue
+        snapshot['diskstats'][dev] = (int(parts[5]), int(parts[9]), int(parts[12]))
+
+    for line in sections.get('df', [])[1:]:  # 第一行为表头
+        parts = line.split()
+        if len(parts) < 6:
+            continue
+        source, mount_point = parts[0], parts[5]
+        # 与原 awk 过滤一致：只要 /dev 设备，排除 /boot、/media 和 swap
+        if not source.startswith('/dev/') or 'swap' in source:
+            continue
+        if mount_point.startswith(('/boot', '/media')):
+            continue
+        snapshot['filesystems'].append({
+            'source': source,
+            'mount_point': mount_point,
+            'total_bytes': int(parts[1]),
+            'used_bytes': int(parts[2]),
+            'avail_bytes': int(parts[3]),
+        })
+
+    return snapshot
+
+
+def _cpu_percentages(prev_cpu, curr_cpu):
+    """
+    由两次 /proc/stat 计数的差值计算 (cpu_percent, iowait_percent)
+    """
+    deltas = [c - p for c, p in zip(curr_cpu, prev_cpu)]
+    total = sum(deltas)
+    if total <= 0:
+        return 0.0, 0.0
+    idle = deltas[3] + deltas[4]
+    return round((total - idle) * 100.0 / total, 2), round(deltas[4] * 100.0 / total, 2)
+
+
+def compute_metrics(host_ip, snapshot):
+    """
+    将快照与该主机上一次快照做差，得到当前的 CPU / IO 利用率，并整理为服务器记录。
+    首次采集没有基准时，CPU 退化为开机以来的平均值，IO 速率记为 0。
+    """
+    with _LOCK:
+        prev = _PREV_SNAPSHOTS.get(host_ip)
+        _PREV_SNAPSHOTS[host_ip] = snapshot
+
+    # 主机重启后 uptime 回退，上一次快照作废
+    if prev is not None and snapshot['uptime'] <= prev['uptime']:
+        prev = None
+
+    if prev is not None:
+        cpu_percent, iowait_percent = _cpu_percentages(prev['cpu'], snapshot['cpu'])
+    else:
+        cpu_percent, iowait_percent = _cpu_percentages([0] * len(snapshot['cpu']), snapshot['cpu'])
+
+    read_bps, write_bps, io_util = 0.0, 0.0, 0.0
+    if prev is not None:
+        elapsed = snapshot['uptime'] - prev['uptime']
+        for dev, (rd, wr, ticks) in snapshot['diskstats'].items():
+            if dev not in prev['diskstats']:
+                continue
+            p_rd, p_wr, p_ticks = prev['diskstats'][dev]
+            read_bps += (rd - p_rd) * SECTOR_BYTES / elapsed
+            write_bps += (wr - p_wr) * SECTOR_BYTES / elapsed
+            # 取最忙的设备作为主机 IO 利用率
+            io_util = max(io_util, (ticks - p_ticks) / (elapsed * 1000) * 100)
+
+    meminfo = snapshot['meminfo']
+    mem_total_mb = meminfo.get('MemTotal', 0) // 1024
+    mem_available_kb = meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+    mem_used_mb = mem_total_mb - mem_available_kb // 1024
+    mem_usage_percent = round(mem_used_mb * 100.0 / mem_total_mb, 2) if mem_total_mb else 0
+
+    disk_info = []
+    for fs in snapshot['filesystems']:
+        capacity = fs['used_bytes'] + fs['avail_bytes']
+        disk_info.append({
+            "mount_point": fs['mount_point'],
+            "total_gb": round(fs['total_bytes'] / 1024 ** 3, 2),
+            "used_gb": round(fs['used_bytes'] / 1024 ** 3, 2),
+            "usage_percent": round(fs['used_bytes'] * 100 / capacity) if capacity else 0
+        })
+
+    return {
+        "ip": host_ip,
+        "cpu_percent": cpu_percent,
+        "iowait_percent": iowait_percent,
+        "load_avg": list(snapshot['loadavg']),
+        "mem_used_mb": mem_used_mb,
+        "mem_total_mb": mem_total_mb,
+        "mem_usage_percent": mem_usage_percent,
+        "disk_info": disk_info,
+        "disk_io": {
+            "read_bytes_per_s": round(read_bps, 1),
+            "write_bytes_per_s": round(write_bps, 1),
+            "util_percent": round(min(io_util, 100.0), 2)
+        },
+        "status": "active"
+    }
@@ -0,0 +1,127 @@
+# services/host_scheduler.py
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class HostCollectionScheduler:
+    """
+    按宿主机独立调度的采集器：每台宿主机一个协程，各自维护采集间隔。
+    - 正常主机按 interval 采集，并加入 jitter 打散
+    - 处于压力下（CPU/内存超过阈值）的主机按 fast_interval 加快采集
+    - 不可达的主机按指数退避，最长 max_backoff，不会拖慢其他主机
+    - 每台主机采集完成后立即通过 on_result 回写，而不是等全部主机完成；
+      on_result 可能阻塞（写 Redis、落盘），在单独的线程中按完成顺序逐个执行，不占用事件循环
+    """
+
+    def __init__(self, collect, on_result, interval=90, fast_interval=30, max_backoff=600,
+                 jitter=0.1, timeout=60, pressure_cpu_percent=80, pressure_mem_percent=85):
+        self.collect = collect  # async collect(host_ip) -> dict，status 为 'offline' 视为失败
+        self.on_result = on_result  # on_result(host_ip, dict)
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.pressure_cpu_percent = pressure_cpu_percent
+        self.pressure_mem_percent = pressure_mem_percent
+        self._loop = None
+        # { host_ip: {"failures", "next_run", "in_flight", "wake": asyncio.Event, "task": asyncio.Task} }
+        # 由事件循环线程增删，status / poke 在请求线程中读取，增删与遍历都在 _lock 内进行
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._result_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="host-results")
+
+    def start(self, loop, hosts):
+        """
+        在给定的事件循环上为每台宿主机启动一个采集协程（可从其他线程调用）
+        """
+        self._loop = loop
+        for host_ip in hosts:
+            loop.call_soon_threadsafe(self._spawn, host_ip)
+
+    def _spawn(self, host_ip):
+        with self._lock:
+            if host_ip in self._hosts:
+                return
+            state = {"failures": 0, "next_run": time.time(), "in_flight": False, "wake": asyncio.Event()}
+            state["task"] = self._loop.create_task(self._run_host(state, host_ip))
+            self._hosts[host_ip] = state
+
+    def _next_delay(self, state, result):
+        if state["failures"]:
+            delay = min(self.interval * 2 ** (state["failures"] - 1), self.max_backoff)
+        elif (result.get("cpu_percent", 0) >= self.pressure_cpu_percent
+              or result.get("mem_usage_percent", 0) >= self.pressure_mem_percent):
+            delay = self.fast_interval
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _run_host(self, state, host_ip):
+        # 启动时打散各主机的首次采集
+        await asyncio.sleep(random.uniform(0, self.jitter * self.interval))
+        while True:
+            state["in_flight"] = True
+            try:
+                result = await asyncio.wait_for(self.collect(host_ip), timeout=self.timeout)
+            except Exception as e:
+                logger.warning(f"Metric collection failed for {host_ip}: {e}")
+                result = {"ip": host_ip, "status": "offline"}
+            finally:
+                state["in_flight"] = False
+
+            if result.get("status") == "offline":
+                state["failures"] += 1
+            else:
+                state["failures"] = 0
+
+            try:
+                await self._loop.run_in_executor(self._result_executor, self.on_result, host_ip, result)
+            except Exception as e:
+                logger.error(f"Failed to publish metrics for {host_ip}: {e}")
+
+            delay = self._next_delay(state, result)
+            state["next_run"] = time.time() + delay
+            try:
+                await asyncio.wait_for(state["wake"].wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            state["wake"].clear()
+
+    def stop(self):
+        """
+        取消全部采集协程（可从其他线程调用），之后可再次 start
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel_all)
+
+    def _cancel_all(self):
+        with self._lock:
+            for state in self._hosts.values():
+                state["task"].cancel()
+            self._hosts.clear()
+
+    def poke(self, host_ip):
+        """
+        请求尽快采集某台宿主机；若该主机正在采集则不重复发起
+        """
+        with self._lock:
+            state = self._hosts.get(host_ip)
+        if state is None or state["in_flight"] or self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(state["wake"].set)
+
+    def status(self):
+        """
+        各宿主机的调度状态：{host_ip: {"failures", "next_run", "in_flight"}}（可从其他线程调用）
+        """
+        with self._lock:
+            return {host_ip: {k: v for k, v in state.items() if k not in ("wake", "task")}
+                    for host_ip, state in self._hosts.items()}
@@ -0,0 +1,480 @@
+# services/inventory.py
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import libvirt
+import yaml
+
+from services import kvm_inspector, libvirt_pool, metric_store, usage_sampler, vm_index, vm_policy
+from services.change_feed import FEED
+from services.domain_desc import get_domain_desc, desc_signature, invalidate_domain_desc
+from services.server_manager import get_server_list
+from utils.leader import LEADER
+from utils.shared_snapshot import build_snapshot
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+INVENTORY_CONFIG = CONFIG.get('inventory', {}) or {}
+RECONCILE_INTERVAL = INVENTORY_CONFIG.get('reconcile_interval', 300)  # 全量对账间隔，单位秒
+FANOUT_CONCURRENCY = INVENTORY_CONFIG.get('fanout_concurrency', 8)  # 集群查询时并发加载的宿主机数
+FANOUT_TIMEOUT = INVENTORY_CONFIG.get('fanout_timeout', 15)  # 集群查询时单台宿主机的等待上限，单位秒
+SHARE_INTERVAL = INVENTORY_CONFIG.get('share_interval', 5)  # 领导者发布 / 其他 worker 同步清单的周期，单位秒
+
+# 需要订阅的域事件
+DOMAIN_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE: "lifecycle",
+    libvirt.VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE: "balloon_change",
+    libvirt.VIR_DOMAIN_EVENT_ID_TUNABLE: "tunable",
+    libvirt.VIR_DOMAIN_EVENT_ID_METADATA_CHANGE: "metadata_change",
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED: "device_added",
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED: "device_removed",
+}
+
+# 定时采样只拉取状态、总 CPU 时间、vCPU 和气球统计，开销远小于全量统计
+SAMPLE_STATS = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_VCPU
+                | libvirt.VIR_DOMAIN_STATS_BALLOON)
+
+# 这些事件意味着域定义（XML）发生了变化
+DEFINITION_EVENTS = {"metadata_change", "device_added", "device_removed"}
+
+# { host_ip: {"vms": {uuid: record}, "updated_at": float, "reconciled_at": float} }
+# 按写时复制更新：记录和宿主机条目（含 vms 字典）都复制后整体替换，读者拿到的字典不会被原地修改
+_INVENTORY = {}
+_LOCK = threading.Lock()
+
+# 事件回调运行在 libvirt 事件循环线程，只负责入队，由工作线程执行 RPC
+_EVENT_QUEUE = queue.Queue()
+
+# 集群查询用的有界线程池，限制同时对宿主机发起的全量加载数
+_FANOUT_EXECUTOR = ThreadPoolExecutor(max_workers=FANOUT_CONCURRENCY, thread_name_prefix="inventory-fanout")
+# { host_ip: Future }，同一宿主机同时只有一个加载任务
+_PENDING_LOADS = {}
+
+# 多 worker 部署时只有当选的采集者连接宿主机（事件、对账、采样），
+# 清单通过共享快照发布，其他 worker 定期同步，不对宿主机产生任何负载
+SHARED_INVENTORY = build_snapshot("inventory")
+_dirty = False  # 领导者的清单自上次发布后是否有变化
+_synced = None  # 其他 worker 最近一次应用的共享快照
+_SYNC_LOCK = threading.Lock()
+# { host_ip: conn }，已注册域事件的连接
+_SUBSCRIBED = {}
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _mark_dirty():
+    global _dirty
+    _dirty = True
+    FEED.notify()
+
+
+def _store_host(host_ip, records):
+    now = time.time()
+    with _LOCK:
+        _INVENTORY[host_ip] = {
+            "vms": {vm["uuid"]: vm for vm in records},
+            "updated_at": now,
+            "reconciled_at": now,
+        }
+    vm_index.replace_host(host_ip, records)
+    _mark_dirty()
+
+
+def _put_vm(host_ip, record):
+    with _LOCK:
+        host = _INVENTORY.get(host_ip)
+        if host is None:
+            return
+        vms = dict(host["vms"])
+        vms[record["uuid"]] = record
+        _INVENTORY[host_ip] = dict(host, vms=vms, updated_at=time.time())
+    vm_index.update_vm(host_ip, record)
+    _mark_dirty()
+
+
+def _remove_vm(host_ip, uuid):
+    with _LOCK:
+        host = _INVENTORY.get(host_ip)
+        if host is None:
+            return
+        vms = dict(host["vms"])
+        vms.pop(uuid, None)
+        _INVENTORY[host_ip] = dict(host, vms=vms, updated_at=time.time())
+    vm_index.remove_vm(uuid)
+    _mark_dirty()
+
+
+def reconcile_host(host_ip):
+    """
+    全量对账：一次批量统计重建该宿主机的清单，弥补丢失的事件。
+    对账同时重新读取所有域描述，desc_signature 察觉不到的定义变更最迟在一个对账周期内生效
+    """
+    records = kvm_inspector.get_all_vms_info(host_ip, refresh_desc=True)
+    _store_host(host_ip, records)
+    logger.info(f"Inventory reconciled for {host_ip}: {len(records)} VMs")
+    return records
+
+
+def refresh_domain(host_ip, domain):
+    """
+    只刷新单个域：一次 domainListGetStats 调用加（必要时）一次 XMLDesc
+    """
+    conn = libvirt_pool.get_connection(host_ip)
+    results = conn.domainListGetStats([domain], kvm_inspector.BULK_STATS, 0)
+    if not results:
+        return
+    dom, stats = results[0]
+    desc = get_domain_desc(dom, desc_signature(stats))
+    _put_vm(host_ip, kvm_inspector.build_vm_record(dom, stats, desc))
+
+
+def _apply_event(host_ip, kind, domain, args):
+    uuid = domain.UUIDString()
+
+    if kind == "lifecycle":
+        event = args[0]
+        kvm_inspector.invalidate_addresses(uuid)
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            invalidate_domain_desc(uuid)
+            vm_policy.invalidate_policy(uuid)
+            _remove_vm(host_ip, uuid)
+            return
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            invalidate_domain_desc(uuid)
+        refresh_domain(host_ip, domain)
+        return
+
+    if kind == "balloon_change":
+        # 事件本身携带了新的气球大小，直接更新记录，无需 RPC
+        actual_kb = args[0]
+        with _LOCK:
+            record = _INVENTORY.get(host_ip, {}).get("vms", {}).get(uuid)
+        if record is not None:
+            record = dict(record)
+            record["curr_mem_kb"] = actual_kb
+            record["curr_mem_gb"] = round(actual_kb / 1024 / 1024, 2)
+            record["elastic_memory"] = actual_kb < record["max_mem_kb"]
+            _put_vm(host_ip, record)
+            return
+        refresh_domain(host_ip, domain)
+        return
+
+    if kind in DEFINITION_EVENTS:
+        invalidate_domain_desc(uuid)
+    if kind == "metadata_change":
+        vm_policy.invalidate_policy(uuid)
+    refresh_domain(host_ip, domain)
+
+
+def _event_worker():
+    while True:
+        item = _EVENT_QUEUE.get()
+        try:
+            if item[0] == "reconcile":
+                reconcile_host(item[1])
+            else:
+                _, host_ip, kind, domain, args = item
+                _apply_event(host_ip, kind, domain, args)
+        except Exception as e:
+            logger.error(f"Failed to apply inventory update {item[:3]}: {e}")
+
+
+def _make_callback(kind):
+    def _callback(conn, domain, *args):
+        # 卸任后不再处理事件，清单改由共享快照同步
+        if not LEADER.is_leader():
+            return
+        # 最后一个参数为注册时传入的 opaque，即宿主机 IP
+        host_ip = args[-1]
+        _EVENT_QUEUE.put(("event", host_ip, kind, domain, args[:-1]))
+    return _callback
+
+
+def _subscribe(host_ip, conn):
+    """在连接上注册域事件，同一连接只注册一次"""
+    with _LOCK:
+        if _SUBSCRIBED.get(host_ip) is conn:
+            return
+        _SUBSCRIBED[host_ip] = conn
+    for event_id, kind in DOMAIN_EVENTS.items():
+        try:
+            conn.domainEventRegisterAny(None, event_id, _make_callback(kind), host_ip)
+        except libvirt.libvirtError as e:
+            logger.warning(f"Failed to register {kind} events on {host_ip}: {e}")
+
+
+def _on_connect(host_ip, conn):
+    """
+    连接池新建（或重建）连接后注册域事件，并安排一次全量对账以弥补断线期间的事件。
+    非领导者的连接只用于按需操作（如扩容），不订阅事件。
+    """
+    if not LEADER.is_leader():
+        return
+    _subscribe(host_ip, conn)
+    with _LOCK:
+        loaded = host_ip in _INVENTORY
+    # 首次连接时清单由触发连接的调用方加载，只有重连才需要补一次对账
+    if loaded:
+        _EVENT_QUEUE.put(("reconcile", host_ip))
+
+
+def _on_elected():
+    """
+    当选后在已有连接上补注册域事件，并对所有宿主机安排一次全量对账
+    """
+    for host_ip in get_server_list():
+        conn = libvirt_pool.POOL.current(host_ip)
+        if conn is not None:
+            _subscribe(host_ip, conn)
+        _EVENT_QUEUE.put(("reconcile", host_ip))
+
+
+def _publish():
+    """领导者把清单发布到共享快照"""
+    global _dirty
+    with _LOCK:
+        _dirty = False
+        hosts = {host_ip: {"vms": dict(host["vms"]), "updated_at": host["updated_at"],
+                           "reconciled_at": host["reconciled_at"]}
+                 for host_ip, host in _INVENTORY.items()}
+    SHARED_INVENTORY.publish(hosts)
+
+
+def _sync_from_shared():
+    """
+    非领导者从共享快照同步清单和 IP / MAC 索引，快照未变化时不做任何事
+    """
+    global _synced
+    with _SYNC_LOCK:
+        shared = SHARED_INVENTORY.read()
+        if shared is None or shared is _synced:
+            return
+        with _LOCK:
+            _INVENTORY.clear()
+            for host_ip, host in shared.items():
+                _INVENTORY[host_ip] = {"vms": dict(host["vms"]), "updated_at": host["updated_at"],
+                                       "reconciled_at": host["reconciled_at"]}
+        for host_ip, host in shared.items():
+            vm_index.replace_host(host_ip, list(host["vms"].values()))
+        _synced = shared
+    FEED.notify()
+
+
+def _share_loop():
+    while True:
+        time.sleep(SHARE_INTERVAL)
+        try:
+            if LEADER.is_leader():
+                if _dirty:
+                    _publish()
+            else:
+                _sync_from_shared()
+        except Exception as e:
+            logger.warning(f"Inventory sharing failed: {e}")
+
+
+def _load_host(host_ip):
+    """
+    加载一台宿主机的清单：领导者直接对账；其他 worker 不连接宿主机，只从共享快照同步
+    """
+    if LEADER.is_leader():
+        return reconcile_host(host_ip)
+    _sync_from_shared()
+    records, _ = get_host_snapshot(host_ip)
+    if records is None:
+        raise Exception(f"Inventory of {host_ip} has not been published by the collector yet")
+    return records
+
+
+def _reconcile_loop():
+    while True:
+        if not LEADER.is_leader():
+            time.sleep(RECONCILE_INTERVAL)
+            continue
+        for host_ip in get_server_list():
+            try:
+                reconcile_host(host_ip)
+            except Exception as e:
+                logger.error(f"Inventory reconcile failed for {host_ip}: {e}")
+        time.sleep(RECONCILE_INTERVAL)
+
+
+def sample_host(host_ip):
+    """
+    对已加载的宿主机做一次轻量采样（一次 getAllDomainStats），把各窗口 CPU 利用率和内存利用率写回清单，
+    并记入供预测使用的长周期历史
+    """
+    with _LOCK:
+        if host_ip not in _INVENTORY:
+            return
+    conn = libvirt_pool.get_connection(host_ip)
+    now = time.time()
+    sampled = []
+    for domain, stats in kvm_inspector.collect_domain_stats(
+            conn, SAMPLE_STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+        if "cpu.time" not in stats:
+            continue
+        uuid = domain.UUIDString()
+        usage_sampler.record(uuid, stats["cpu.time"], stats.get("vcpu.current", 0), ts=now)
+        mem_usage = kvm_inspector.balloon_usage_percent(stats)
+        cpu_percent = usage_sampler.get_cpu_percent(uuid)
+        usage_sampler.record_usage(uuid, cpu_percent, mem_usage, ts=now)
+        metric_store.record_vm(uuid, cpu_percent, mem_usage, ts=now)
+        sampled.append((uuid, mem_usage))
+
+    with _LOCK:
+        host = _INVENTORY.get(host_ip)
+        if host is None:
+            return
+        vms = dict(host["vms"])
+        for uuid, mem_usage in sampled:
+            record = vms.get(uuid)
+            if record is None:
+                continue
+            record = dict(record)
+            record["cpu_usage"] = usage_sampler.get_usage(uuid)
+            record["cpu_usage_percent"] = usage_sampler.get_cpu_percent(uuid)
+            record["mem_usage_percent"] = mem_usage
+            vms[uuid] = record
+        _INVENTORY[host_ip] = dict(host, vms=vms, updated_at=time.time())
+    _mark_dirty()
+
+
+def _sample_loop():
+    while True:
+        started = time.time()
+        for host_ip in get_server_list() if LEADER.is_leader() else []:
+            try:
+                sample_host(host_ip)
+            except Exception as e:
+                logger.warning(f"CPU sampling failed for {host_ip}: {e}")
+        usage_sampler.prune()
+        if LEADER.is_leader():
+            try:
+                usage_sampler.publish_shared()
+            except Exception as e:
+                logger.warning(f"Failed to publish CPU usage: {e}")
+        time.sleep(max(usage_sampler.SAMPLE_INTERVAL - (time.time() - started), 1))
+
+
+def start():
+    """
+    启动清单服务：事件工作线程 + 周期性全量对账线程 + CPU 采样线程 + 共享快照发布 / 同步线程，
+    并从磁盘加载上次的 VM 索引预热（首次对账完成前也能按 IP / MAC 定位）。
+    对账、采样和事件只在当选的采集者上进行。
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        vm_index.start_persistence()
+        libvirt_pool.POOL.add_connect_listener(_on_connect)
+        threading.Thread(target=_event_worker, name="inventory-events", daemon=True).start()
+        threading.Thread(target=_reconcile_loop, name="inventory-reconcile", daemon=True).start()
+        threading.Thread(target=_sample_loop, name="inventory-sampler", daemon=True).start()
+        threading.Thread(target=_share_loop, name="inventory-share", daemon=True).start()
+        LEADER.on_elected(_on_elected)
+        _started = True
+
+
+def get_host_vms(host_ip):
+    """
+    读取某台宿主机的虚拟机清单（纯内存读取，无 RPC）。
+    该宿主机尚未完成首次加载时，同步加载一次（见 _load_host）。
+    """
+    with _LOCK:
+        host = _INVENTORY.get(host_ip)
+        if host is not None:
+            return list(host["vms"].values())
+    return _load_host(host_ip)
+
+
+def get_vm(host_ip, uuid):
+    """
+    按 UUID 读取单台虚拟机的记录（纯内存读取），未加载或不存在时返回 None
+    """
+    with _LOCK:
+        return _INVENTORY.get(host_ip, {}).get("vms", {}).get(uuid)
+
+
+def get_host_snapshot(host_ip):
+    """
+    返回 (vms, updated_at)；宿主机未加载时返回 (None, None)
+    """
+    with _LOCK:
+        host = _INVENTORY.get(host_ip)
+        if host is None:
+            return None, None
+        return list(host["vms"].values()), host["updated_at"]
+
+
+def load_async(host_ip):
+    """
+    宿主机尚未加载时在后台发起一次全量对账，不阻塞调用方
+    """
+    with _LOCK:
+        if host_ip in _INVENTORY:
+            return
+    _submit_load(host_ip)
+
+
+def _submit_load(host_ip):
+    with _LOCK:
+        future = _PENDING_LOADS.get(host_ip)
+        if future is None or future.done():
+            future = _FANOUT_EXECUTOR.submit(_load_host, host_ip)
+            _PENDING_LOADS[host_ip] = future
+        return future
+
+
+def get_cluster_vms(timeout=None):
+    """
+    查询 config.yaml 中所有宿主机的虚拟机清单。
+    已加载的宿主机直接读内存；未加载的并发加载（并发数受 FANOUT_CONCURRENCY 限制），
+    最多等待 timeout 秒，超时或失败的宿主机只在 hosts 中标注状态，不影响其他宿主机。
+    返回: {
+        'hosts': { host_ip: {'status': 'ok'|'loading'|'error', 'vm_count', 'updated_at', 'error'} },
+        'vms': [ {..., 'host': host_ip} ]
+    }
+    """
+    timeout = FANOUT_TIMEOUT if timeout is None else timeout
+    hosts = {}
+    vms = []
+    futures = {}
+
+    for host_ip in get_server_list():
+        records, updated_at = get_host_snapshot(host_ip)
+        if records is not None:
+            hosts[host_ip] = {"status": "ok", "vm_count": len(records), "updated_at": updated_at}
+            vms.extend(dict(vm, host=host_ip) for vm in records)
+        else:
+            futures[host_ip] = _submit_load(host_ip)
+
+    if futures:
+        wait(futures.values(), timeout=timeout)
+
+    for host_ip, future in futures.items():
+        if not future.done():
+            # 加载仍在后台进行，完成后写入清单，下次查询即可命中
+            hosts[host_ip] = {"status": "loading", "vm_count": 0, "updated_at": None}
+            continue
+        error = future.exception()
+        if error is not None:
+            hosts[host_ip] = {"status": "error", "vm_count": 0, "updated_at": None, "error": str(error)}
+            continue
+        records, updated_at = get_host_snapshot(host_ip)
+        records = records or []
+        hosts[host_ip] = {"status": "ok", "vm_count": len(records), "updated_at": updated_at}
+        vms.extend(dict(vm, host=host_ip) for vm in records)
+
+    return {"hosts": hosts, "vms": vms}
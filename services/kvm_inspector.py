@@ -1,9 +1,15 @@
 # services/kvm_inspector.py
 
+import threading
+import time
+
 import libvirt
 import yaml
 from xml.etree import ElementTree as ET
 
+from services import libvirt_pool, usage_sampler, vm_policy
+from services.domain_desc import get_domain_desc, desc_signature, invalidate_domain_desc
+
 
 # 加载配置
 with open("config.yaml", "r") as f:
@@ -12,224 +18,265 @@ with open("config.yaml", "r") as f:
 
 def connect_libvirt(host_ip):
     """
-    建立 libvirt 连接
+    获取 libvirt 连接（来自进程级连接池，调用方不要 close）
     """
     server = CONFIG['servers'].get(host_ip)
     if not server:
         raise Exception(f"No config found for host {host_ip}")
 
-    uri = server['libvirt_uri']
-    conn = libvirt.open(uri)
-    if not conn:
-        raise Exception(f"Failed to open connection to {host_ip}")
-    return conn
+    return libvirt_pool.get_connection(host_ip)
 
 
-def has_qemu_agent(domain):
+def get_vm_policy_from_metadata(domain):
     """
-    判断虚拟机是否配置了 QEMU Guest Agent
+    获取虚拟机的伸缩策略：default_vm_policy 合并域元数据中的 <policy>。
+    读取缓存的域描述，只有描述未缓存时才会执行一次 XMLDesc。
     """
-    try:
-        xml_desc = domain.XMLDesc(0)
-        root = ET.fromstring(xml_desc)
-        for channel in root.findall(".//devices/channel"):
-            target = channel.find("target")
-            if target is not None and 'name' in target.attrib:
-                if target.attrib['name'] == 'org.qemu.guest_agent.0':
-                    return True
-    except ET.ParseError as pe:
-        print(f"[ERROR] XML parse failed (has_qemu_agent): {pe}")
-    except Exception as e:
-        print(f"[ERROR] Failed to check QEMU GA for {domain.name()}: {e}")
-    return False
+    return vm_policy.policy_for_desc(get_domain_desc(domain))
 
 
-def get_vcpu_info(domain):
-    """
-    获取虚拟机的 vCPU 配置信息
-    返回: {
-        'max_vcpu': int,
-        'curr_vcpu': int,
-        'vcpu_mode': 'static' or 'elastic'
-    }
-    """
-    try:
-        xml_desc = domain.XMLDesc(0)
-        root = ET.fromstring(xml_desc)
+# 没有 QEMU GA 的虚拟机是否通过 DHCP 租约补全 IP
+LEASE_LOOKUP = (CONFIG.get('inventory', {}) or {}).get('lease_lookup', True)
+# 通过 QEMU GA 查到的地址的缓存时间（秒）；虚拟机启停或重启时立即失效
+ADDRESS_TTL = (CONFIG.get('inventory', {}) or {}).get('address_ttl', 300)
 
-        vcpu_elem = root.find("vcpu")
-        if vcpu_elem is None:
-            raise ValueError("XML 中未找到 vCPU 配置")
+# { uuid: (过期时间, [ip, ...]) }
+_ADDRESS_CACHE = {}
+_ADDRESS_LOCK = threading.Lock()
 
-        max_vcpu = int(vcpu_elem.text)
-        curr_vcpu = int(vcpu_elem.get('current', max_vcpu))
-        is_elastic = curr_vcpu < max_vcpu
+# getAllDomainStats 一次性拉取的统计分组：状态、总 CPU 时间、气球内存、vCPU、网卡、磁盘
+BULK_STATS = (
+    libvirt.VIR_DOMAIN_STATS_STATE
+    | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
 
-        return {
-            'max_vcpu': max_vcpu,
-            'curr_vcpu': curr_vcpu,
-            'vcpu_mode': 'elastic' if is_elastic else 'static'
-        }
 
-    except ET.ParseError as pe:
-        print(f"[ERROR] XML parse failed (get_vcpu_info): {pe}")
-    except Exception as e:
-        print(f"[ERROR] Failed to get vCPU info for {domain.name()}: {e}")
-    return {
-        'max_vcpu': 0,
-        'curr_vcpu': 0,
-        'vcpu_mode': 'static'
-    }
-
-
-def is_elastic_memory(domain):
+def get_domain_ip_addresses(domain, source=libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT):
     """
-    判断是否启用弹性内存（是否设置 currentMemory < maxMemory）
+    获取虚拟机的全部 IPv4 地址（eth0 的地址排在最前）。
+    source 默认通过 QEMU GA 查询，也可用 VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE 查 DHCP 租约
     """
+    ip_addresses = []
     try:
-        xml_desc = domain.XMLDesc(0)
-        root = ET.fromstring(xml_desc)
-
-        mem_elem = root.find("memory")
-        curr_mem_elem = root.find("currentMemory")
-
-        if mem_elem is not None and curr_mem_elem is not None:
-            max_mem_kb = int(mem_elem.text)
-            curr_mem_kb = int(curr_mem_elem.text)
-            return curr_mem_kb < max_mem_kb
-    except ET.ParseError as pe:
-        print(f"[ERROR] XML parse failed (is_elastic_memory): {pe}")
+        # 获取虚拟机的接口信息
+        interfaces = domain.interfaceAddresses(source, 0)
+        # 优先查找 eth0 接口，其余接口按顺序追加
+        names = sorted(interfaces, key=lambda name: name != 'eth0')
+        for name in names:
+            for addr in interfaces[name].get('addrs') or []:
+                # 只获取 IPv4 地址，跳过回环
+                if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4 and not addr['addr'].startswith('127.'):
+                    ip_addresses.append(addr['addr'])
     except Exception as e:
-        print(f"[ERROR] Failed to check elastic memory for {domain.name()}: {e}")
-    return False
+        print(f"[WARN] Failed to get IP address for {domain.name()}: {e}")
+    return ip_addresses
 
 
-def get_domain_cpu_usage(domain):
+def _agent_addresses(domain, uuid):
+    """
+    通过 QEMU GA 获取地址，结果按 uuid 缓存 ADDRESS_TTL 秒；
+    对账时不必每台虚拟机都做一次 interfaceAddresses 往返。查询结果为空（GA 尚未就绪）时不缓存
+    """
+    now = time.time()
+    with _ADDRESS_LOCK:
+        cached = _ADDRESS_CACHE.get(uuid)
+    if cached is not None and cached[0] > now:
+        return list(cached[1])
+    ip_addresses = get_domain_ip_addresses(domain)
+    with _ADDRESS_LOCK:
+        if ip_addresses:
+            _ADDRESS_CACHE[uuid] = (now + ADDRESS_TTL, ip_addresses)
+        else:
+            _ADDRESS_CACHE.pop(uuid, None)
+    return list(ip_addresses)
+
+
+def invalidate_addresses(uuid):
+    """虚拟机启停、重启或被删除时丢弃缓存的地址"""
+    with _ADDRESS_LOCK:
+        _ADDRESS_CACHE.pop(uuid, None)
+
+
+def get_host_leases(conn):
     """
-    获取虚拟机 CPU 使用率（需要 QEMU GA）
+    一次性读取宿主机上所有活动网络的 DHCP 租约，返回 { mac: [ipv4, ...] }。
+    每个网络一次 DHCPLeases 调用，替代每台虚拟机一次租约查询；无法列出网络时返回 None，由调用方逐域查询
     """
+    leases = {}
     try:
-        if not domain.isActive():  # 👈 先判断是否运行中
-            return 0.0
-        stats = domain.getCPUStats(True)
-        if stats and 'cpu_time' in stats[0]:
-            return round(stats[0]['cpu_time'] / 10_000_000, 2)  # ns -> %
+        networks = conn.listAllNetworks(libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)
     except Exception as e:
-        print(f"[WARN] Failed to get CPU usage for {domain.name()}: {e}")
-    return 0.0
+        print(f"[WARN] Failed to list networks, falling back to per-domain lease lookups: {e}")
+        return None
+    for network in networks:
+        try:
+            for lease in network.DHCPLeases():
+                if lease.get('type') == libvirt.VIR_IP_ADDR_TYPE_IPV4 and lease.get('mac'):
+                    leases.setdefault(lease['mac'].lower(), []).append(lease['ipaddr'])
+        except Exception as e:
+            print(f"[WARN] Failed to get DHCP leases for network {network.name()}: {e}")
+    return leases
+
+
+def _lease_addresses(desc, leases):
+    """按域定义中网卡的顺序，从租约表中取出虚拟机的地址"""
+    ip_addresses = []
+    for mac in desc['macs']:
+        ip_addresses.extend(leases.get(mac.lower(), []))
+    return ip_addresses
+
+
+def _sum_indexed_stats(stats, prefix, field):
+    """
+    汇总 getAllDomainStats 中按序号展开的字段，如 net.0.rx.bytes + net.1.rx.bytes
+    """
+    total = 0
+    for i in range(stats.get(f"{prefix}.count", 0)):
+        total += stats.get(f"{prefix}.{i}.{field}", 0)
+    return total
 
 
+def balloon_usage_percent(stats):
+    """
+    由气球统计计算客户机内存利用率（%），需要客户机内的 virtio-balloon 驱动上报 available
+    """
+    actual = stats.get("balloon.current", 0)
+    if not actual or "balloon.available" not in stats:
+        return 0.0
+    return round((actual - stats["balloon.available"]) * 100.0 / actual, 2)
 
-def get_domain_memory_usage(domain):
+
+def build_vm_record(domain, stats, desc, leases=None):
     """
-    获取虚拟机内存使用率（需要 QEMU GA）
+    根据一次批量统计结果和缓存的域描述构建虚拟机记录。
+    stats 为 getAllDomainStats 返回的单个域的字典，desc 为 domain_desc 解析出的描述。
+    leases 为 get_host_leases 读取的租约表；为 None 时（单个域刷新）按需查询该域的租约。
     """
-    try:
-        if not domain.isActive():  # 👈 先判断是否运行中
-            return 0.0
-        stats = domain.memoryStats()
-        if stats:
-            return round((stats['actual'] - stats['available']) * 100.0 / stats['actual'], 2)
-    except Exception as e:
-        print(f"[WARN] Failed to get memory usage for {domain.name()}: {e}")
-    return 0.0
+    running = stats.get("state.state") == libvirt.VIR_DOMAIN_RUNNING
+
+    # 内存 / vCPU：优先使用实时统计，缺失时回退到 XML 定义
+    max_mem_kb = stats.get("balloon.maximum", desc['max_mem_kb'])
+    curr_mem_kb = stats.get("balloon.current", desc['curr_mem_kb'])
+    max_vcpu = stats.get("vcpu.maximum", desc['max_vcpu'])
+    curr_vcpu = stats.get("vcpu.current", desc['curr_vcpu'])
+    qemu_ga = desc['has_qemu_ga']
+
+    uuid = domain.UUIDString()
+    cpu_usage = 0.0
+    mem_usage = 0.0
+    if running:
+        # 环形缓冲区只由采样线程按固定间隔写入（见 inventory.sample_host），这里只读取；
+        # 对账 / 事件刷新额外写入的样本会挤掉旧样本，使长窗口覆盖不到完整时长
+        cpu_usage = usage_sampler.get_cpu_percent(uuid)
+        mem_usage = balloon_usage_percent(stats)
+
+    elastic_vcpu = curr_vcpu < max_vcpu
+    elastic_memory = curr_mem_kb < max_mem_kb
+    ip_addresses = []
+    if running:
+        if qemu_ga:
+            ip_addresses = _agent_addresses(domain, uuid)
+        elif LEASE_LOOKUP and desc['macs']:
+            # 没有 GA 的虚拟机退而查询 libvirt 网络的 DHCP 租约
+            if leases is not None:
+                ip_addresses = _lease_addresses(desc, leases)
+            else:
+                ip_addresses = get_domain_ip_addresses(domain, libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+    else:
+        invalidate_addresses(uuid)
+    ip_address = ip_addresses[0] if ip_addresses else ""
 
+    return {
+        "name": domain.name(),
+        "uuid": uuid,
+        "state": "running" if running else "shutdown",
+        "curr_mem_kb": curr_mem_kb,
+        "max_mem_kb": max_mem_kb,
+        "curr_mem_gb": round(curr_mem_kb / 1024 / 1024, 2),
+        "max_mem_gb": round(max_mem_kb / 1024 / 1024, 2),
+        "curr_vcpu": curr_vcpu,
+        "max_vcpu": max_vcpu,
+        "vcpu_mode": 'elastic' if elastic_vcpu else 'static',
+        "has_qemu_ga": qemu_ga,
+        "elastic_vcpu": elastic_vcpu,
+        "elastic_memory": elastic_memory,
+        "cpu_usage_percent": cpu_usage,
+        "cpu_usage": usage_sampler.get_usage(uuid) if running else {},
+        "mem_usage_percent": mem_usage,
+        "policy": vm_policy.policy_for_desc(desc),
+        "ip_address": ip_address,  # 添加IP地址字段
+        "ip_addresses": ip_addresses,
+        "macs": desc['macs'],
+        "block_rd_bytes": _sum_indexed_stats(stats, "block", "rd.bytes"),
+        "block_wr_bytes": _sum_indexed_stats(stats, "block", "wr.bytes"),
+        "net_rx_bytes": _sum_indexed_stats(stats, "net", "rx.bytes"),
+        "net_tx_bytes": _sum_indexed_stats(stats, "net", "tx.bytes"),
+    }
 
-def get_all_vms_info(host_ip):
+
+def _legacy_domain_stats(domain):
     """
-    获取指定 KVM 主机上的所有虚拟机及其详细信息（含弹性、QEMU GA、资源使用等）
+    不支持 getAllDomainStats 的旧版 libvirt：逐个 RPC 拼出与批量统计相同格式的字典
     """
-    conn = connect_libvirt(host_ip)
-    vms = []
+    info = domain.info()
+    stats = {
+        "state.state": info[0],
+        "balloon.maximum": info[1],
+        "balloon.current": info[2],
+        "vcpu.current": info[3],
+    }
+    if info[0] == libvirt.VIR_DOMAIN_RUNNING:
+        cpu_stats = domain.getCPUStats(True)
+        if cpu_stats and 'cpu_time' in cpu_stats[0]:
+            stats["cpu.time"] = cpu_stats[0]['cpu_time']
+        mem_stats = domain.memoryStats()
+        if 'available' in mem_stats:
+            stats["balloon.available"] = mem_stats['available']
+    return stats
 
-    try:
-        domains = conn.listAllDomains(0)
-        for domain in domains:
-            try:
-                info = domain.info()
-                xml_desc = domain.XMLDesc(0)
-                root = ET.fromstring(xml_desc)
-
-                # 提取内存信息
-                mem_elem = root.find("memory")
-                curr_mem_elem = root.find("currentMemory")
-                max_mem_kb = int(mem_elem.text) if mem_elem is not None else 0
-                curr_mem_kb = int(curr_mem_elem.text) if curr_mem_elem is not None else max_mem_kb
-
-                # 获取 vCPU 信息
-                vcpu_info = get_vcpu_info(domain)
-
-                # 获取 QEMU GA 状态
-                qemu_ga = has_qemu_agent(domain)
-
-                # 构建返回对象
-                elastic_vcpu = vcpu_info['curr_vcpu'] < vcpu_info['max_vcpu']
-                elastic_memory = curr_mem_kb < max_mem_kb
-                cpu_usage = get_domain_cpu_usage(domain) if info[0] == libvirt.VIR_DOMAIN_RUNNING else 0.0
-                mem_usage = get_domain_memory_usage(domain) if info[0] == libvirt.VIR_DOMAIN_RUNNING else 0.0
-
-                ip_address = ""
-                if qemu_ga:
-                    # 如果 QEMU GA 存在，尝试获取 eth0 的 IP 地址
-                    try:
-                        if domain.isActive():
-                            # 获取虚拟机的接口信息
-                            interfaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT, 0)
-                            # 优先查找 eth0 接口
-                            if 'eth0' in interfaces:
-                                value = interfaces['eth0']
-                                if 'addrs' in value:
-                                    for addr in value['addrs']:
-                                        # 只获取 IPv4 地址
-                                        if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
-                                            ip_address = addr['addr']
-                                            break
-                            else:
-                                # 如果没有 eth0，回退到第一个有地址的接口
-                                for key, value in interfaces.items():
-                                    if 'addrs' in value:
-                                        for addr in value['addrs']:
-                                            if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
-                                                ip_address = addr['addr']
-                                                break
-                                        if ip_address:
-                                            break
-                    except Exception as e:
-                        print(f"[WARN] Failed to get IP address for {domain.name()}: {e}")
-                vms.append({
-                    "name": domain.name(),
-                    "uuid": domain.UUIDString(),
-                    "state": "running" if info[0] == libvirt.VIR_DOMAIN_RUNNING else "shutdown",
-                    "curr_mem_kb": curr_mem_kb,
-                    "max_mem_kb": max_mem_kb,
-                    "curr_mem_gb": round(curr_mem_kb / 1024 / 1024, 2),
-                    "max_mem_gb": round(max_mem_kb / 1024 / 1024, 2),
-                    "curr_vcpu": vcpu_info['curr_vcpu'],
-                    "max_vcpu": vcpu_info['max_vcpu'],
-                    "vcpu_mode": 'elastic' if elastic_vcpu else 'static',
-                    "has_qemu_ga": qemu_ga,
-                    "elastic_vcpu": elastic_vcpu,
-                    "elastic_memory": elastic_memory,
-                    "cpu_usage_percent": cpu_usage,
-                    "mem_usage_percent": mem_usage,
-                    "ip_address": ip_address  # 添加IP地址字段
-                })
-
-            except ET.ParseError as pe:
-                print(f"[ERROR] XML Parse failed for {domain.name()}: {pe}")
-                continue
-            except Exception as e:
-                print(f"[ERROR] Failed to collect data for {domain.name()}: {e}")
-                continue
-
-    finally:
-        conn.close()
 
-    return vms
+def collect_domain_stats(conn, stats=BULK_STATS, flags=0):
+    """
+    批量获取主机上所有域的统计信息，返回 [(domain, stats_dict), ...]。
+    一次 getAllDomainStats 调用替代每个域 info/isActive/getCPUStats/memoryStats 的多次往返；
+    旧版 libvirt 不支持时回退到逐域查询。
+    """
+    try:
+        return conn.getAllDomainStats(stats, flags)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+            raise
+        print(f"[WARN] getAllDomainStats not supported, falling back to per-domain queries: {e}")
+    # VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE 等过滤位与 listAllDomains 的取值一致
+    return [(domain, _legacy_domain_stats(domain)) for domain in conn.listAllDomains(flags)]
 
 
-def get_all_vms_on_host(host_ip):
+def get_all_vms_info(host_ip, refresh_desc=False):
     """
-    兼容旧接口：获取指定 KVM 主机上的所有虚拟机信息。
+    获取指定 KVM 主机上的所有虚拟机及其详细信息（含弹性、QEMU GA、资源使用等）。
+    refresh_desc 为 True 时丢弃缓存的域描述、重新执行 XMLDesc，
+    补上签名覆盖不到的定义变更（元数据、MAC 等）以及断线期间丢失的事件
     """
-    return get_all_vms_info(host_ip)
+    conn = connect_libvirt(host_ip)
+    vms = []
+    # 租约表整台宿主机只读一次
+    leases = get_host_leases(conn) if LEASE_LOOKUP else None
+
+    for domain, stats in collect_domain_stats(conn):
+        try:
+            if refresh_desc:
+                invalidate_domain_desc(domain.UUIDString())
+            desc = get_domain_desc(domain, desc_signature(stats))
+            vms.append(build_vm_record(domain, stats, desc, leases))
+        except ET.ParseError as pe:
+            print(f"[ERROR] XML Parse failed for {domain.name()}: {pe}")
+            continue
+        except Exception as e:
+            print(f"[ERROR] Failed to collect data for {domain.name()}: {e}")
+            continue
+
+    return vms
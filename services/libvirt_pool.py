@@ -0,0 +1,195 @@
+# services/libvirt_pool.py
+
+import logging
+import os
+import threading
+import time
+
+import libvirt
+import yaml
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+POOL_CONFIG = CONFIG.get('libvirt_pool', {}) or {}
+
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
+
+
+def ensure_event_loop():
+    """
+    注册并启动 libvirt 默认事件循环线程。
+    keepalive 和域事件回调都依赖事件循环，必须在打开连接之前调用。
+    """
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def _run():
+            while True:
+                try:
+                    libvirt.virEventRunDefaultImpl()
+                except Exception as e:
+                    logger.error(f"libvirt event loop iteration failed: {e}")
+                    time.sleep(1)
+
+        threading.Thread(target=_run, name="libvirt-event-loop", daemon=True).start()
+        _event_loop_started = True
+
+
+class LibvirtConnectionPool:
+    """
+    进程级 libvirt 连接池：每台宿主机维持一条长连接，供所有 Flask 工作线程复用。
+    - 通过 setKeepAlive 探测对端，连接失效后由 close 回调标记
+    - 取连接时用 isAlive() 复核，失效则重连
+    - 连续失败按指数退避，退避期内直接报错，避免每个请求都去握手
+    """
+
+    def __init__(self, servers, keepalive_interval=5, keepalive_count=3,
+                 backoff_base=1, backoff_max=60):
+        self.servers = servers
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._entries = {}
+        self._entries_lock = threading.Lock()
+        self._connect_listeners = []
+
+    def _entry(self, host_ip):
+        with self._entries_lock:
+            entry = self._entries.get(host_ip)
+            if entry is None:
+                entry = {"conn": None, "lock": threading.Lock(), "failures": 0, "next_retry": 0.0}
+                self._entries[host_ip] = entry
+            return entry
+
+    def add_connect_listener(self, callback):
+        """
+        注册新建连接时的回调 callback(host_ip, conn)，用于重连后重新注册域事件等
+        """
+        self._connect_listeners.append(callback)
+
+    def current(self, host_ip):
+        """
+        返回已建立的连接，不新建；没有连接时返回 None
+        """
+        with self._entries_lock:
+            entry = self._entries.get(host_ip)
+        return entry["conn"] if entry is not None else None
+
+    def get(self, host_ip):
+        """
+        获取指定宿主机的共享连接，必要时建立或重建。调用方不要 close 返回的连接。
+        """
+        server = self.servers.get(host_ip)
+        if not server:
+            raise Exception(f"No config found for host {host_ip}")
+
+        entry = self._entry(host_ip)
+        with entry["lock"]:
+            conn = entry["conn"]
+            if conn is not None:
+                try:
+                    if conn.isAlive():
+                        return conn
+                except libvirt.libvirtError:
+                    pass
+                logger.warning(f"libvirt connection to {host_ip} is dead, reconnecting")
+                self._drop(entry)
+
+            now = time.time()
+            if now < entry["next_retry"]:
+                raise Exception(f"Connection to {host_ip} is backing off for "
+                                f"{entry['next_retry'] - now:.1f}s after {entry['failures']} failure(s)")
+
+            try:
+                conn = self._open(host_ip, server['libvirt_uri'])
+            except Exception:
+                entry["failures"] += 1
+                delay = min(self.backoff_base * 2 ** (entry["failures"] - 1), self.backoff_max)
+                entry["next_retry"] = time.time() + delay
+                raise
+
+            entry["conn"] = conn
+            entry["failures"] = 0
+            entry["next_retry"] = 0.0
+
+        for callback in self._connect_listeners:
+            try:
+                callback(host_ip, conn)
+            except Exception as e:
+                logger.error(f"Connect listener failed for {host_ip}: {e}")
+        return conn
+
+    def _open(self, host_ip, uri):
+        ensure_event_loop()
+        conn = libvirt.open(uri)
+        if not conn:
+            raise Exception(f"Failed to open connection to {host_ip}")
+        conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+
+        def _on_close(c, reason, opaque):
+            logger.warning(f"libvirt connection to {host_ip} closed (reason={reason})")
+            self.invalidate(host_ip, c)
+
+        conn.registerCloseCallback(_on_close, None)
+        logger.info(f"Opened pooled libvirt connection to {host_ip}")
+        return conn
+
+    @staticmethod
+    def _drop(entry):
+        conn = entry["conn"]
+        entry["conn"] = None
+        if conn is not None:
+            try:
+                conn.unregisterCloseCallback()
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+
+    def invalidate(self, host_ip, conn=None):
+        """
+        标记某台宿主机的连接失效，下次 get 时重连。
+        若给定 conn，只有当它仍是池中的连接时才丢弃。
+        """
+        entry = self._entry(host_ip)
+        # close 回调在事件循环线程中触发，可能与 get 竞争，这里带超时地加锁
+        if not entry["lock"].acquire(timeout=5):
+            return
+        try:
+            if conn is None:
+                self._drop(entry)
+            elif entry["conn"] is conn:
+                # 连接已被对端关闭，只需从池中移除
+                entry["conn"] = None
+        finally:
+            entry["lock"].release()
+
+    def close_all(self):
+        for host_ip in list(self._entries):
+            entry = self._entry(host_ip)
+            with entry["lock"]:
+                self._drop(entry)
+
+
+POOL = LibvirtConnectionPool(
+    CONFIG.get('servers', {}),
+    keepalive_interval=POOL_CONFIG.get('keepalive_interval', 5),
+    keepalive_count=POOL_CONFIG.get('keepalive_count', 3),
+    backoff_base=POOL_CONFIG.get('reconnect_backoff_base', 1),
+    backoff_max=POOL_CONFIG.get('reconnect_backoff_max', 60),
+)
+
+
+def get_connection(host_ip):
+    """
+    从进程级连接池获取宿主机的 libvirt 连接
+    """
+    return POOL.get(host_ip)
@@ -0,0 +1,373 @@
+# services/metric_store.py
+
+import bisect
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid as uuid_lib
+
+import yaml
+
+from utils.leader import LEADER
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(BASE_DIR, "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+STORE_CONFIG = CONFIG.get('metric_store', {}) or {}
+ENABLED = STORE_CONFIG.get('enabled', True)
+ROOT = os.path.join(BASE_DIR, STORE_CONFIG.get('path', 'data/metrics'))
+FLUSH_INTERVAL = STORE_CONFIG.get('flush_interval', 30)  # 内存缓冲写入段文件的周期，单位秒
+RETENTION_INTERVAL = STORE_CONFIG.get('retention_interval', 3600)  # 清理过期段文件的周期，单位秒
+
+# 各序列类型记录的字段，每条记录为 uint32 时间戳 + 各字段 float32
+FIELDS = {
+    "host": ("cpu_percent", "iowait_percent", "load1", "mem_usage_percent", "mem_used_mb",
+             "read_bytes_per_s", "write_bytes_per_s", "io_util_percent"),
+    "vm": ("cpu_percent", "mem_usage_percent"),
+}
+RECORDS = {kind: struct.Struct('<I' + 'f' * len(fields)) for kind, fields in FIELDS.items()}
+
+# 分辨率：名称 -> (步长秒, 每个段文件覆盖的秒数, 默认保留秒数)；raw 为原始样本
+RESOLUTIONS = {
+    "raw": (0, 86400, 2 * 86400),
+    "1m": (60, 7 * 86400, 14 * 86400),
+    "10m": (600, 30 * 86400, 90 * 86400),
+    "1h": (3600, 365 * 86400, 730 * 86400),
+}
+RETENTION = {res: (STORE_CONFIG.get('retention', {}) or {}).get(res, default)
+             for res, (_, _, default) in RESOLUTIONS.items()}
+ROLLUPS = [res for res, (step, _, _) in RESOLUTIONS.items() if step]
+MAX_POINTS = STORE_CONFIG.get('max_points', 2000)  # 查询未指定分辨率时返回点数的上限
+RAW_INTERVAL = (CONFIG.get('usage_sampler', {}) or {}).get('sample_interval', 10)  # 原始样本的大致间隔
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def validate_series_id(kind, series_id):
+    """
+    序列 id 会拼进段文件路径：宿主机必须是 IP 地址，VM 必须是规范格式的 UUID，其他形式（如 ../）一律拒绝
+    :raises ValueError: id 不合法时
+    """
+    try:
+        if kind == "host":
+            valid = str(ipaddress.ip_address(series_id)) == series_id
+        else:
+            valid = str(uuid_lib.UUID(series_id)) == series_id
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ValueError(f"Invalid {kind} id '{series_id}'")
+
+
+def _segment_start(name):
+    """段文件名 {segment_start}.seg 中的起始时间；不是段文件或无法解析时返回 None"""
+    if not name.endswith('.seg'):
+        return None
+    try:
+        return int(name[:-len('.seg')])
+    except ValueError:
+        return None
+
+
+class _Rollup:
+    """
+    某条序列在一个降采样分辨率上正在累积的桶，桶结束时输出各字段均值
+    """
+
+    __slots__ = ("bucket", "sums", "count")
+
+    def __init__(self, width):
+        self.bucket = -1
+        self.sums = [0.0] * width
+        self.count = 0
+
+    def add(self, bucket, values):
+        """加入一个样本；跨入新桶时返回上一个桶的 (桶序号, 均值列表)，否则返回 None"""
+        done = None
+        if bucket != self.bucket:
+            if self.count:
+                done = (self.bucket, [s / self.count for s in self.sums])
+            self.bucket = bucket
+            self.sums = [0.0] * len(self.sums)
+            self.count = 0
+        for i, value in enumerate(values):
+            self.sums[i] += value
+        self.count += 1
+        return done
+
+
+class _RecordView:
+    """
+    把段文件的 mmap 包装成按时间戳索引的序列，供 bisect 二分查找
+    """
+
+    def __init__(self, buf, record, count):
+        self.buf = buf
+        self.record = record
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<I', self.buf, index * self.record.size)[0]
+
+
+class MetricStore:
+    """
+    嵌入式、只追加的时间序列存储：每条序列（宿主机或 VM）每个分辨率一组定长记录的段文件，
+    路径为 {root}/{resolution}/{kind}/{id}/{segment_start}.seg。
+    - 写入只追加到内存缓冲区，由后台线程每 FLUSH_INTERVAL 秒批量追加到段文件
+    - 原始样本同时累积为 1m / 10m / 1h 均值，各分辨率按自己的保留期整段删除
+    - 查询按时间范围选出段文件，mmap 后二分查找起止位置，只解码范围内的记录
+    """
+
+    def __init__(self, root):
+        self.root = root
+        # { (kind, id): {"last": {res: ts}, "rollups": {res: _Rollup}} }
+        self._series = {}
+        # { (res, kind, id): {segment_start: bytearray} }，等待写入的记录
+        self._pending = {}
+        self._writing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _segment_dir(self, res, kind, series_id):
+        return os.path.join(self.root, res, kind, series_id)
+
+    def _append(self, res, kind, series_id, ts, values):
+        """在持有 _lock 时调用：把一条记录放入对应段的缓冲区，时间戳不递增的记录丢弃"""
+        state = self._series[(kind, series_id)]
+        if ts <= state["last"].get(res, -1):
+            return
+        state["last"][res] = ts
+        segments = self._pending.get((res, kind, series_id))
+        if segments is None:
+            segments = self._pending[(res, kind, series_id)] = {}
+        segment = ts - ts % RESOLUTIONS[res][1]
+        buf = segments.get(segment)
+        if buf is None:
+            buf = segments[segment] = bytearray()
+        buf += RECORDS[kind].pack(ts, *values)
+
+    def record(self, kind, series_id, values, ts=None):
+        """
+        记录一个样本：values 为 {字段: 数值}，缺少的字段记为 NaN
+        """
+        ts = int(ts or time.time())
+        row = [float('nan') if values.get(field) is None else float(values[field]) for field in FIELDS[kind]]
+        with self._lock:
+            state = self._series.get((kind, series_id))
+            if state is None:
+                state = self._series[(kind, series_id)] = {
+                    "last": {}, "rollups": {res: _Rollup(len(row)) for res in ROLLUPS}}
+            self._append("raw", kind, series_id, ts, row)
+            for res in ROLLUPS:
+                step = RESOLUTIONS[res][0]
+                done = state["rollups"][res].add(ts // step, row)
+                if done is not None:
+                    self._append(res, kind, series_id, done[0] * step, done[1])
+
+    def flush(self):
+        """
+        把缓冲区中的记录追加到段文件（每段一次 write）
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._writing, self._pending = self._pending, {}
+            for (res, kind, series_id), segments in self._writing.items():
+                directory = self._segment_dir(res, kind, series_id)
+                for segment, buf in segments.items():
+                    try:
+                        os.makedirs(directory, exist_ok=True)
+                        self._write_segment(os.path.join(directory, f"{segment}.seg"), RECORDS[kind].size, buf)
+                    except OSError as e:
+                        logger.error(f"Failed to write metric segment {res}/{kind}/{series_id}/{segment}: {e}")
+            with self._lock:
+                self._writing = {}
+
+    @staticmethod
+    def _write_segment(path, record_size, buf):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            # 上次写入中断留下的残缺记录会让后续记录错位，追加前先截掉
+            size = os.fstat(fd).st_size
+            if size % record_size:
+                os.ftruncate(fd, size - size % record_size)
+            os.write(fd, buf)
+        finally:
+            os.close(fd)
+
+    def enforce_retention(self, now=None):
+        """
+        删除整段都超出保留期的段文件，以及已经没有任何段的序列目录
+        """
+        now = now or time.time()
+        removed = 0
+        for res, (_, span, _) in RESOLUTIONS.items():
+            cutoff = now - RETENTION[res]
+            for kind in FIELDS:
+                kind_dir = os.path.join(self.root, res, kind)
+                if not os.path.isdir(kind_dir):
+                    continue
+                for series in os.scandir(kind_dir):
+                    if not series.is_dir():
+                        continue
+                    remaining = 0
+                    for name in os.listdir(series.path):
+                        # 只处理段文件，其他文件（如写入中的临时文件、无法解析的文件名）保留，目录也随之保留
+                        segment = _segment_start(name)
+                        if segment is None:
+                            remaining += 1
+                            continue
+                        if segment + span <= cutoff:
+                            os.remove(os.path.join(series.path, name))
+                            removed += 1
+                        else:
+                            remaining += 1
+                    if not remaining:
+                        os.rmdir(series.path)
+        # 长时间没有样本的序列不再保留内存中的累积状态
+        with self._lock:
+            idle = now - RETENTION["raw"]
+            for key in [k for k, state in self._series.items() if state["last"].get("raw", 0) < idle]:
+                del self._series[key]
+        if removed:
+            logger.info(f"Removed {removed} expired metric segments")
+        return removed
+
+    def _read_segment(self, path, record, start, end):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            size = os.fstat(fd).st_size
+            # 只读取完整的记录，忽略写入中途的残缺尾部
+            count = size // record.size
+            if not count:
+                return []
+            with mmap.mmap(fd, count * record.size, prot=mmap.PROT_READ) as buf:
+                view = _RecordView(buf, record, count)
+                lo = bisect.bisect_left(view, start)
+                hi = bisect.bisect_right(view, end)
+                return list(record.iter_unpack(buf[lo * record.size:hi * record.size]))
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_buffers(segments, record, start, end):
+        rows = []
+        for buf in segments.values():
+            rows.extend(row for row in record.iter_unpack(bytes(buf)) if start <= row[0] <= end)
+        return rows
+
+    def pick_resolution(self, start, end, now=None, max_points=MAX_POINTS):
+        """
+        选择保留期覆盖 start、且点数不超过 max_points 的最细分辨率
+        """
+        now = now or time.time()
+        for res, (step, _, _) in RESOLUTIONS.items():
+            interval = step or RAW_INTERVAL
+            if start >= now - RETENTION[res] and (end - start) / interval <= max_points:
+                return res
+        return ROLLUPS[-1]
+
+    def query(self, kind, series_id, start, end, resolution=None):
+        """
+        范围查询 [start, end]（epoch 秒），返回 {"resolution", "fields", "points": [[ts, ...], ...]}
+        :raises ValueError: 分辨率未知或序列 id 不合法时
+        """
+        validate_series_id(kind, series_id)
+        start, end = int(start), int(end)
+        res = resolution or self.pick_resolution(start, end)
+        if res not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution '{res}'")
+        record = RECORDS[kind]
+        span = RESOLUTIONS[res][1]
+        rows = []
+        directory = self._segment_dir(res, kind, series_id)
+        if os.path.isdir(directory):
+            segments = sorted(s for s in map(_segment_start, os.listdir(directory)) if s is not None)
+            for segment in segments:
+                if segment + span <= start or segment > end:
+                    continue
+                rows.extend(self._read_segment(os.path.join(directory, f"{segment}.seg"), record, start, end))
+        # 尚未落盘的记录（只有领导者进程持有）
+        with self._lock:
+            for buffers in (self._writing, self._pending):
+                rows.extend(self._read_buffers(buffers.get((res, kind, series_id), {}), record, start, end))
+        # 刚落盘的记录可能同时出现在文件和写入中的缓冲区里，按时间戳去重
+        rows = sorted({row[0]: row for row in rows}.values(), key=lambda row: row[0])
+        return {
+            "resolution": res,
+            "fields": list(FIELDS[kind]),
+            "points": [[row[0]] + [None if v != v else round(v, 2) for v in row[1:]] for row in rows],
+        }
+
+
+STORE = MetricStore(ROOT)
+
+
+def record_host(host_ip, metrics, ts=None):
+    """
+    记录一次宿主机采集结果；只有当选的采集者写入，离线结果不记录
+    """
+    if not ENABLED or not LEADER.is_leader() or metrics.get("status") == "offline":
+        return
+    disk_io = metrics.get("disk_io") or {}
+    load_avg = metrics.get("load_avg") or [None]
+    STORE.record("host", host_ip, {
+        "cpu_percent": metrics.get("cpu_percent"),
+        "iowait_percent": metrics.get("iowait_percent"),
+        "load1": load_avg[0],
+        "mem_usage_percent": metrics.get("mem_usage_percent"),
+        "mem_used_mb": metrics.get("mem_used_mb"),
+        "read_bytes_per_s": disk_io.get("read_bytes_per_s"),
+        "write_bytes_per_s": disk_io.get("write_bytes_per_s"),
+        "io_util_percent": disk_io.get("util_percent"),
+    }, ts=ts)
+
+
+def record_vm(uuid, cpu_percent, mem_usage_percent, ts=None):
+    """
+    记录一次 VM 利用率样本；只有当选的采集者写入
+    """
+    if not ENABLED or not LEADER.is_leader():
+        return
+    STORE.record("vm", uuid, {"cpu_percent": cpu_percent, "mem_usage_percent": mem_usage_percent}, ts=ts)
+
+
+def _flush_loop():
+    last_retention = time.time()
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            STORE.flush()
+            if time.time() - last_retention >= RETENTION_INTERVAL:
+                last_retention = time.time()
+                if LEADER.is_leader():
+                    STORE.enforce_retention()
+        except Exception as e:
+            logger.warning(f"Metric store maintenance failed: {e}")
+
+
+def start():
+    """
+    启动后台落盘与保留期清理线程（配置中 metric_store.enabled 为 false 时不启动）
+    """
+    global _started
+    with _start_lock:
+        if _started or not ENABLED:
+            return
+        threading.Thread(target=_flush_loop, name="metric-store", daemon=True).start()
+        _started = True
@@ -0,0 +1,120 @@
+# services/migrator.py
+
+import logging
+import os
+import threading
+import time
+
+import libvirt
+import yaml
+
+from services import inventory, libvirt_pool, placement
+from services.capacity_ledger import LEDGER
+from services.scaler import classify_error
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+MIGRATION_CONFIG = CONFIG.get('migration', {}) or {}
+URI_TEMPLATE = MIGRATION_CONFIG.get('uri_template', 'qemu+tcp://{host}/system')  # 目标宿主机 libvirtd 地址
+BANDWIDTH_MIB = MIGRATION_CONFIG.get('bandwidth_mib', 0)  # 单次迁移带宽上限（MiB/s），0 表示不限制
+MAX_CONCURRENT = MIGRATION_CONFIG.get('max_concurrent', 2)  # 每个进程同时进行的迁移数
+MIN_FREE_RATIO = MIGRATION_CONFIG.get('min_free_ratio', 0.1)  # 目标宿主机放入后至少保留的空闲比例
+AUTO_EXECUTE = MIGRATION_CONFIG.get('auto_execute', False)  # 编排器是否直接执行迁移，否则只给出建议
+
+# 在线迁移，目标端持久化定义并删除源端定义，由源端 libvirtd 直连目标端
+MIGRATE_FLAGS = (libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PEER2PEER
+                 | libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_UNDEFINE_SOURCE)
+
+_MIGRATION_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+
+def cluster_snapshot(timeout=None):
+    """
+    由清单与容量账本构建放置引擎使用的集群快照，跳过尚未加载或不可用的宿主机
+    """
+    cluster_vms = inventory.get_cluster_vms(timeout=timeout)
+    cluster = {}
+    for host_ip, status in cluster_vms["hosts"].items():
+        if status["status"] != "ok":
+            continue
+        try:
+            capacity = LEDGER.snapshot(host_ip)
+        except libvirt.libvirtError as e:
+            logger.warning(f"Skipping {host_ip} in placement: {e}")
+            continue
+        cluster[host_ip] = {"capacity": capacity, "vms": []}
+    for vm in cluster_vms["vms"]:
+        if vm["host"] in cluster:
+            cluster[vm["host"]]["vms"].append(vm)
+    return cluster
+
+
+def propose_relief(host_ip, target_uuid, need_vcpu=0, need_mem_kb=0):
+    """
+    为宿主机上容量不足的目标 VM 给出迁移建议，没有可行方案返回 None
+    """
+    cluster = cluster_snapshot()
+    if host_ip not in cluster:
+        return None
+    return placement.plan_relief(cluster, host_ip, target_uuid, need_vcpu=need_vcpu, need_mem_kb=need_mem_kb,
+                                 min_free_ratio=MIN_FREE_RATIO)
+
+
+def _keep_reserved(reservation_id, done):
+    """迁移进行期间每半个有效期续期一次预留，避免迁移耗时超过 reservation_ttl 后被回收"""
+    while not done.wait(LEDGER.reservation_ttl / 2):
+        LEDGER.renew(reservation_id)
+
+
+def migrate(proposal):
+    """
+    按建议执行在线迁移（migrateToURI3），受本进程并发数（MAX_CONCURRENT）和带宽限制。
+    取得并发名额后才在目标宿主机的容量账本中预留资源，迁移期间持续续期，失败时释放。
+    返回 {"success", "uuid", "source", "dest", "duration_ms", "error_class", "error"}
+    """
+    result = {
+        "success": False,
+        "uuid": proposal["uuid"],
+        "source": proposal["source"],
+        "dest": proposal["dest"],
+        "duration_ms": 0,
+        "error_class": None,
+        "error": None,
+    }
+    params = {}
+    if BANDWIDTH_MIB:
+        params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH] = BANDWIDTH_MIB
+    dest_uri = URI_TEMPLATE.format(host=proposal["dest"])
+
+    with _MIGRATION_SLOTS:
+        reservation = LEDGER.reserve(proposal["dest"], vcpu=proposal["vcpu"], mem_kb=proposal["mem_kb"])
+        if reservation is None:
+            result["error_class"] = "capacity"
+            result["error"] = f"host {proposal['dest']} no longer has capacity"
+            return result
+
+        done = threading.Event()
+        threading.Thread(target=_keep_reserved, args=(reservation["id"], done), name="migration-lease",
+                         daemon=True).start()
+        started = time.time()
+        try:
+            domain = libvirt_pool.get_connection(proposal["source"]).lookupByUUIDString(proposal["uuid"])
+            logger.info(f"Migrating {proposal['name']} from {proposal['source']} to {dest_uri}")
+            domain.migrateToURI3(dest_uri, params, MIGRATE_FLAGS)
+            result["success"] = True
+        except Exception as e:
+            result["error_class"] = classify_error(e)
+            result["error"] = str(e)
+            logger.error(f"Migration of {proposal['name']} to {proposal['dest']} failed: {e}")
+        finally:
+            done.set()
+            result["duration_ms"] = int((time.time() - started) * 1000)
+            if result["success"]:
+                LEDGER.commit(reservation["id"])
+            else:
+                LEDGER.release(reservation["id"])
+    return result
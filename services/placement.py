@@ -0,0 +1,110 @@
+# services/placement.py
+
+# 集群放置引擎：只处理快照数据（不访问宿主机），可以直接用构造的集群快照离线验证。
+# 集群快照格式：
+# {
+#     host_ip: {
+#         "capacity": {"total_vcpu", "total_mem_kb", "free_vcpu", "free_mem_kb", ...},  # 容量账本汇总
+#         "vms": [vm_record, ...],  # 清单记录，policy 字段中可带 anti_affinity_group
+#     }
+# }
+
+DEFAULT_POLICY = {"priority": 99, "anti_affinity_group": ""}
+
+
+def _policy(vm):
+    return {**DEFAULT_POLICY, **(vm.get("policy") or {})}
+
+
+def _groups(vms):
+    return {_policy(vm)["anti_affinity_group"] for vm in vms} - {""}
+
+
+def fits(capacity, vcpu, mem_kb, min_free_ratio=0.0):
+    """
+    放入 vcpu / mem_kb 后，宿主机仍保留至少 min_free_ratio 的空闲容量
+    """
+    return (capacity["free_vcpu"] - vcpu >= capacity["total_vcpu"] * min_free_ratio
+            and capacity["free_mem_kb"] - mem_kb >= capacity["total_mem_kb"] * min_free_ratio)
+
+
+def placement_score(capacity, vcpu, mem_kb):
+    """
+    二维 best-fit 得分：放入后剩余的 CPU / 内存占比的平方和，越小越紧凑。
+    两个维度同时考虑，避免把 CPU 密集型 VM 放到只剩内存的宿主机上。
+    """
+    left_cpu = (capacity["free_vcpu"] - vcpu) / max(capacity["total_vcpu"], 1)
+    left_mem = (capacity["free_mem_kb"] - mem_kb) / max(capacity["total_mem_kb"], 1)
+    return left_cpu ** 2 + left_mem ** 2
+
+
+def best_host(cluster, vm, vcpu, mem_kb, exclude=(), min_free_ratio=0.0):
+    """
+    为 VM 选择目标宿主机：容量足够、不违反反亲和组、得分最小。没有合适的宿主机返回 None。
+    """
+    group = _policy(vm)["anti_affinity_group"]
+    best = None
+    for host_ip, host in cluster.items():
+        if host_ip in exclude:
+            continue
+        if group and group in _groups(v for v in host["vms"] if v["uuid"] != vm["uuid"]):
+            continue
+        if not fits(host["capacity"], vcpu, mem_kb, min_free_ratio):
+            continue
+        score = placement_score(host["capacity"], vcpu, mem_kb)
+        if best is None or score < best[0]:
+            best = (score, host_ip)
+    return best[1] if best else None
+
+
+def _proposal(vm, source, dest, vcpu, mem_kb, reason):
+    return {
+        "uuid": vm["uuid"],
+        "name": vm["name"],
+        "source": source,
+        "dest": dest,
+        "vcpu": vcpu,
+        "mem_kb": mem_kb,
+        "reason": reason,
+        # 迁移开销主要取决于需要拷贝的内存量
+        "cost_mem_kb": vm["curr_mem_kb"],
+    }
+
+
+def plan_relief(cluster, host_ip, target_uuid, need_vcpu=0, need_mem_kb=0, min_free_ratio=0.0):
+    """
+    宿主机容量不足时，规划一次迁移来满足目标 VM 的扩容：
+      - 把扩容后的目标 VM 整体迁到其他宿主机；或
+      - 把一台优先级更低的邻居迁走，腾出足够的本地容量
+    在所有可行方案中选迁移内存最少的一个，都不可行返回 None。
+    """
+    source = cluster[host_ip]
+    target = next((vm for vm in source["vms"] if vm["uuid"] == target_uuid), None)
+    if target is None:
+        return None
+    target_priority = _policy(target)["priority"]
+    shortfall_vcpu = max(need_vcpu - source["capacity"]["free_vcpu"], 0)
+    shortfall_mem_kb = max(need_mem_kb - source["capacity"]["free_mem_kb"], 0)
+
+    proposals = []
+    vcpu, mem_kb = target["curr_vcpu"] + need_vcpu, target["curr_mem_kb"] + need_mem_kb
+    dest = best_host(cluster, target, vcpu, mem_kb, exclude=(host_ip,), min_free_ratio=min_free_ratio)
+    if dest:
+        proposals.append(_proposal(target, host_ip, dest, vcpu, mem_kb, "move_target"))
+
+    for vm in source["vms"]:
+        if vm["uuid"] == target_uuid or vm["state"] != "running":
+            continue
+        if _policy(vm)["priority"] <= target_priority:
+            continue
+        if vm["curr_vcpu"] < shortfall_vcpu or vm["curr_mem_kb"] < shortfall_mem_kb:
+            continue
+        dest = best_host(cluster, vm, vm["curr_vcpu"], vm["curr_mem_kb"], exclude=(host_ip,),
+                         min_free_ratio=min_free_ratio)
+        if dest:
+            proposals.append(_proposal(vm, host_ip, dest, vm["curr_vcpu"], vm["curr_mem_kb"], "move_neighbour"))
+
+    if not proposals:
+        return None
+    # 迁移内存相同时，优先迁走邻居（目标 VM 正在承压，迁移期间性能更差）
+    return min(proposals, key=lambda p: (p["cost_mem_kb"], p["reason"] == "move_target"))
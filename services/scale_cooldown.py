@@ -0,0 +1,67 @@
+# services/scale_cooldown.py
+
+import logging
+import threading
+import time
+
+import redis
+
+from services.vm_locator import redis_client
+
+logger = logging.getLogger(__name__)
+
+# 同一台 VM 两次扩容的最小间隔（秒），告警扩容与预测扩容共用
+SCALE_COOLDOWN = 300
+COOLDOWN_KEY_PREFIX = "kvm_scale:cooldown:"
+
+# 冷却状态存放在 Redis 中，由所有 worker 共享；Redis 不可用时退回以下进程内缓存
+last_scale_time = {}  # { vm_uuid: timestamp }
+_COOLDOWN_LOCK = threading.Lock()
+
+
+def claim(vm_uuid, now=None):
+    """
+    原子地占用 VM 的扩容冷却期（Redis SET NX EX），已在冷却中返回 False
+    """
+    now = now or time.time()
+    try:
+        return bool(redis_client.set(f"{COOLDOWN_KEY_PREFIX}{vm_uuid}", now, nx=True, ex=SCALE_COOLDOWN))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for cooldown of {vm_uuid}, using local state: {e}")
+    with _COOLDOWN_LOCK:
+        if now - last_scale_time.get(vm_uuid, 0) < SCALE_COOLDOWN:
+            return False
+        last_scale_time[vm_uuid] = now
+        return True
+
+
+def is_cooling(vm_uuid, now=None):
+    """
+    VM 是否在冷却期内（只查询，不占用），用于提交任务前提前过滤
+    """
+    now = now or time.time()
+    try:
+        return bool(redis_client.exists(f"{COOLDOWN_KEY_PREFIX}{vm_uuid}"))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for cooldown of {vm_uuid}, using local state: {e}")
+    with _COOLDOWN_LOCK:
+        return now - last_scale_time.get(vm_uuid, 0) < SCALE_COOLDOWN
+
+
+def release(vm_uuid):
+    """
+    没有执行扩容或扩容失败时释放冷却期，下一次扩容可以立即进行
+    """
+    try:
+        redis_client.delete(f"{COOLDOWN_KEY_PREFIX}{vm_uuid}")
+    except redis.RedisError as e:
+        logger.warning(f"Failed to release cooldown of {vm_uuid}: {e}")
+    with _COOLDOWN_LOCK:
+        last_scale_time.pop(vm_uuid, None)
+
+
+def job_key(vm_uuid):
+    """
+    同一台 VM 的扩容任务（告警或预测）使用同一个任务键，在任务队列中串行执行
+    """
+    return f"vm:{vm_uuid}"
@@ -1,18 +1,128 @@
 # services/scaler.py
 
-import subprocess
 import logging
+import time
+from xml.etree import ElementTree as ET
+
+import libvirt
+
+from services import libvirt_pool
 
 logger = logging.getLogger(__name__)
 
+# 在线 + 持久化同时生效
+LIVE_AND_CONFIG = libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG
+
+
+def classify_error(error):
+    """
+    将异常归类，便于调用方区分重试策略
+    """
+    if not isinstance(error, libvirt.libvirtError):
+        return "connection"
+    code = error.get_error_code()
+    if code == libvirt.VIR_ERR_NO_DOMAIN:
+        return "not_found"
+    if code in (libvirt.VIR_ERR_NO_SUPPORT, libvirt.VIR_ERR_OPERATION_UNSUPPORTED):
+        return "unsupported"
+    if code in (libvirt.VIR_ERR_INVALID_ARG, libvirt.VIR_ERR_OPERATION_INVALID,
+                libvirt.VIR_ERR_CONFIG_UNSUPPORTED):
+        return "invalid_argument"
+    if code in (libvirt.VIR_ERR_SYSTEM_ERROR, libvirt.VIR_ERR_RPC, libvirt.VIR_ERR_NO_CONNECT):
+        return "connection"
+    return "libvirt"
+
+
+def _apply(domain, setter, value):
+    """
+    先按在线 + 持久化调整；虚拟机未运行时只能改持久化配置。
+    返回实际使用的 flags，用于随后的校验。
+    """
+    try:
+        setter(value, LIVE_AND_CONFIG)
+        return libvirt.VIR_DOMAIN_AFFECT_LIVE
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID or domain.isActive():
+            raise
+    setter(value, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+    return libvirt.VIR_DOMAIN_AFFECT_CONFIG
+
+
+def _persistent_memory_kb(domain):
+    """
+    持久化定义中的当前内存（KiB）。在线调整后气球异步生效，info() 可能仍是旧值，
+    而持久化定义在 setMemoryFlags 返回时已经更新，用它校验调整结果。
+    """
+    root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    elem = root.find('currentMemory')
+    if elem is None:
+        elem = root.find('memory')
+    # libvirt 输出的内存单位固定为 KiB
+    return int(elem.text)
+
+
+def _resize(host_ip, lookup, vm, resource, requested):
+    """
+    在连接池的 libvirt 连接上直接调整资源并校验，返回结构化结果：
+    {
+        'success': bool, 'host', 'vm', 'resource': 'vcpu'|'memory',
+        'requested', 'applied', 'duration_ms', 'error_class', 'error'
+    }
+    """
+    started = time.monotonic()
+    result = {
+        "success": False,
+        "host": host_ip,
+        "vm": vm,
+        "resource": resource,
+        "requested": requested,
+        "applied": None,
+        "duration_ms": 0,
+        "error_class": None,
+        "error": None,
+    }
+    try:
+        conn = libvirt_pool.get_connection(host_ip)
+        domain = lookup(conn, vm)
+        if resource == "vcpu":
+            flags = _apply(domain, domain.setVcpusFlags, requested)
+            applied = domain.vcpusFlags(flags)
+        else:
+            _apply(domain, domain.setMemoryFlags, requested)
+            applied = _persistent_memory_kb(domain)
+        result["applied"] = applied
+        if applied == requested:
+            result["success"] = True
+        else:
+            result["error_class"] = "verify_failed"
+            result["error"] = f"requested {requested}, host reports {applied}"
+    except Exception as e:
+        result["error_class"] = classify_error(e)
+        result["error"] = str(e)
+    result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+    if result["success"]:
+        logger.info(f"Resized {resource} of {vm} on {host_ip} to {requested} in {result['duration_ms']}ms")
+    else:
+        logger.error(f"Failed to resize {resource} of {vm} on {host_ip}: "
+                     f"[{result['error_class']}] {result['error']}")
+    return result
+
+
+def _by_name(conn, vm_name):
+    return conn.lookupByName(vm_name)
+
+
+def _by_uuid(conn, vm_uuid):
+    return conn.lookupByUUIDString(vm_uuid)
+
+
 def scale_vm_cpu(vm_name, host_ip, new_cpu_count):
     """
     调整虚拟机 CPU 数量（需支持热插拔）
     """
     logger.info(f"Scaling VM {vm_name} on {host_ip} to {new_cpu_count} CPUs")
-
-    cmd = f"ssh root@{host_ip} 'virsh setvcpus {vm_name} {new_cpu_count} --live --config'"
-    return run_command(cmd)
+    return _resize(host_ip, _by_name, vm_name, "vcpu", new_cpu_count)
 
 
 def scale_vm_memory(vm_name, host_ip, new_mem_gb):
@@ -21,28 +131,22 @@ def scale_vm_memory(vm_name, host_ip, new_mem_gb):
     """
     logger.info(f"Scaling VM {vm_name} on {host_ip} to {new_mem_gb} GB memory")
 
-    # 注意：单位转换为 MB
-    mem_mb = new_mem_gb * 1024
-    cmd = f"ssh root@{host_ip} 'virsh setmem {vm_name} {mem_mb}M --live --config'"
-    return run_command(cmd)
+    # 注意：libvirt 以 KiB 为单位
+    mem_kb = int(new_mem_gb * 1024 * 1024)
+    return _resize(host_ip, _by_name, vm_name, "memory", mem_kb)
 
 
-def run_command(cmd):
-    try:
-        result = subprocess.run(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=30
-        )
-        if result.returncode == 0:
-            logger.info(f"Command succeeded: {result.stdout}")
-            return True
-        else:
-            logger.error(f"Command failed: {result.stderr}")
-            return False
-    except Exception as e:
-        logger.exception(f"Error executing command: {e}")
-        return False
+def adjust_vcpu(host_ip, vm_uuid, new_cpu_count):
+    """
+    按 UUID 调整 vCPU 数量（在线 + 持久化）
+    """
+    logger.info(f"Adjusting VM {vm_uuid} on {host_ip} to {new_cpu_count} vCPUs")
+    return _resize(host_ip, _by_uuid, vm_uuid, "vcpu", new_cpu_count)
+
+
+def adjust_memory(host_ip, vm_uuid, new_mem_kb):
+    """
+    按 UUID 调整当前内存（KiB，在线 + 持久化）
+    """
+    logger.info(f"Adjusting VM {vm_uuid} on {host_ip} to {new_mem_kb} KiB memory")
+    return _resize(host_ip, _by_uuid, vm_uuid, "memory", new_mem_kb)
@@ -1,6 +1,7 @@
 # services/scaling_orchestrator.py
 import libvirt
-from . import kvm_inspector, scaler, monitoring_agent, server_manager
+from . import kvm_inspector, scaler, compression_planner, migrator
+from .capacity_ledger import LEDGER
 
 
 def handle_scaling_request(vm_name: str, host_ip: str, alert: dict):
@@ -11,102 +12,108 @@ def handle_scaling_request(vm_name: str, host_ip: str, alert: dict):
     # [1] 告警已触发 (由调用方完成)
     print(f"--- Starting Scaling Orchestration for VM '{vm_name}' on Host '{host_ip}' ---")
 
-    conn = None
+    # 连接来自进程级连接池，复用且不在此处关闭
     try:
         conn = kvm_inspector.connect_libvirt(host_ip)
-        if not conn:
-            return {"status": "error", "message": f"Could not connect to libvirt on {host_ip}"}
-
-        # 通过名称查找目标虚拟机
-        try:
-            target_domain = conn.lookupByName(vm_name)
-        except libvirt.libvirtError:
-            return {"status": "error", "message": f"VM '{vm_name}' not found on host '{host_ip}'"}
-
-        # [2] 判断 vm01 当前资源与最大限制
-        policy = kvm_inspector.get_vm_policy_from_metadata(target_domain)
-        current_vcpu = target_domain.info()[3]
-        max_vcpu = policy.get('max_vcpu', current_vcpu)
-        scale_step_cpu = policy.get('scale_step_cpu', 1)
-
-        if current_vcpu >= max_vcpu:
-            return {"status": "skipped", "message": f"VM '{vm_name}' is already at its max vCPU limit ({max_vcpu})."}
-
-        needed_cpus = scale_step_cpu
-        print(f"Step [2]: VM '{vm_name}' needs {needed_cpus} more vCPU(s). Current: {current_vcpu}, Max: {max_vcpu}.")
-
-        # [3] 判断宿主机剩余资源是否可扩容
-        if kvm_inspector.check_host_has_enough_resources(conn, needed_cpus):
-            print(f"Step [3]: Host '{host_ip}' has enough resources.")
-            # [6] 执行扩容
-            new_vcpu_count = current_vcpu + needed_cpus
-            print(f"Step [6]: Scaling up '{vm_name}' to {new_vcpu_count} vCPUs...")
-            success = scaler.adjust_vcpu(host_ip, target_domain.UUIDString(), new_vcpu_count)
-            return {"status": "success" if success else "error", "action": "scaled_up_directly"}
-
-        # [4] 宿主机资源不足 -> 找可降级的 VM
-        print(f"Step [3/4]: Host '{host_ip}' has insufficient resources. Finding victim VMs to compress...")
-
-        victim_vms = _find_compressible_vms(conn, vm_name, policy.get('priority', 99))
-        if not victim_vms:
-            return {"status": "failed", "message": "Host has no resources, and no compressible VMs found."}
-
-        # [5] 动态压缩它们，释放资源
-        freed_cpus = 0
-        for victim in victim_vms:
-            if freed_cpus >= needed_cpus:
-                break
-            freed_cpus += _compress_vm(host_ip, victim)
-
-        print(f"Step [5]: Freed up a total of {freed_cpus} vCPUs.")
-
-        # [6] 回来重新判断是否够
-        if kvm_inspector.check_host_has_enough_resources(conn, needed_cpus):
-            print("Step [6] (Post-compression): Host now has enough resources.")
-            new_vcpu_count = current_vcpu + needed_cpus
-            print(f"Step [6]: Scaling up '{vm_name}' to {new_vcpu_count} vCPUs...")
-            success = scaler.adjust_vcpu(host_ip, target_domain.UUIDString(), new_vcpu_count)
-            return {"status": "success" if success else "error", "action": "scaled_up_after_compression"}
-        else:
-            return {"status": "failed", "message": "Failed to free up enough resources by compressing other VMs."}
-
-    finally:
-        if conn:
-            conn.close()
-
-
-def _find_compressible_vms(conn: libvirt.virConnect, target_vm_name: str, target_priority: int):
-    """找到所有比目标VM优先级低的、非空闲的、可压缩的VM"""
-    compressible_vms = []
-    all_domains = conn.listAllDomains()
-    for domain in all_domains:
-        if not domain.isActive() or domain.name() == target_vm_name:
-            continue
-
-        policy = kvm_inspector.get_vm_policy_from_metadata(domain)
-        priority = policy.get('priority', 99)
-        usage = monitoring_agent.get_vm_resource_usage(domain)  # 复用我们的监控agent
-
-        # 优先级更低，且CPU使用率低于缩容阈值（即“空闲”）
-        if priority > target_priority and usage and usage['memory_usage_percent'] < policy.get('cpu_threshold_low', 20):
-            compressible_vms.append(domain)
-
-    # 按优先级从高到低排序（即优先压缩优先级最低的）
-    compressible_vms.sort(key=lambda d: kvm_inspector.get_vm_policy_from_metadata(d).get('priority', 99), reverse=True)
-    return compressible_vms
-
-
-def _compress_vm(host_ip: str, domain: libvirt.virDomain) -> int:
-    """压缩单个VM，返回释放的CPU数量"""
-    policy = kvm_inspector.get_vm_policy_from_metadata(domain)
-    current_vcpu = domain.info()[3]
-    min_vcpu = policy.get('min_vcpu', 1)
-    scale_step = policy.get('scale_step_cpu', 1)
-
-    if current_vcpu > min_vcpu:
-        new_vcpu_count = max(current_vcpu - scale_step, min_vcpu)
-        print(f"Compressing VM '{domain.name()}' from {current_vcpu} to {new_vcpu_count} vCPUs...")
-        success = kvm_scaler.adjust_vcpu(host_ip, domain.UUIDString(), new_vcpu_count)
-        if success:
-            return current_vcpu - new_vcpu_count
-    return 0
\ No newline at end of file
+    except Exception as e:
+        return {"status": "error", "message": f"Could not connect to libvirt on {host_ip}: {e}"}
+
+    # 通过名称查找目标虚拟机
+    try:
+        target_domain = conn.lookupByName(vm_name)
+    except libvirt.libvirtError:
+        return {"status": "error", "message": f"VM '{vm_name}' not found on host '{host_ip}'"}
+
+    # [2] 判断 vm01 当前资源与最大限制
+    policy = kvm_inspector.get_vm_policy_from_metadata(target_domain)
+    current_vcpu = target_domain.info()[3]
+    max_vcpu = policy.get('max_vcpu', current_vcpu)
+    scale_step_cpu = policy.get('scale_step_cpu', 1)
+
+    if current_vcpu >= max_vcpu:
+        return {"status": "skipped", "message": f"VM '{vm_name}' is already at its max vCPU limit ({max_vcpu})."}
+
+    needed_cpus = scale_step_cpu
+    print(f"Step [2]: VM '{vm_name}' needs {needed_cpus} more vCPU(s). Current: {current_vcpu}, Max: {max_vcpu}.")
+
+    # [3] 判断宿主机剩余资源是否可扩容：在容量账本中原子预留，并发的扩容不会看到同一份空闲容量
+    uuid = target_domain.UUIDString()
+    reservation = LEDGER.reserve(host_ip, vcpu=needed_cpus, uuid=uuid)
+    if reservation:
+        print(f"Step [3]: Host '{host_ip}' has enough resources.")
+        # [6] 执行扩容
+        return _scale_up_reserved(host_ip, vm_name, uuid, current_vcpu, needed_cpus, reservation,
+                                  "scaled_up_directly")
+
+    # [4] 宿主机资源不足 -> 找可降级的 VM
+    print(f"Step [3/4]: Host '{host_ip}' has insufficient resources. Finding victim VMs to compress...")
+
+    plan = compression_planner.plan_compression(host_ip, need_vcpu=needed_cpus, target_uuid=uuid,
+                                                target_priority=policy.get('priority', 99))
+    if not plan["feasible"]:
+        # 本机压缩也不够时，尝试借用集群中其他宿主机的容量
+        return _relieve_by_migration(host_ip, vm_name, uuid, current_vcpu, needed_cpus)
+    print(f"Step [4]: Planned compression of {len(plan['actions'])} VM(s) in {plan['planning_ms']} ms.")
+
+    # [5] 动态压缩它们，释放资源（各 VM 并行执行）
+    outcomes = compression_planner.execute_plan(plan)
+    freed_cpus = sum(action["from_vcpu"] - action["to_vcpu"]
+                     for action, outcome in zip(plan["actions"], outcomes) if outcome["success"])
+
+    print(f"Step [5]: Freed up a total of {freed_cpus} vCPUs.")
+
+    # [6] 回来重新判断是否够（压缩释放的资源已记入账本）
+    reservation = LEDGER.reserve(host_ip, vcpu=needed_cpus, uuid=uuid)
+    if reservation:
+        print("Step [6] (Post-compression): Host now has enough resources.")
+        return _scale_up_reserved(host_ip, vm_name, uuid, current_vcpu, needed_cpus, reservation,
+                                  "scaled_up_after_compression")
+    else:
+        return {"status": "failed", "message": "Failed to free up enough resources by compressing other VMs."}
+
+
+def _scale_up_reserved(host_ip, vm_name, uuid, current_vcpu, needed_cpus, reservation, action):
+    """执行已预留容量的扩容：成功则提交预留，失败则释放"""
+    new_vcpu_count = current_vcpu + needed_cpus
+    print(f"Step [6]: Scaling up '{vm_name}' to {new_vcpu_count} vCPUs...")
+    try:
+        result = scaler.adjust_vcpu(host_ip, uuid, new_vcpu_count)
+    except Exception:
+        LEDGER.release(reservation["id"])
+        raise
+    if result["success"]:
+        LEDGER.commit(reservation["id"], vcpu=result["applied"] - current_vcpu)
+    else:
+        LEDGER.release(reservation["id"])
+    return {"status": "success" if result["success"] else "error", "action": action, "result": result}
+
+
+def _relieve_by_migration(host_ip, vm_name, uuid, current_vcpu, needed_cpus):
+    """把目标 VM 或低优先级邻居迁到集群中更合适的宿主机；未开启自动执行时只返回建议"""
+    proposal = migrator.propose_relief(host_ip, uuid, need_vcpu=needed_cpus)
+    if proposal is None:
+        return {"status": "failed",
+                "message": "Host has no resources, and neither compression nor migration can free enough."}
+    print(f"Step [4]: Proposed migrating '{proposal['name']}' from {proposal['source']} to {proposal['dest']}.")
+    if not migrator.AUTO_EXECUTE:
+        return {"status": "proposed", "action": "migration", "proposal": proposal}
+
+    migration = migrator.migrate(proposal)
+    if not migration["success"]:
+        return {"status": "error", "action": "migration", "proposal": proposal, "result": migration}
+
+    if proposal["reason"] == "move_target":
+        # 目标宿主机的容量已按扩容后的规格预留，直接扩容
+        print(f"Step [6]: Scaling up '{vm_name}' to {current_vcpu + needed_cpus} vCPUs on {proposal['dest']}...")
+        result = scaler.adjust_vcpu(proposal["dest"], uuid, current_vcpu + needed_cpus)
+        return {"status": "success" if result["success"] else "error", "action": "scaled_up_after_migration",
+                "migration": migration, "result": result}
+
+    reservation = LEDGER.reserve(host_ip, vcpu=needed_cpus, uuid=uuid)
+    if not reservation:
+        return {"status": "failed", "action": "migration", "migration": migration,
+                "message": "Capacity freed by migration was taken by another request."}
+    response = _scale_up_reserved(host_ip, vm_name, uuid, current_vcpu, needed_cpus, reservation,
+                                  "scaled_up_after_migration")
+    response["migration"] = migration
+    return response
@@ -0,0 +1,263 @@
+# services/usage_sampler.py
+
+import os
+import threading
+import time
+from array import array
+
+import yaml
+
+from utils.shared_snapshot import build_snapshot
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+SAMPLER_CONFIG = CONFIG.get('usage_sampler', {}) or {}
+SAMPLE_INTERVAL = SAMPLER_CONFIG.get('sample_interval', 10)  # 采样间隔，单位秒
+WINDOWS = sorted(SAMPLER_CONFIG.get('windows', [10, 60, 300]))  # 利用率计算窗口，单位秒
+# 环形缓冲区容量：覆盖最大窗口再多留两个点
+CAPACITY = max(WINDOWS) // SAMPLE_INTERVAL + 2
+# 长周期历史（供预测使用）：按 HISTORY_BUCKET 秒聚合成均值，保留 HISTORY_DAYS 天
+HISTORY_BUCKET = SAMPLER_CONFIG.get('history_bucket', 300)
+HISTORY_DAYS = SAMPLER_CONFIG.get('history_days', 8)
+HISTORY_CAPACITY = HISTORY_DAYS * 86400 // HISTORY_BUCKET
+
+
+class CpuRingBuffer:
+    """
+    定长、基于 array 的环形缓冲区，记录 (timestamp, cpu_time, vcpu_count)。
+    每个 VM 占用固定内存（约 CAPACITY * 18 字节），与运行时长无关。
+    """
+
+    __slots__ = ("timestamps", "cpu_times", "vcpus", "head", "size")
+
+    def __init__(self, capacity=CAPACITY):
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.cpu_times = array('q', bytes(8 * capacity))
+        self.vcpus = array('H', bytes(2 * capacity))
+        self.head = 0  # 下一个写入位置
+        self.size = 0
+
+    def append(self, ts, cpu_time, vcpu_count):
+        capacity = len(self.timestamps)
+        self.timestamps[self.head] = ts
+        self.cpu_times[self.head] = cpu_time
+        self.vcpus[self.head] = vcpu_count
+        self.head = (self.head + 1) % capacity
+        if self.size < capacity:
+            self.size += 1
+
+    def _index(self, age):
+        """age=0 为最新样本，age=size-1 为最旧样本"""
+        return (self.head - 1 - age) % len(self.timestamps)
+
+    def latest_ts(self):
+        return self.timestamps[self._index(0)] if self.size else 0.0
+
+    def utilisation(self, window):
+        """
+        计算最近 window 秒内的 CPU 利用率（%，按 vCPU 数归一化到 0~100）。
+        样本不足两个时返回 None；历史不足一个窗口时按已有跨度计算。
+        """
+        if self.size < 2:
+            return None
+        newest = self._index(0)
+        base = self._index(self.size - 1)
+        for age in range(1, self.size):
+            idx = self._index(age)
+            # 允许半个采样间隔的抖动
+            if self.timestamps[newest] - self.timestamps[idx] >= window - SAMPLE_INTERVAL / 2:
+                base = idx
+                break
+        return _percent(self.timestamps[base], self.cpu_times[base],
+                        self.timestamps[newest], self.cpu_times[newest], self.vcpus[newest])
+
+    def history(self):
+        """
+        相邻样本两两求差得到的利用率序列 [(timestamp, percent), ...]，按时间升序
+        """
+        points = []
+        for age in range(self.size - 2, -1, -1):
+            prev, curr = self._index(age + 1), self._index(age)
+            percent = _percent(self.timestamps[prev], self.cpu_times[prev],
+                               self.timestamps[curr], self.cpu_times[curr], self.vcpus[curr])
+            if percent is not None:
+                points.append((self.timestamps[curr], percent))
+        return points
+
+
+class UsageHistory:
+    """
+    长周期的 CPU / 内存利用率序列，定长 array 环形存储，每个桶一个均值。
+    槽位由桶序号取模决定，buckets 中记录槽位实际对应的桶序号，用于识别缺失的桶。
+    每个 VM 占用固定内存（约 HISTORY_CAPACITY * 16 字节）。
+    """
+
+    __slots__ = ("buckets", "cpu", "mem", "current", "cpu_sum", "mem_sum", "count")
+
+    def __init__(self, capacity=HISTORY_CAPACITY):
+        self.buckets = array('q', [-1]) * capacity
+        self.cpu = array('f', bytes(4 * capacity))
+        self.mem = array('f', bytes(4 * capacity))
+        self.current = -1  # 正在累积的桶序号
+        self.cpu_sum = self.mem_sum = 0.0
+        self.count = 0
+
+    def add(self, ts, cpu_percent, mem_percent):
+        bucket = int(ts // HISTORY_BUCKET)
+        if bucket != self.current:
+            self._flush()
+            self.current = bucket
+        self.cpu_sum += cpu_percent
+        self.mem_sum += mem_percent
+        self.count += 1
+
+    def _flush(self):
+        if not self.count:
+            return
+        slot = self.current % len(self.buckets)
+        self.buckets[slot] = self.current
+        self.cpu[slot] = self.cpu_sum / self.count
+        self.mem[slot] = self.mem_sum / self.count
+        self.cpu_sum = self.mem_sum = 0.0
+        self.count = 0
+
+    def last_bucket(self):
+        return self.current
+
+    def export(self):
+        """
+        返回已完成各桶的副本 (buckets, cpu, mem)，正在累积的桶不包含在内
+        """
+        return array('q', self.buckets), array('f', self.cpu), array('f', self.mem)
+
+
+def _percent(t0, cpu0, t1, cpu1, vcpu_count):
+    elapsed = t1 - t0
+    # cpu_time 回退说明虚拟机重启过，本段差值无意义
+    if elapsed <= 0 or cpu1 < cpu0 or not vcpu_count:
+        return None
+    percent = (cpu1 - cpu0) * 100.0 / (elapsed * 1e9 * vcpu_count)
+    return round(min(percent, 100.0), 2)
+
+
+def window_label(seconds):
+    """10 -> '10s', 60 -> '1m', 300 -> '5m'"""
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+# { uuid: CpuRingBuffer }
+_SERIES = {}
+# { uuid: UsageHistory }
+_HISTORY = {}
+_LOCK = threading.Lock()
+# 只有领导者采样，其他 worker 通过共享快照读取各窗口利用率与环形缓冲区内的历史
+SHARED_USAGE = build_snapshot("usage")
+
+
+def current_bucket(ts=None):
+    return int((ts or time.time()) // HISTORY_BUCKET)
+
+
+def record(uuid, cpu_time, vcpu_count, ts=None):
+    """
+    记录一次 CPU 时间样本（cpu_time 单位纳秒，来自 cpu.time / getCPUStats）。
+    只应由采样线程按 SAMPLE_INTERVAL 调用：CAPACITY 按该间隔计算，额外的样本会挤掉最大窗口需要的旧样本
+    """
+    ts = ts or time.time()
+    with _LOCK:
+        ring = _SERIES.get(uuid)
+        if ring is None:
+            ring = CpuRingBuffer()
+            _SERIES[uuid] = ring
+        # 同一时刻的重复样本（如事件刷新与定时采样撞车）只保留一个
+        if ring.size and ts - ring.latest_ts() < 1:
+            return
+        ring.append(ts, cpu_time, vcpu_count)
+
+
+def record_usage(uuid, cpu_percent, mem_percent, ts=None):
+    """
+    记录一次 CPU / 内存利用率（%）到长周期历史
+    """
+    ts = ts or time.time()
+    with _LOCK:
+        history = _HISTORY.get(uuid)
+        if history is None:
+            history = UsageHistory()
+            _HISTORY[uuid] = history
+        history.add(ts, cpu_percent, mem_percent)
+
+
+def export_history(uuids=None):
+    """
+    导出长周期历史的副本 {uuid: (buckets, cpu, mem)}，uuids 为 None 时导出全部
+    """
+    with _LOCK:
+        uuids = list(_HISTORY) if uuids is None else [u for u in uuids if u in _HISTORY]
+        return {uuid: _HISTORY[uuid].export() for uuid in uuids}
+
+
+def get_usage(uuid):
+    """
+    返回各窗口的 CPU 利用率，如 {'10s': 12.5, '1m': 10.1, '5m': None}
+    """
+    with _LOCK:
+        ring = _SERIES.get(uuid)
+        return {window_label(w): ring.utilisation(w) if ring else None for w in WINDOWS}
+
+
+def get_cpu_percent(uuid):
+    """
+    最短窗口的 CPU 利用率，样本不足时返回 0.0
+    """
+    with _LOCK:
+        ring = _SERIES.get(uuid)
+        value = ring.utilisation(WINDOWS[0]) if ring else None
+    return value if value is not None else 0.0
+
+
+def get_history(uuid):
+    """
+    返回某台 VM 环形缓冲区内的利用率历史，未采样过返回 None
+    """
+    with _LOCK:
+        ring = _SERIES.get(uuid)
+        return ring.history() if ring else None
+
+
+def publish_shared():
+    """
+    领导者每轮采样后调用：发布各 VM 的窗口利用率与环形缓冲区内的历史
+    """
+    with _LOCK:
+        data = {uuid: {"usage": {window_label(w): ring.utilisation(w) for w in WINDOWS}, "history": ring.history()}
+                for uuid, ring in _SERIES.items()}
+    SHARED_USAGE.publish(data)
+
+
+def read_shared(uuid):
+    """
+    从共享快照读取某台 VM 的 {"usage", "history"}，领导者尚未发布或没有该 VM 时返回 None
+    """
+    return (SHARED_USAGE.read() or {}).get(uuid)
+
+
+def prune(max_age=None):
+    """
+    清理长时间没有新样本的 VM（已删除、已关机或已迁走），保证内存有界
+    """
+    max_age = max_age or max(WINDOWS) * 2
+    now = time.time()
+    with _LOCK:
+        for uuid in [u for u, ring in _SERIES.items() if now - ring.latest_ts() > max_age]:
+            del _SERIES[uuid]
+        # 长周期历史在整个保留期内都没有新数据时才清理
+        oldest = current_bucket(now) - HISTORY_CAPACITY
+        for uuid in [u for u, history in _HISTORY.items() if history.last_bucket() < oldest]:
+            del _HISTORY[uuid]
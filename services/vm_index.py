@@ -0,0 +1,185 @@
+# services/vm_index.py
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import yaml
+
+from utils.leader import LEADER
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+INDEX_CONFIG = CONFIG.get('vm_index', {}) or {}
+# 索引持久化文件（相对路径基于项目根目录），重启后可直接用上次的索引预热
+PERSIST_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            INDEX_CONFIG.get('persist_path', 'data/vm_index.json'))
+PERSIST_INTERVAL = INDEX_CONFIG.get('persist_interval', 60)  # 有变更时的落盘间隔，单位秒
+
+# 全集群的 VM 索引，由清单服务在全量对账和增量事件时维护，查询为纯内存字典查找
+# { ip: {"host", "uuid", "name"} } / { mac: {"host", "uuid", "name"} }
+_BY_IP = {}
+_BY_MAC = {}
+# { uuid: {"host", "name", "ips": set, "macs": set} }，用于删除和更新时清理旧键
+_BY_UUID = {}
+_LOCK = threading.Lock()
+_dirty = False
+
+
+def _unlink(uuid):
+    global _dirty
+    _dirty = True
+    entry = _BY_UUID.pop(uuid, None)
+    if entry is None:
+        return
+    for ip in entry["ips"]:
+        if _BY_IP.get(ip, {}).get("uuid") == uuid:
+            del _BY_IP[ip]
+    for mac in entry["macs"]:
+        if _BY_MAC.get(mac, {}).get("uuid") == uuid:
+            del _BY_MAC[mac]
+
+
+def _link(host_ip, record):
+    global _dirty
+    _dirty = True
+    uuid = record["uuid"]
+    target = {"host": host_ip, "uuid": uuid, "name": record["name"]}
+    ips = {ip for ip in record.get("ip_addresses") or [record.get("ip_address")] if ip}
+    macs = {mac.lower() for mac in record.get("macs", []) if mac}
+    for ip in ips:
+        _BY_IP[ip] = target
+    for mac in macs:
+        _BY_MAC[mac] = target
+    _BY_UUID[uuid] = {"host": host_ip, "name": record["name"], "ips": ips, "macs": macs}
+
+
+def update_vm(host_ip, record):
+    """
+    新增或更新一台 VM 的索引项（IP / MAC 变化时清理旧键）
+    """
+    with _LOCK:
+        _unlink(record["uuid"])
+        _link(host_ip, record)
+
+
+def remove_vm(uuid):
+    with _LOCK:
+        _unlink(uuid)
+
+
+def replace_host(host_ip, records):
+    """
+    全量对账后重建某台宿主机的索引项：移除已不在该宿主机上的 VM，刷新其余 VM
+    """
+    live = {record["uuid"] for record in records}
+    with _LOCK:
+        for uuid in [u for u, entry in _BY_UUID.items() if entry["host"] == host_ip and u not in live]:
+            _unlink(uuid)
+        for record in records:
+            _unlink(record["uuid"])
+            _link(host_ip, record)
+
+
+def learn_ip(uuid, ip):
+    """
+    记录通过 ARP + MAC 反查得到的 IP，下次可直接命中（下一次全量对账时会以清单为准重建）
+    """
+    global _dirty
+    with _LOCK:
+        entry = _BY_UUID.get(uuid)
+        if entry is None:
+            return
+        entry["ips"].add(ip)
+        _BY_IP[ip] = {"host": entry["host"], "uuid": uuid, "name": entry["name"]}
+        _dirty = True
+
+
+def lookup_ip(ip):
+    """
+    按客户机 IP 查找，返回 {"host", "uuid", "name"}，未找到返回 None
+    """
+    with _LOCK:
+        target = _BY_IP.get(ip)
+        return dict(target) if target else None
+
+
+def lookup_mac(mac):
+    """
+    按 MAC 地址查找，返回 {"host", "uuid", "name"}，未找到返回 None
+    """
+    with _LOCK:
+        target = _BY_MAC.get(mac.lower())
+        return dict(target) if target else None
+
+
+def save(path=PERSIST_PATH):
+    """
+    将索引写入磁盘（先写独立的临时文件再原子替换，并发写入不会互相覆盖出残缺文件）
+    """
+    global _dirty
+    with _LOCK:
+        data = {
+            "saved_at": time.time(),
+            "vms": {uuid: {"host": e["host"], "name": e["name"],
+                           "ips": sorted(e["ips"]), "macs": sorted(e["macs"])}
+                    for uuid, e in _BY_UUID.items()}
+        }
+        _dirty = False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".vm_index.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(path=PERSIST_PATH):
+    """
+    从磁盘加载上次保存的索引用于预热；文件不存在或损坏时忽略
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to load VM index from {path}: {e}")
+        return 0
+    with _LOCK:
+        for uuid, entry in data.get("vms", {}).items():
+            _unlink(uuid)
+            _link(entry["host"], {"uuid": uuid, "name": entry["name"],
+                                  "ip_addresses": entry["ips"], "macs": entry["macs"]})
+    logger.info(f"Loaded {len(data.get('vms', {}))} VMs into the index from {path}")
+    return len(data.get("vms", {}))
+
+
+def _persist_loop():
+    while True:
+        time.sleep(PERSIST_INTERVAL)
+        # 只有当选的采集者落盘，其他 worker 的索引同步自它
+        if not _dirty or not LEADER.is_leader():
+            continue
+        try:
+            save()
+        except OSError as e:
+            logger.warning(f"Failed to persist VM index to {PERSIST_PATH}: {e}")
+
+
+def start_persistence():
+    """
+    加载磁盘上的索引预热，并启动周期性落盘线程
+    """
+    load()
+    threading.Thread(target=_persist_loop, name="vm-index-persist", daemon=True).start()
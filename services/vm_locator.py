@@ -1,10 +1,24 @@
 # services/vm_locator.py
 
+import json
 import logging
+import os
+import threading
+import time
+
 import redis
+import yaml
+
+from services import vm_index
 
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+HOST_MAP_CONFIG = CONFIG.get('host_map', {}) or {}
+
 # Redis 连接配置
 redis_client = redis.StrictRedis(
     host='localhost',  # 替换为你的 Redis 地址
@@ -14,36 +28,209 @@ redis_client = redis.StrictRedis(
 )
 
 KVMMAP_KEY = "kvm_host_map"
+# 写入方在修改映射后发布失效消息：JSON 数组为失效的字段，"*" 为全部失效
+KVMMAP_INVALIDATE_CHANNEL = "kvm_host_map:invalidate"
+
+
+class KVMHostMapCache:
+    """
+    kvm_host_map 的本地读穿缓存。
+    - 读：先查本地字典，未命中才 HGET，并把结果（包括未找到）缓存下来
+    - 失效：订阅 KVMMAP_INVALIDATE_CHANNEL；若 Redis 开启了 notify-keyspace-events Kh，
+      其他客户端直接改 hash 时也会通过 keyspace 通知整体失效
+    - 兜底：每个条目最多缓存 cache_ttl 秒，未找到的结果只缓存 negative_ttl 秒
+    - 每次失效都递增代号；HGET 期间发生过失效时不回填读到的值，避免把旧值写回缓存
+    - 批量写入 / 删除使用 pipeline，列表使用 HSCAN 分页
+    """
+
+    def __init__(self, client, key=KVMMAP_KEY, channel=KVMMAP_INVALIDATE_CHANNEL,
+                 cache_ttl=300, negative_ttl=30, batch_size=1000):
+        self.client = client
+        self.key = key
+        self.channel = channel
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.batch_size = batch_size
+        self._cache = {}  # { vm_ip: (host_ip or None, cached_at) }
+        self._generation = 0  # 失效代号，每次 invalidate 递增
+        self._lock = threading.Lock()
+        self._listener_started = False
+
+    def get(self, vm_ip):
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(vm_ip)
+            generation = self._generation
+        if cached is not None:
+            host_ip, cached_at = cached
+            ttl = self.cache_ttl if host_ip else self.negative_ttl
+            if now - cached_at < ttl:
+                return host_ip
+
+        host_ip = self.client.hget(self.key, vm_ip)
+        with self._lock:
+            # 读取期间有过失效，读到的值可能已过时，只返回不缓存
+            if self._generation == generation:
+                self._cache[vm_ip] = (host_ip, now)
+        return host_ip
+
+    def invalidate(self, fields=None):
+        with self._lock:
+            self._generation += 1
+            if fields is None:
+                self._cache.clear()
+            else:
+                for field in fields:
+                    self._cache.pop(field, None)
+
+    def _publish(self, fields):
+        self.invalidate(fields)
+        self.client.publish(self.channel, json.dumps(fields))
+
+    def set_many(self, mapping):
+        """
+        批量写入 {vm_ip: host_ip}，按 batch_size 分批 pipeline
+        """
+        items = list(mapping.items())
+        for start in range(0, len(items), self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for vm_ip, host_ip in items[start:start + self.batch_size]:
+                pipe.hset(self.key, vm_ip, host_ip)
+            pipe.execute()
+        if items:
+            self._publish([vm_ip for vm_ip, _ in items])
+        return len(items)
+
+    def delete_many(self, vm_ips):
+        """
+        批量删除，返回实际删除的条数
+        """
+        vm_ips = list(vm_ips)
+        removed = 0
+        for start in range(0, len(vm_ips), self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for vm_ip in vm_ips[start:start + self.batch_size]:
+                pipe.hdel(self.key, vm_ip)
+            removed += sum(pipe.execute())
+        if vm_ips:
+            self._publish(vm_ips)
+        return removed
+
+    def scan_page(self, cursor=0, count=500):
+        """
+        HSCAN 分页读取，返回 (next_cursor, {vm_ip: host_ip})；next_cursor 为 0 表示已读完
+        """
+        return self.client.hscan(self.key, cursor=cursor, count=count)
+
+    def export(self):
+        """
+        通过 HSCAN 迭代导出全部映射，避免一次性 HGETALL 阻塞 Redis
+        """
+        return dict(self.client.hscan_iter(self.key, count=self.batch_size))
+
+    def start_listener(self):
+        """
+        启动失效消息监听线程（断线后自动重连）
+        """
+        with self._lock:
+            if self._listener_started:
+                return
+            self._listener_started = True
+        threading.Thread(target=self._listen, name="kvm-host-map-invalidator", daemon=True).start()
+
+    def _listen(self):
+        db = self.client.connection_pool.connection_kwargs.get('db', 0)
+        keyspace_channel = f"__keyspace@{db}__:{self.key}"
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel, keyspace_channel)
+                # 重新订阅期间可能错过消息，整体失效一次
+                self.invalidate()
+                for message in pubsub.listen():
+                    if message["channel"] == self.channel:
+                        fields = json.loads(message["data"])
+                        self.invalidate(None if fields == "*" else fields)
+                    else:
+                        # keyspace 通知不携带字段名，只能整体失效
+                        self.invalidate()
+            except Exception as e:
+                logger.warning(f"KVM host map invalidation listener error: {e}")
+                # 监听中断期间无法保证一致性，清空缓存后稍后重连
+                self.invalidate()
+                time.sleep(5)
+
+
+HOST_MAP = KVMHostMapCache(
+    redis_client,
+    cache_ttl=HOST_MAP_CONFIG.get('cache_ttl', 300),
+    negative_ttl=HOST_MAP_CONFIG.get('negative_ttl', 30),
+    batch_size=HOST_MAP_CONFIG.get('batch_size', 1000),
+)
+HOST_MAP.start_listener()
+
+
+def _arp_lookup(vm_ip):
+    """
+    从本机 ARP 缓存（/proc/net/arp）中查找 IP 对应的 MAC，不再 fork arp 命令
+    """
+    try:
+        with open("/proc/net/arp", "r") as f:
+            for line in f.readlines()[1:]:  # 第一行为表头
+                parts = line.split()
+                # IP address, HW type, Flags, HW address, Mask, Device
+                if len(parts) >= 4 and parts[0] == vm_ip and parts[3] != "00:00:00:00:00:00":
+                    return parts[3].lower()
+    except OSError as e:
+        logger.warning(f"ARP lookup failed for {vm_ip}: {e}")
+    return None
+
+
+def locate_vm(vm_ip):
+    """
+    在本地定位虚拟机，返回 {"host", "uuid", "name"}，找不到返回 None：
+      1. 按 IP 查 VM 索引
+      2. 通过 ARP 缓存得到 MAC，再按域定义中的 MAC 查索引（适用于没有 GA / 映射的 VM）
+    """
+    located = vm_index.lookup_ip(vm_ip)
+    if located:
+        return located
+
+    mac_address = _arp_lookup(vm_ip)
+    if not mac_address:
+        return None
+    logger.info(f"Found MAC address for {vm_ip}: {mac_address}")
+    located = vm_index.lookup_mac(mac_address)
+    if located:
+        vm_index.learn_ip(located["uuid"], vm_ip)
+    return located
+
 
 def find_host_by_vm_ip(vm_ip):
     """
     根据虚拟机 IP 查找宿主机地址。
 
     支持：
-      - 从 Redis 中获取映射关系
-      - 或者通过 ARP 表动态查找（需 root 权限）
+      - 从 Redis 中获取映射关系（经本地读穿缓存）
+      - 或者通过 ARP 表得到 MAC，再由域定义中的 MAC 索引找到宿主机
     """
     logger.info(f"Looking up host for VM IP: {vm_ip}")
 
-    # 方法一：从 Redis 获取映射
-    host_ip = redis_client.hget(KVMMAP_KEY, vm_ip)
+    # 方法一：从 Redis 获取映射（本地缓存命中时不走网络）
+    try:
+        host_ip = HOST_MAP.get(vm_ip)
+    except redis.RedisError as e:
+        logger.warning(f"Redis lookup failed for {vm_ip}: {e}")
+        host_ip = None
     if host_ip:
         logger.info(f"Found host via Redis: {host_ip}")
         return host_ip
 
-    # 方法二：尝试通过本地 ARP 表查找（适用于同网段）
-    try:
-        import subprocess
-        arp_output = subprocess.check_output(["arp", "-n", vm_ip], stderr=subprocess.DEVNULL, text=True)
-        for line in arp_output.splitlines():
-            if "ether" in line and vm_ip in line:
-                parts = line.strip().split()
-                mac_address = parts[2]
-                logger.info(f"Found MAC address for {vm_ip}: {mac_address}")
-                # TODO: 根据 MAC 地址查归属宿主机（需要额外配置）
-                return None  # 暂不实现自动 MAC → 宿主匹配
-    except Exception as e:
-        logger.warning(f"ARP lookup failed for {vm_ip}: {e}")
+    # 方法二：ARP 表 IP -> MAC，再按 MAC 索引查宿主机
+    located = locate_vm(vm_ip)
+    if located:
+        logger.info(f"Found host via MAC index: {located['host']}")
+        return located["host"]
 
     logger.warning(f"No host found for VM {vm_ip}")
     return None
@@ -0,0 +1,163 @@
+# services/vm_policy.py
+
+import logging
+import os
+import threading
+from xml.etree import ElementTree as ET
+
+import libvirt
+import yaml
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+# 伸缩策略存放在域 XML 的 <metadata> 中：
+#   <metadata>
+#     <kvmscale:policy xmlns:kvmscale="http://kvm-scale/xmlns/policy/1.0"
+#                      priority="3" policy="compressible" min_vcpu="2" max_vcpu="8" .../>
+#   </metadata>
+POLICY_NS = "http://kvm-scale/xmlns/policy/1.0"
+POLICY_PREFIX = "kvmscale"
+
+# 策略字段及其类型；priority 数值越大优先级越低，越先被压缩
+POLICY_FIELDS = {
+    "priority": int,
+    "policy": str,  # compressible / fixed
+    "min_vcpu": int,
+    "max_vcpu": int,
+    "scale_step_cpu": int,
+    "cpu_threshold_low": float,
+    "cpu_threshold_high": float,
+    "min_mem_mb": int,
+    "max_mem_mb": int,
+    "scale_step_mem_mb": int,
+    "mem_threshold_low": float,
+    "mem_threshold_high": float,
+    "anti_affinity_group": str,  # 同组的 VM 不放在同一台宿主机上
+}
+
+# 内置默认值，被 config.yaml 的 default_vm_policy 覆盖，再被各 VM 的元数据覆盖
+BUILTIN_POLICY = {
+    "priority": 99,
+    "policy": "compressible",
+    "min_vcpu": 1,
+    "max_vcpu": 32,
+    "scale_step_cpu": 1,
+    "cpu_threshold_low": 20,
+    "cpu_threshold_high": 80,
+    "min_mem_mb": 1024,
+    "max_mem_mb": 32768,
+    "scale_step_mem_mb": 1024,
+    "mem_threshold_low": 40,
+    "mem_threshold_high": 85,
+    "anti_affinity_group": "",
+}
+
+# { uuid: (metadata_xml, policy) }，元数据不变时直接复用解析结果
+_POLICY_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def validate_policy(raw):
+    """
+    按 POLICY_FIELDS 校验并转换类型，忽略未知字段。
+    :raises ValueError: 字段值无法转换时
+    """
+    policy = {}
+    for field, value in raw.items():
+        cast = POLICY_FIELDS.get(field)
+        if cast is None or value is None:
+            continue
+        try:
+            policy[field] = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid value for policy field '{field}': {value!r}")
+    return policy
+
+
+DEFAULT_POLICY = {**BUILTIN_POLICY, **validate_policy(CONFIG.get('default_vm_policy', {}) or {})}
+
+
+def parse_policy_xml(xml_string):
+    """
+    解析 <policy> 元数据元素的属性，非法的字段记录告警后忽略
+    """
+    try:
+        elem = ET.fromstring(xml_string)
+    except ET.ParseError as e:
+        logger.warning(f"Invalid policy metadata: {e}")
+        return {}
+    policy = {}
+    for field, value in elem.attrib.items():
+        try:
+            policy.update(validate_policy({field: value}))
+        except ValueError as e:
+            logger.warning(str(e))
+    return policy
+
+
+def build_policy_xml(policy):
+    """
+    生成写入 setMetadata 的 <policy> 元素（命名空间由 setMetadata 的 key / uri 参数指定）
+    """
+    elem = ET.Element("policy", {field: str(value) for field, value in validate_policy(policy).items()})
+    return ET.tostring(elem, encoding='unicode')
+
+
+def policy_for_desc(desc):
+    """
+    由缓存的域描述得到生效策略（默认策略 + 元数据覆盖），纯内存计算，不访问宿主机。
+    """
+    xml_string = desc['metadata'].get(POLICY_NS)
+    if xml_string is None:
+        return dict(DEFAULT_POLICY)
+
+    uuid = desc['uuid']
+    with _CACHE_LOCK:
+        cached = _POLICY_CACHE.get(uuid)
+    if cached is not None and cached[0] == xml_string:
+        return dict(cached[1])
+
+    policy = {**DEFAULT_POLICY, **parse_policy_xml(xml_string)}
+    with _CACHE_LOCK:
+        _POLICY_CACHE[uuid] = (xml_string, policy)
+    return dict(policy)
+
+
+def invalidate_policy(uuid):
+    """
+    元数据变更或域删除时使缓存失效
+    """
+    with _CACHE_LOCK:
+        _POLICY_CACHE.pop(uuid, None)
+
+
+def set_policy(domain, policy):
+    """
+    通过 setMetadata 写入单台 VM 的策略（运行中的 VM 同时修改在线与持久化定义）。
+    写入后 libvirt 会发出 metadata-change 事件，由清单服务刷新缓存。
+    """
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if domain.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    domain.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, build_policy_xml(policy),
+                       POLICY_PREFIX, POLICY_NS, flags)
+    invalidate_policy(domain.UUIDString())
+
+
+def set_policies(conn, policies):
+    """
+    批量写入策略：{uuid: policy}。单台失败不影响其他 VM，返回 {uuid: {"success", "error"}}
+    """
+    results = {}
+    for uuid, policy in policies.items():
+        try:
+            set_policy(conn.lookupByUUIDString(uuid), policy)
+            results[uuid] = {"success": True, "error": None}
+        except (libvirt.libvirtError, ValueError) as e:
+            logger.warning(f"Failed to set policy for VM {uuid}: {e}")
+            results[uuid] = {"success": False, "error": str(e)}
+    return results
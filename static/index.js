@@ -5,4 +5,87 @@ document.addEventListener("DOMContentLoaded", function () {
             location.reload();
         });
     }
-});
\ No newline at end of file
+
+    const serversTable = document.getElementById("servers-table");
+    if (!serversTable) return;
+    const tbody = serversTable.querySelector("tbody");
+    const ageEl = document.getElementById("servers-age");
+    let latest = {};
+
+    function diskBar(disk) {
+        const color = disk.usage_percent > 90 ? "bg-danger" : disk.usage_percent > 70 ? "bg-warning" : "bg-success";
+        const label = `${disk.mount_point}: ${disk.used_gb}/${disk.total_gb} GB (${disk.usage_percent}%)`;
+        return `
+            <div class="progress mt-1" style="height: 20px;">
+                <div class="progress-bar ${color} d-flex align-items-center px-2"
+                     role="progressbar" style="width: ${disk.usage_percent}%; min-width: 40%;">
+                    <span class="text-truncate" style="white-space: nowrap;" title="${label}">${label}</span>
+                </div>
+            </div>`;
+    }
+
+    // 与 index.html 中服务端渲染的行保持一致
+    function renderRow(row, server) {
+        const active = server.status === 'active';
+        const disks = server.disk_info && server.disk_info.length > 0 ?
+            server.disk_info.map(diskBar).join("") :
+            '<span class="text-muted">无可用磁盘信息</span>';
+        const memUsed = ((server.mem_used_mb || 0) / 1024).toFixed(1);
+        const memTotal = ((server.mem_total_mb || 0) / 1024).toFixed(1);
+        row.innerHTML = `
+            <td>${server.ip}</td>
+            <td>
+                <div class="progress" style="height: 20px;">
+                    <div class="progress-bar bg-info" role="progressbar" style="width: ${server.cpu_percent}%">
+                        ${server.cpu_percent}%
+                    </div>
+                </div>
+            </td>
+            <td>
+                <div class="progress" style="height: 20px;">
+                    <div class="progress-bar bg-warning" role="progressbar" style="width: ${server.mem_usage_percent}%">
+                        ${memUsed}/${memTotal} GB
+                    </div>
+                </div>
+            </td>
+            <td>${disks}</td>
+            <td>${active ? '<span class="badge bg-success">在线</span>' : '<span class="badge bg-danger">离线</span>'}</td>
+            <td>${active ?
+                `<a href="/kvm/list?host=${encodeURIComponent(server.ip)}" class="btn btn-primary btn-sm"><i class="bi bi-eye"></i> 查看VM</a>` :
+                '<button class="btn btn-secondary btn-sm" disabled title="主机离线"><i class="bi bi-eye-slash"></i> 查看VM</button>'}
+            </td>
+        `;
+    }
+
+    function renderServers(items, keys) {
+        keys.forEach(ip => {
+            let row = tbody.querySelector(`tr[data-ip="${ip}"]`);
+            const server = items[ip];
+            if (!server) {
+                if (row) row.remove();
+                return;
+            }
+            if (!row) {
+                row = document.createElement("tr");
+                row.dataset.ip = ip;
+                tbody.appendChild(row);
+            }
+            renderRow(row, server);
+        });
+        latest = items;
+        renderAge();
+    }
+
+    // 数据时间取最旧的一台宿主机，每秒刷新一次显示
+    function renderAge() {
+        const timestamps = Object.values(latest).map(server => server.timestamp).filter(Boolean);
+        if (!ageEl || timestamps.length === 0) return;
+        const age = Math.round(Date.now() / 1000 - Math.min(...timestamps));
+        ageEl.textContent = `数据更新于 ${age} 秒前`;
+    }
+
+    const source = subscribeTopic("servers",
+        items => renderServers(items, Object.keys(items)),
+        (items, touched) => renderServers(items, touched));
+    if (source) setInterval(renderAge, 1000);
+});
@@ -1,3 +1,57 @@
+// 把 /api/stream 推送的字段级变更应用到本地的 { key: record } 快照
+function applyPatch(items, changes) {
+    const touched = new Set();
+    changes.forEach(change => {
+        if (change.op === "add") {
+            items[change.key] = change.value;
+        } else if (change.op === "remove") {
+            delete items[change.key];
+        } else if (change.op === "update" && items[change.key]) {
+            const record = Object.assign({}, items[change.key]);
+            Object.entries(change.fields).forEach(([field, value]) => {
+                if (value === null) {
+                    delete record[field];
+                } else {
+                    record[field] = value;
+                }
+            });
+            items[change.key] = record;
+        }
+        touched.add(change.key);
+    });
+    return touched;
+}
+
+// 订阅一个主题：收到 snapshot 时调用 onSnapshot(items)，收到 patch 时调用 onPatch(items, 变更的 key 集合)
+// 浏览器不支持 EventSource 时返回 null，由调用方退回一次性加载
+function subscribeTopic(topic, onSnapshot, onPatch) {
+    if (!window.EventSource) return null;
+    let items = null;
+    let seq = 0;
+    const source = new EventSource(`/api/stream?topics=${encodeURIComponent(topic)}`);
+
+    source.addEventListener("snapshot", event => {
+        const data = JSON.parse(event.data);
+        if (data.topic !== topic) return;
+        items = data.items;
+        seq = data.seq;
+        onSnapshot(items);
+    });
+    source.addEventListener("patch", event => {
+        const data = JSON.parse(event.data);
+        if (data.topic !== topic || items === null) return;
+        if (data.seq !== seq + 1) {
+            // 漏掉了变更，重新连接以获取新的快照
+            source.close();
+            subscribeTopic(topic, onSnapshot, onPatch);
+            return;
+        }
+        seq = data.seq;
+        onPatch(items, applyPatch(items, data.changes));
+    });
+    return source;
+}
+
 document.addEventListener("DOMContentLoaded", function () {
     const kvmTable = document.getElementById("kvm-table");
 
@@ -14,59 +68,95 @@ document.addEventListener("DOMContentLoaded", function () {
 
         tbody.innerHTML = '<tr><td colspan="6" class="text-center">正在加载...</td></tr>';
 
-        // 初始化总计
-        let totalRunningCpu = 0;
-        let totalRunningMemory = 0;
-
-        fetch(`/api/kvm/list?host=${hostIp}`)
-            .then(response => {
-                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-                return response.json();
-            })
-            .then(data => {
-                tbody.innerHTML = "";
-                if (!data || data.length === 0) {
-                    tbody.innerHTML = '<tr><td colspan="6" class="text-center">该主机上没有找到虚拟机。</td></tr>';
-                    return;
-                }
+        function renderRow(row, vm) {
+            const stateText = vm.state === 'running' ?
+                '<span class="badge bg-success">运行中</span>' :
+                '<span class="badge bg-secondary">已关机</span>';
 
-                data.forEach(vm => {
-                    const stateText = vm.state === 'running' ?
-                        '<span class="badge bg-success">运行中</span>' :
-                        '<span class="badge bg-secondary">已关机</span>';
+            const elasticCpu = vm.elastic_vcpu ? `<span class="badge bg-success">支持</span>` : `<span class="badge bg-secondary">不支持</span>`;
+            const elasticMemory = vm.elastic_memory ? `<span class="badge bg-success">支持</span>` : `<span class="badge bg-secondary">不支持</span>`;
+            const isElasticEnabled = vm.elastic_vcpu || vm.elastic_mem_gb ? "" : "disabled";
+            const qemuGaStatus = vm.has_qemu_ga ?
+                '<span class="badge bg-success">已安装</span>' :
+                '<span class="badge bg-secondary">未安装</span>';
 
-                    const elasticCpu = vm.elastic_vcpu ? `<span class="badge bg-success">支持</span>` : `<span class="badge bg-secondary">不支持</span>`;
-                    const elasticMemory = vm.elastic_memory ? `<span class="badge bg-success">支持</span>` : `<span class="badge bg-secondary">不支持</span>`;
-                    const isElasticEnabled = vm.elastic_vcpu || vm.elastic_mem_gb ? "" : "disabled";
-                    const qemuGaStatus = vm.has_qemu_ga ?
-                        '<span class="badge bg-success">已安装</span>' :
-                        '<span class="badge bg-secondary">未安装</span>';
+            row.innerHTML = `
+                <td>${vm.name}</td>
+                <td>${stateText}</td>
+                <td>${vm.ip_address}</td>
+                <td>当前: ${vm.curr_vcpu} 核 / 最大: ${vm.max_vcpu} 核 ${elasticCpu}</td>
+                <td>当前: ${Math.round(vm.curr_mem_gb)} GB / 最大: ${Math.round(vm.max_mem_gb)} GB ${elasticMemory}</td>
+                <td>${qemuGaStatus}</td>
+                <td><button class="btn btn-danger btn-sm" ${isElasticEnabled}>扩容</button></td>
+            `;
+        }
 
-                    const row = document.createElement("tr");
-                    row.innerHTML = `
-                        <td>${vm.name}</td>
-                        <td>${stateText}</td>
-                        <td>${vm.ip_address}</td>
-                        <td>当前: ${vm.curr_vcpu} 核 / 最大: ${vm.max_vcpu} 核 ${elasticCpu}</td>
-                        <td>当前: ${Math.round(vm.curr_mem_gb)} GB / 最大: ${Math.round(vm.max_mem_gb)} GB ${elasticMemory}</td>
-                        <td>${qemuGaStatus}</td>
-                        <td><button class="btn btn-danger btn-sm" ${isElasticEnabled}>扩容</button></td>
-                    `;
+        // 展示运行中虚拟机的资源总计
+        function renderTotals(vms) {
+            let totalRunningCpu = 0;
+            let totalRunningMemory = 0;
+            vms.forEach(vm => {
+                if (vm.state === 'running') {
+                    totalRunningCpu += vm.curr_vcpu;
+                    totalRunningMemory += Math.round(vm.curr_mem_gb);
+                }
+            });
+            if (totalCpuEl) totalCpuEl.textContent = totalRunningCpu;
+            if (totalMemEl) totalMemEl.textContent = totalRunningMemory;
+        }
 
-                    // 累计运行中的虚拟机资源
-                    if (vm.state === 'running') {
-                        totalRunningCpu += vm.curr_vcpu;
-                        totalRunningMemory += Math.round(vm.curr_mem_gb);
-                    }
+        function renderAll(vms) {
+            tbody.innerHTML = "";
+            if (!vms || vms.length === 0) {
+                tbody.innerHTML = '<tr><td colspan="6" class="text-center">该主机上没有找到虚拟机。</td></tr>';
+                renderTotals([]);
+                return;
+            }
+            vms.forEach(vm => {
+                const row = document.createElement("tr");
+                row.dataset.uuid = vm.uuid;
+                renderRow(row, vm);
+                tbody.appendChild(row);
+            });
+            renderTotals(vms);
+        }
 
+        // 只重绘发生变化的行
+        function renderChanged(items, touched) {
+            if (!tbody.querySelector("tr[data-uuid]")) {
+                renderAll(Object.values(items));
+                return;
+            }
+            touched.forEach(uuid => {
+                let row = tbody.querySelector(`tr[data-uuid="${uuid}"]`);
+                const vm = items[uuid];
+                if (!vm) {
+                    if (row) row.remove();
+                    return;
+                }
+                if (!row) {
+                    row = document.createElement("tr");
+                    row.dataset.uuid = uuid;
                     tbody.appendChild(row);
-                });
+                }
+                renderRow(row, vm);
+            });
+            if (Object.keys(items).length === 0) {
+                renderAll([]);
+                return;
+            }
+            renderTotals(Object.values(items));
+        }
 
-                // 展示总计信息
-                if (totalCpuEl) totalCpuEl.textContent = totalRunningCpu;
-                if (totalMemEl) totalMemEl.textContent = totalRunningMemory;
+        const source = subscribeTopic(`vms:${hostIp}`, items => renderAll(Object.values(items)), renderChanged);
+        if (source) return;
 
+        fetch(`/api/kvm/list?host=${hostIp}`)
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                return response.json();
             })
+            .then(data => renderAll(data))
             .catch(err => {
                 console.error("❌ 加载失败:", err);
                 tbody.innerHTML = `<tr><td colspan="6" class="text-center text-danger">加载失败: ${err.message}</td></tr>`;
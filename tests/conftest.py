@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# 测试直接导入 services / utils，与应用从仓库根目录启动时一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+# tests/test_balloon_tuner.py
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from services import balloon_tuner  # noqa: E402
+
+GB = 1024 * 1024  # KiB
+POLICY = {"min_mem_mb": 1024, "max_mem_mb": 32768}
+
+
+def _stats(used_kb, current_kb, maximum_kb=128 * GB):
+    # available - usable 即客户机已用内存
+    return {
+        "balloon.available": current_kb,
+        "balloon.usable": current_kb - used_kb,
+        "balloon.current": current_kb,
+        "balloon.maximum": maximum_kb,
+    }
+
+
+def _needed(used_kb):
+    return used_kb + max(int(used_kb * balloon_tuner.HEADROOM), balloon_tuner.MIN_FREE_MB * 1024)
+
+
+def test_missing_guest_stats_returns_none():
+    assert balloon_tuner.balloon_target_kb({"balloon.current": 8 * GB}, POLICY) is None
+
+
+def test_grow_is_capped_at_policy_max():
+    assert balloon_tuner.balloon_target_kb(_stats(30 * GB, 31 * GB), POLICY) == 32 * GB
+
+
+def test_grow_is_capped_at_domain_maximum():
+    target = balloon_tuner.balloon_target_kb(_stats(14 * GB, 15 * GB, maximum_kb=16 * GB), POLICY)
+    assert target == 16 * GB
+
+
+def test_vm_above_policy_max_is_never_shrunk_below_used():
+    """已用内存超过策略上限的大 VM：不能把气球压到已用内存加余量之下"""
+    stats = _stats(40 * GB, 64 * GB)
+    target = balloon_tuner.balloon_target_kb(stats, POLICY)
+    assert target >= _needed(40 * GB)
+    assert target <= 64 * GB
+
+
+def test_vm_above_policy_max_needing_more_keeps_current_size():
+    """需要扩容但已超过上限时保持当前大小，而不是缩到上限"""
+    assert balloon_tuner.balloon_target_kb(_stats(40 * GB, 45 * GB), POLICY) == 45 * GB
+
+
+def test_shrink_stops_at_used_plus_headroom():
+    assert balloon_tuner.balloon_target_kb(_stats(8 * GB, 16 * GB), POLICY) == _needed(8 * GB)
+
+
+def test_shrink_stops_at_policy_min():
+    assert balloon_tuner.balloon_target_kb(_stats(100 * 1024, 8 * GB), POLICY) == 1024 * 1024
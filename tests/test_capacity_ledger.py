@@ -0,0 +1,124 @@
+# tests/test_capacity_ledger.py
+
+import time
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from services import inventory  # noqa: E402
+from services.capacity_ledger import CapacityLedger  # noqa: E402
+from utils.shared_snapshot import FileSharedState  # noqa: E402
+
+GB = 1024 * 1024  # KiB
+HOST = "10.0.0.1"
+
+
+def _vm(uuid, vcpu, mem_gb, state="running"):
+    return {"uuid": uuid, "state": state, "curr_vcpu": vcpu, "curr_mem_kb": mem_gb * GB}
+
+
+@pytest.fixture
+def host_vms(monkeypatch):
+    vms = [_vm("a", 4, 8), _vm("b", 2, 4), _vm("stopped", 8, 16, state="shutdown")]
+    monkeypatch.setattr(inventory, "get_host_vms", lambda host_ip: vms)
+    return vms
+
+
+def _ledger(state=None, **kwargs):
+    # 8 个在线 CPU、32 GiB 内存：可分配 16 vCPU、32 GiB
+    ledger = CapacityLedger(cpu_overcommit=2.0, mem_overcommit=1.0, state=state, **kwargs)
+    ledger._hosts[HOST] = {"cpus": 8, "online_cpus": 8, "mem_kb": 32 * GB, "refreshed_at": time.time()}
+    return ledger
+
+
+def test_snapshot_counts_running_vms_only(host_vms):
+    summary = _ledger().snapshot(HOST)
+    assert (summary["total_vcpu"], summary["total_mem_kb"]) == (16, 32 * GB)
+    assert (summary["allocated_vcpu"], summary["allocated_mem_kb"]) == (6, 12 * GB)
+    assert (summary["free_vcpu"], summary["free_mem_kb"]) == (10, 20 * GB)
+
+
+def test_reserve_holds_capacity_until_released(host_vms):
+    ledger = _ledger()
+    reservation = ledger.reserve(HOST, vcpu=8, uuid="a")
+    assert reservation is not None
+    assert ledger.snapshot(HOST)["free_vcpu"] == 2
+    # 剩余容量不足时拒绝
+    assert ledger.reserve(HOST, vcpu=3, uuid="b") is None
+    assert ledger.release(reservation["id"])
+    assert ledger.snapshot(HOST)["free_vcpu"] == 10
+    assert not ledger.release(reservation["id"])
+
+
+def test_shrink_is_never_rejected(host_vms):
+    ledger = _ledger()
+    assert ledger.reserve(HOST, vcpu=10) is not None
+    assert ledger.reserve(HOST, vcpu=-2, uuid="a") is not None
+
+
+def test_commit_keeps_new_spec_until_inventory_catches_up(host_vms):
+    ledger = _ledger()
+    reservation = ledger.reserve(HOST, vcpu=2, mem_kb=4 * GB, uuid="a")
+    # 内存按气球粒度取整后实际只增加了 3 GiB
+    assert ledger.commit(reservation["id"], mem_kb=3 * GB)
+    summary = ledger.snapshot(HOST)
+    assert summary["reserved_vcpu"] == 0
+    assert (summary["allocated_vcpu"], summary["allocated_mem_kb"]) == (8, 15 * GB)
+
+    # 清单反映出新规格后，已提交的规格被清除，不会重复计算
+    host_vms[0] = _vm("a", 6, 11)
+    assert ledger.snapshot(HOST)["allocated_vcpu"] == 8
+    assert ledger.snapshot(HOST)["allocated_mem_kb"] == 15 * GB
+
+
+def test_commit_builds_on_previous_pending_spec(host_vms):
+    ledger = _ledger()
+    ledger.commit(ledger.reserve(HOST, vcpu=2, uuid="a")["id"])
+    ledger.commit(ledger.reserve(HOST, vcpu=2, uuid="a")["id"])
+    assert ledger.snapshot(HOST)["allocated_vcpu"] == 10
+
+
+def test_commit_without_inventory_vm_keeps_reservation(host_vms):
+    ledger = _ledger()
+    reservation = ledger.reserve(HOST, vcpu=4, uuid="new")
+    assert ledger.commit(reservation["id"])
+    assert ledger.snapshot(HOST)["reserved_vcpu"] == 4
+
+
+def test_unknown_reservation_cannot_be_committed(host_vms):
+    assert not _ledger().commit("missing")
+
+
+def test_expired_reservation_frees_capacity(host_vms):
+    ledger = _ledger(reservation_ttl=0.05)
+    reservation = ledger.reserve(HOST, vcpu=10)
+    assert ledger.reserve(HOST, vcpu=1) is None
+    time.sleep(0.1)
+    assert ledger.snapshot(HOST)["free_vcpu"] == 10
+    assert not ledger.renew(reservation["id"])
+
+
+def test_renew_extends_reservation(host_vms):
+    ledger = _ledger(reservation_ttl=0.2)
+    reservation = ledger.reserve(HOST, vcpu=10)
+    time.sleep(0.1)
+    assert ledger.renew(reservation["id"])
+    time.sleep(0.15)
+    assert ledger.snapshot(HOST)["reserved_vcpu"] == 10
+
+
+def test_record_change_is_visible_immediately(host_vms):
+    ledger = _ledger()
+    ledger.record_change(HOST, "b", vcpu=-1, mem_kb=-2 * GB)
+    summary = ledger.snapshot(HOST)
+    assert (summary["allocated_vcpu"], summary["allocated_mem_kb"]) == (5, 10 * GB)
+
+
+def test_ledgers_sharing_state_do_not_oversubscribe(host_vms, tmp_path):
+    path = str(tmp_path / "ledger.state.json")
+    first, second = _ledger(FileSharedState(path)), _ledger(FileSharedState(path))
+    assert first.reserve(HOST, vcpu=6) is not None
+    assert second.reserve(HOST, vcpu=6) is None
+    assert second.reserve(HOST, vcpu=4) is not None
+    assert first.snapshot(HOST)["free_vcpu"] == 0
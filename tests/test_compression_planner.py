@@ -0,0 +1,96 @@
+# tests/test_compression_planner.py
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from services import compression_planner, inventory, vm_policy  # noqa: E402
+
+GB = 1024 * 1024  # KiB
+
+
+def _vm(uuid, vcpu=4, mem_gb=8, cpu=5.0, mem=10.0, priority=9, state="running", **policy):
+    return {
+        "uuid": uuid,
+        "name": uuid,
+        "state": state,
+        "curr_vcpu": vcpu,
+        "curr_mem_kb": mem_gb * GB,
+        "cpu_usage_percent": cpu,
+        "cpu_usage": {"10s": cpu},
+        "mem_usage_percent": mem,
+        "policy": {**vm_policy.DEFAULT_POLICY, "priority": priority, **policy},
+    }
+
+
+@pytest.fixture
+def host_vms(monkeypatch):
+    vms = []
+    monkeypatch.setattr(inventory, "get_host_vms", lambda host_ip: vms)
+    return vms
+
+
+def _plan(**kwargs):
+    return compression_planner.plan_compression("10.0.0.1", **kwargs)
+
+
+def test_takes_from_lowest_priority_first(host_vms):
+    host_vms += [_vm("p7", priority=7), _vm("p9", priority=9), _vm("p8", priority=8)]
+    plan = _plan(need_vcpu=2, target_priority=5)
+    assert plan["feasible"]
+    assert [a["uuid"] for a in plan["actions"]] == ["p9"]
+    assert plan["actions"][0]["to_vcpu"] == 2
+
+
+def test_spreads_across_vms_when_one_is_not_enough(host_vms):
+    host_vms += [_vm("a", vcpu=2, priority=9), _vm("b", vcpu=4, priority=8)]
+    plan = _plan(need_vcpu=3, target_priority=5)
+    assert plan["feasible"]
+    assert plan["freed_vcpu"] == 3
+    # a 最多释放 1 个（min_vcpu=1），剩下的由 b 补齐
+    assert {a["uuid"]: a["from_vcpu"] - a["to_vcpu"] for a in plan["actions"]} == {"a": 1, "b": 2}
+
+
+def test_prunes_vms_made_redundant_by_later_picks(host_vms):
+    # 先选中的 small 不够；large 按 4 个 vCPU 的步长取整后单独就能满足需求，small 被剪掉
+    host_vms += [_vm("small", vcpu=3, priority=9, scale_step_cpu=2),
+                 _vm("large", vcpu=9, priority=8, scale_step_cpu=4)]
+    plan = _plan(need_vcpu=3, target_priority=5)
+    assert plan["feasible"]
+    assert [a["uuid"] for a in plan["actions"]] == ["large"]
+    assert plan["actions"][0]["to_vcpu"] == 5
+
+
+def test_skips_ineligible_vms(host_vms):
+    host_vms += [
+        _vm("target", priority=9),
+        _vm("stopped", priority=9, state="shutdown"),
+        _vm("busy", priority=9, cpu=90.0),
+        _vm("pinned", priority=9, policy="fixed"),
+        _vm("important", priority=3),
+    ]
+    host_vms.append(dict(_vm("unsampled", priority=9), cpu_usage={}))
+    plan = _plan(need_vcpu=1, target_uuid="target", target_priority=5)
+    assert plan["candidates"] == 0
+    assert not plan["feasible"]
+    assert plan["actions"] == []
+
+
+def test_memory_rounds_to_step_and_respects_minimum(host_vms):
+    host_vms.append(_vm("a", mem_gb=4, priority=9, min_mem_mb=2048, scale_step_mem_mb=1024))
+    plan = _plan(need_mem_kb=GB + 1, target_priority=5)
+    assert plan["feasible"]
+    assert plan["actions"][0]["to_mem_kb"] == 2 * GB
+
+
+def test_vm_without_balloon_stats_is_not_compressed(host_vms):
+    host_vms.append(_vm("a", priority=9, mem=0.0))
+    plan = _plan(need_mem_kb=GB, target_priority=5)
+    assert plan["candidates"] == 0
+
+
+def test_infeasible_plan_reports_partial_freed(host_vms):
+    host_vms.append(_vm("a", vcpu=3, priority=9))
+    plan = _plan(need_vcpu=4, target_priority=5)
+    assert not plan["feasible"]
+    assert plan["freed_vcpu"] == 2
@@ -0,0 +1,100 @@
+# tests/test_forecaster.py
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("libvirt")
+
+from services import forecaster  # noqa: E402
+
+
+def _model(season=4):
+    return forecaster.HoltWinters(season=season, alpha=0.5, beta=0.1, gamma=0.3)
+
+
+def test_constant_series_forecasts_constant():
+    y = np.full((2, 40), 35.0)
+    predicted = _model().forecast(y, first_bucket=0, horizon=5)
+    assert predicted.shape == (2, 5)
+    assert np.allclose(predicted, 35.0)
+
+
+def test_trend_is_extrapolated():
+    y = np.arange(40, dtype=np.float64)[None, :]
+    predicted = _model().forecast(y, first_bucket=0, horizon=5)[0]
+    assert predicted[0] > 39
+    assert np.all(np.diff(predicted) > 0)
+
+
+def test_season_is_aligned_to_absolute_bucket():
+    pattern = np.array([10.0, 20.0, 80.0, 20.0])
+    y = np.tile(pattern, 10)[None, :]
+    # 序列从第 3 个桶开始，下一个桶的相位为 (3 + 40) % 4 = 3
+    predicted = _model().forecast(np.roll(y, -3, axis=1), first_bucket=3, horizon=4)[0]
+    assert np.argmax(predicted) == (2 - 3) % 4
+    assert predicted.max() > 60
+
+
+def test_short_history_skips_seasonal_component():
+    y = np.array([[10.0, 90.0, 10.0, 90.0, 10.0]])
+    level, trend, season, _ = _model(season=4).run(y, first_bucket=0)
+    assert np.all(season == 0)
+
+
+def test_missing_values_do_not_break_smoothing():
+    y = np.full((1, 40), 50.0)
+    y[0, 10:20] = np.nan
+    predicted = _model().forecast(y, first_bucket=0, horizon=3)
+    assert np.all(np.isfinite(predicted))
+    assert np.allclose(predicted, 50.0)
+
+
+def test_forecast_is_clipped_to_percent_range():
+    y = np.linspace(0, 99, 40)[None, :] ** 1.2
+    predicted = _model().forecast(np.clip(y, 0, 100), first_bucket=0, horizon=60)
+    assert predicted.max() <= 100
+    assert predicted.min() >= 0
+
+
+class _FixedFlags:
+    """按给定的预测结果回放，便于精确校验回测的窗口统计"""
+
+    def __init__(self, flags):
+        self.flags = np.array(flags, dtype=bool)
+
+    def run(self, y, first_bucket, horizon=0, threshold=None):
+        return None, None, None, self.flags
+
+
+def test_backtest_counts_avoided_saturation_and_false_alarms():
+    cpu = np.array([
+        [10, 10, 10, 10, 95, 95, 10, 10],  # t=2 提前预测到，t=4 与 t=5 都在 horizon 内
+        [10, 10, 10, 10, 10, 10, 10, 10],  # t=1 预测到但从未饱和：误报
+        [10, 10, 10, 10, 10, 10, 10, 95],  # 没有预测到的饱和
+    ], dtype=np.float64)
+    flags = np.zeros(cpu.shape, dtype=bool)
+    flags[0, 2] = flags[0, 3] = True
+    flags[1, 1] = True
+    result = forecaster.backtest(cpu, 0, threshold=90, horizon=3, model=_FixedFlags(flags))
+    minutes = forecaster.BUCKET / 60
+    assert result["vms"] == 3
+    assert result["saturated_minutes"] == 3 * minutes
+    assert result["avoided_minutes"] == 2 * minutes
+    assert result["scale_events"] == 2
+    assert result["false_alarms"] == 1
+
+
+def test_backtest_without_saturation():
+    cpu = np.full((1, 20), 20.0)
+    result = forecaster.backtest(cpu, 0, threshold=90, horizon=4, model=_model())
+    assert result["saturated_minutes"] == 0
+    assert result["avoided_ratio"] is None
+    assert result["scale_events"] == 0
+
+
+def test_backtest_predicts_recurring_daily_peak():
+    pattern = np.array([20.0, 20.0, 20.0, 20.0, 20.0, 95.0, 20.0, 20.0])
+    cpu = np.tile(pattern, 12)[None, :]
+    result = forecaster.backtest(cpu, 0, threshold=90, horizon=2, model=_model(season=8))
+    # 前两个季节用于初始化之后，季节项已学到峰值，大部分饱和可以提前发现
+    assert result["avoided_ratio"] >= 0.75
@@ -0,0 +1,99 @@
+# tests/test_host_map_cache.py
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from services.vm_locator import KVMHostMapCache  # noqa: E402
+
+
+class CountingRedis(fakeredis.FakeStrictRedis):
+    """记录 HGET 次数，并可在 HGET 返回前执行一个钩子（模拟并发的写入方）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hget_calls = 0
+        self.during_hget = None
+
+    def hget(self, name, key):
+        self.hget_calls += 1
+        value = super().hget(name, key)
+        if self.during_hget is not None:
+            hook, self.during_hget = self.during_hget, None
+            hook()
+        return value
+
+
+@pytest.fixture
+def client():
+    return CountingRedis(decode_responses=True)
+
+
+@pytest.fixture
+def cache(client):
+    return KVMHostMapCache(client, key="test_host_map", channel="test_host_map:invalidate")
+
+
+def test_get_reads_through_once(client, cache):
+    client.hset("test_host_map", "10.0.0.5", "192.168.1.10")
+    assert cache.get("10.0.0.5") == "192.168.1.10"
+    assert cache.get("10.0.0.5") == "192.168.1.10"
+    assert client.hget_calls == 1
+
+
+def test_misses_are_cached(client, cache):
+    assert cache.get("10.0.0.6") is None
+    assert cache.get("10.0.0.6") is None
+    assert client.hget_calls == 1
+
+
+def test_negative_entries_expire(client):
+    cache = KVMHostMapCache(client, key="test_host_map", negative_ttl=0)
+    assert cache.get("10.0.0.6") is None
+    client.hset("test_host_map", "10.0.0.6", "192.168.1.11")
+    assert cache.get("10.0.0.6") == "192.168.1.11"
+
+
+def test_invalidation_during_read_is_not_overwritten(client, cache):
+    """get -> 并发写入并失效 -> get 回填：回填的旧值不能留在缓存里"""
+    client.hset("test_host_map", "10.0.0.5", "192.168.1.10")
+
+    def concurrent_move():
+        client.hset("test_host_map", "10.0.0.5", "192.168.1.20")
+        cache.invalidate(["10.0.0.5"])
+
+    client.during_hget = concurrent_move
+    # 本次读取返回的是失效前的值
+    assert cache.get("10.0.0.5") == "192.168.1.10"
+    # 但没有被缓存，下次读取拿到新值
+    assert cache.get("10.0.0.5") == "192.168.1.20"
+    assert client.hget_calls == 2
+
+
+def test_set_many_invalidates_local_entries(client, cache):
+    client.hset("test_host_map", "10.0.0.5", "192.168.1.10")
+    assert cache.get("10.0.0.5") == "192.168.1.10"
+    assert cache.set_many({"10.0.0.5": "192.168.1.20", "10.0.0.7": "192.168.1.20"}) == 2
+    assert cache.get("10.0.0.5") == "192.168.1.20"
+
+
+def test_delete_many_counts_removed(client, cache):
+    cache.set_many({"10.0.0.5": "192.168.1.10", "10.0.0.7": "192.168.1.10"})
+    assert cache.get("10.0.0.5") == "192.168.1.10"
+    assert cache.delete_many(["10.0.0.5", "10.0.0.9"]) == 1
+    assert cache.get("10.0.0.5") is None
+
+
+def test_export_and_scan_page(client):
+    cache = KVMHostMapCache(client, key="test_host_map", batch_size=3)
+    mapping = {f"10.0.1.{i}": "192.168.1.10" for i in range(10)}
+    cache.set_many(mapping)
+    assert cache.export() == mapping
+
+    collected, cursor = {}, 0
+    while True:
+        cursor, page = cache.scan_page(cursor, count=4)
+        collected.update(page)
+        if cursor == 0:
+            break
+    assert collected == mapping
@@ -0,0 +1,160 @@
+# tests/test_metric_store.py
+
+import os
+
+import pytest
+
+from services import metric_store
+from services.metric_store import MetricStore
+
+DAY = 86400
+T0 = 1_700_000_000 - 1_700_000_000 % (7 * DAY)  # 对齐到 1m 段的起点
+VM1 = "2f1c6f3e-8a4b-4c1d-9e2f-0a1b2c3d4e5f"
+VM2 = "7d9e0f1a-2b3c-4d5e-8f6a-7b8c9d0e1f2a"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MetricStore(str(tmp_path))
+
+
+def _record_minutes(store, minutes, start=T0, step=10):
+    """每 step 秒记录一个样本，cpu 为该样本所在分钟的序号"""
+    for ts in range(start, start + minutes * 60, step):
+        store.record("vm", VM1, {"cpu_percent": (ts - start) // 60, "mem_usage_percent": None}, ts=ts)
+
+
+def test_raw_query_round_trips_through_segments(store):
+    _record_minutes(store, 2)
+    store.flush()
+    result = store.query("vm", VM1, T0, T0 + 119, resolution="raw")
+    assert result["fields"] == ["cpu_percent", "mem_usage_percent"]
+    assert len(result["points"]) == 12
+    assert result["points"][0] == [T0, 0.0, None]
+    assert result["points"][-1] == [T0 + 110, 1.0, None]
+
+
+def test_query_includes_unflushed_records(store):
+    _record_minutes(store, 1)
+    store.flush()
+    store.record("vm", VM1, {"cpu_percent": 50}, ts=T0 + 60)
+    points = store.query("vm", VM1, T0, T0 + 60, resolution="raw")["points"]
+    assert len(points) == 7
+    assert points[-1][:2] == [T0 + 60, 50.0]
+
+
+def test_query_range_is_inclusive_and_bounded(store):
+    _record_minutes(store, 3)
+    store.flush()
+    points = store.query("vm", VM1, T0 + 60, T0 + 120, resolution="raw")["points"]
+    assert [p[0] for p in points] == list(range(T0 + 60, T0 + 121, 10))
+
+
+def test_rollup_emits_bucket_mean_when_next_bucket_starts(store):
+    store.record("vm", VM1, {"cpu_percent": 10}, ts=T0)
+    store.record("vm", VM1, {"cpu_percent": 30}, ts=T0 + 30)
+    # 桶尚未结束，不输出
+    assert store.query("vm", VM1, T0, T0 + 60, resolution="1m")["points"] == []
+    store.record("vm", VM1, {"cpu_percent": 90}, ts=T0 + 60)
+    store.flush()
+    assert store.query("vm", VM1, T0, T0 + 60, resolution="1m")["points"] == [[T0, 20.0, None]]
+
+
+def test_rollups_cascade_to_coarser_resolutions(store):
+    _record_minutes(store, 21)
+    store.flush()
+    minute = store.query("vm", VM1, T0, T0 + 1200, resolution="1m")["points"]
+    assert [p[1] for p in minute] == [float(m) for m in range(20)]
+    ten_minutes = store.query("vm", VM1, T0, T0 + 1200, resolution="10m")["points"]
+    assert ten_minutes == [[T0, 4.5, None], [T0 + 600, 14.5, None]]
+
+
+def test_out_of_order_samples_are_dropped(store):
+    store.record("vm", VM1, {"cpu_percent": 1}, ts=T0 + 10)
+    store.record("vm", VM1, {"cpu_percent": 2}, ts=T0)
+    store.record("vm", VM1, {"cpu_percent": 3}, ts=T0 + 10)
+    points = store.query("vm", VM1, T0, T0 + 10, resolution="raw")["points"]
+    assert points == [[T0 + 10, 1.0, None]]
+
+
+def test_torn_tail_is_ignored_and_truncated_on_next_write(store):
+    _record_minutes(store, 1)
+    store.flush()
+    path = os.path.join(store._segment_dir("raw", "vm", VM1), f"{T0 - T0 % DAY}.seg")
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02\x03")
+    assert len(store.query("vm", VM1, T0, T0 + 60, resolution="raw")["points"]) == 6
+    store.record("vm", VM1, {"cpu_percent": 7}, ts=T0 + 60)
+    store.flush()
+    assert os.path.getsize(path) % metric_store.RECORDS["vm"].size == 0
+    assert store.query("vm", VM1, T0 + 60, T0 + 60, resolution="raw")["points"] == [[T0 + 60, 7.0, None]]
+
+
+def test_retention_removes_only_expired_segments(store):
+    old, recent = T0 - 10 * DAY, T0
+    store.record("vm", VM1, {"cpu_percent": 1}, ts=old)
+    store.record("vm", VM1, {"cpu_percent": 2}, ts=recent)
+    store.record("vm", VM2, {"cpu_percent": 3}, ts=old)
+    store.record("vm", VM2, {"cpu_percent": 3}, ts=old + 60)  # 结束第一个 1m 桶
+    store.flush()
+    raw_dir = store._segment_dir("raw", "vm", VM1)
+    with open(os.path.join(raw_dir, "notes.txt"), "w") as f:
+        f.write("keep")
+
+    removed = store.enforce_retention(now=recent + 60)
+    assert removed == 2  # 两条序列过期的 raw 段
+    assert sorted(os.listdir(raw_dir)) == [f"{recent - recent % DAY}.seg", "notes.txt"]
+    # 没有剩余段的序列目录一并删除
+    assert not os.path.exists(store._segment_dir("raw", "vm", VM2))
+    # 1m 段仍在保留期内
+    assert os.path.isdir(store._segment_dir("1m", "vm", VM2))
+
+
+def test_retention_forgets_idle_series_state(store):
+    store.record("vm", VM1, {"cpu_percent": 1}, ts=T0)
+    store.flush()
+    store.enforce_retention(now=T0 + metric_store.RETENTION["raw"] + 1)
+    assert ("vm", VM1) not in store._series
+
+
+def test_pick_resolution_prefers_finest_covering_range(store):
+    now = T0
+    assert store.pick_resolution(now - 3600, now, now=now) == "raw"
+    # raw 在保留期内，但一天的原始样本超过 MAX_POINTS
+    assert store.pick_resolution(now - DAY, now, now=now) == "1m"
+    assert store.pick_resolution(now - 10 * DAY, now, now=now) == "10m"
+    assert store.pick_resolution(now - 400 * DAY, now, now=now) == "1h"
+
+
+def test_unknown_resolution_is_rejected(store):
+    with pytest.raises(ValueError):
+        store.query("vm", VM1, T0, T0 + 60, resolution="5m")
+
+
+@pytest.mark.parametrize("kind, series_id", [
+    ("vm", "../../etc"),
+    ("vm", "2F1C6F3E-8A4B-4C1D-9E2F-0A1B2C3D4E5F"),
+    ("host", "../10.0.0.1"),
+    ("host", "10.0.0.1/.."),
+    ("host", VM1),
+])
+def test_query_rejects_ids_that_are_not_uuid_or_ip(store, kind, series_id):
+    with pytest.raises(ValueError):
+        store.query(kind, series_id, T0, T0 + 60, resolution="raw")
+
+
+def test_host_series_accepts_ip(store):
+    store.record("host", "10.0.0.1", {"cpu_percent": 5}, ts=T0)
+    points = store.query("host", "10.0.0.1", T0, T0, resolution="raw")["points"]
+    assert points[0][:2] == [T0, 5.0]
+
+
+def test_unparsable_segment_names_are_skipped(store):
+    store.record("vm", VM1, {"cpu_percent": 1}, ts=T0 - 10 * DAY)
+    store.record("vm", VM1, {"cpu_percent": 2}, ts=T0)
+    store.flush()
+    raw_dir = store._segment_dir("raw", "vm", VM1)
+    open(os.path.join(raw_dir, "backup.seg"), "w").close()
+    assert len(store.query("vm", VM1, T0 - 10 * DAY, T0, resolution="raw")["points"]) == 2
+    assert store.enforce_retention(now=T0 + 60) == 1
+    assert "backup.seg" in os.listdir(raw_dir)
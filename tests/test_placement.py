@@ -0,0 +1,129 @@
+# tests/test_placement.py
+
+from services import placement
+
+GB = 1024 * 1024  # KiB
+
+
+def _capacity(total_vcpu, total_mem_gb, free_vcpu, free_mem_gb):
+    return {
+        "total_vcpu": total_vcpu,
+        "total_mem_kb": total_mem_gb * GB,
+        "free_vcpu": free_vcpu,
+        "free_mem_kb": free_mem_gb * GB,
+    }
+
+
+def _vm(uuid, vcpu=2, mem_gb=4, priority=99, group="", state="running"):
+    return {
+        "uuid": uuid,
+        "name": uuid,
+        "state": state,
+        "curr_vcpu": vcpu,
+        "curr_mem_kb": mem_gb * GB,
+        "policy": {"priority": priority, "anti_affinity_group": group},
+    }
+
+
+def test_best_host_prefers_tightest_fit():
+    cluster = {
+        "10.0.0.1": {"capacity": _capacity(32, 128, 16, 64), "vms": []},
+        "10.0.0.2": {"capacity": _capacity(32, 128, 4, 8), "vms": []},
+    }
+    assert placement.best_host(cluster, _vm("a"), 2, 4 * GB) == "10.0.0.2"
+
+
+def test_best_host_scores_both_dimensions():
+    # 10.0.0.1 的 CPU 更紧，但内存剩得多；二维得分选择两个维度都更紧的 10.0.0.2
+    cluster = {
+        "10.0.0.1": {"capacity": _capacity(32, 128, 4, 100), "vms": []},
+        "10.0.0.2": {"capacity": _capacity(32, 128, 8, 16), "vms": []},
+    }
+    assert placement.best_host(cluster, _vm("a"), 2, 4 * GB) == "10.0.0.2"
+
+
+def test_best_host_skips_hosts_without_room():
+    cluster = {
+        "10.0.0.1": {"capacity": _capacity(32, 128, 1, 64), "vms": []},
+        "10.0.0.2": {"capacity": _capacity(32, 128, 16, 2), "vms": []},
+    }
+    assert placement.best_host(cluster, _vm("a"), 2, 4 * GB) is None
+
+
+def test_best_host_honours_min_free_ratio():
+    cluster = {"10.0.0.1": {"capacity": _capacity(32, 128, 8, 32), "vms": []}}
+    assert placement.best_host(cluster, _vm("a"), 2, 4 * GB) == "10.0.0.1"
+    assert placement.best_host(cluster, _vm("a"), 2, 4 * GB, min_free_ratio=0.25) is None
+
+
+def test_best_host_rejects_anti_affinity_conflict():
+    cluster = {
+        "10.0.0.1": {"capacity": _capacity(32, 128, 4, 8), "vms": [_vm("db-1", group="db")]},
+        "10.0.0.2": {"capacity": _capacity(32, 128, 16, 64), "vms": []},
+    }
+    assert placement.best_host(cluster, _vm("db-2", group="db"), 2, 4 * GB) == "10.0.0.2"
+    assert placement.best_host(cluster, _vm("web-1", group="web"), 2, 4 * GB) == "10.0.0.1"
+
+
+def test_best_host_ignores_the_vm_itself():
+    # 原地评估（如扩容后留在本机）时，VM 自己不算反亲和冲突
+    vm = _vm("db-1", group="db")
+    cluster = {"10.0.0.1": {"capacity": _capacity(32, 128, 8, 32), "vms": [vm]}}
+    assert placement.best_host(cluster, vm, 2, 4 * GB) == "10.0.0.1"
+
+
+def _saturated_cluster(neighbours, dest_capacity):
+    target = _vm("target", vcpu=4, mem_gb=16, priority=10)
+    return {
+        "10.0.0.1": {"capacity": _capacity(16, 64, 0, 0), "vms": [target] + neighbours},
+        "10.0.0.2": {"capacity": dest_capacity, "vms": []},
+    }
+
+
+def test_plan_relief_moves_cheaper_low_priority_neighbour():
+    cluster = _saturated_cluster([_vm("batch", vcpu=4, mem_gb=8, priority=50)], _capacity(32, 128, 16, 64))
+    plan = placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB)
+    assert plan["uuid"] == "batch"
+    assert plan["reason"] == "move_neighbour"
+    assert (plan["source"], plan["dest"]) == ("10.0.0.1", "10.0.0.2")
+    assert plan["cost_mem_kb"] == 8 * GB
+
+
+def test_plan_relief_moves_target_when_neighbours_outrank_it():
+    cluster = _saturated_cluster([_vm("critical", vcpu=4, mem_gb=8, priority=1)], _capacity(32, 128, 16, 64))
+    plan = placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB)
+    assert plan["uuid"] == "target"
+    assert plan["reason"] == "move_target"
+    # 目标 VM 按扩容后的规格迁移
+    assert (plan["vcpu"], plan["mem_kb"]) == (6, 20 * GB)
+
+
+def test_plan_relief_skips_neighbours_too_small_to_cover_shortfall():
+    cluster = _saturated_cluster([_vm("tiny", vcpu=1, mem_gb=1, priority=50)], _capacity(32, 128, 16, 64))
+    plan = placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB)
+    assert plan["uuid"] == "target"
+
+
+def test_plan_relief_skips_stopped_neighbours():
+    neighbours = [_vm("stopped", vcpu=4, mem_gb=8, priority=50, state="shutdown")]
+    cluster = _saturated_cluster(neighbours, _capacity(32, 128, 16, 64))
+    plan = placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB)
+    assert plan["uuid"] == "target"
+
+
+def test_plan_relief_returns_none_without_destination():
+    cluster = _saturated_cluster([_vm("batch", vcpu=4, mem_gb=8, priority=50)], _capacity(32, 128, 0, 0))
+    assert placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB) is None
+
+
+def test_plan_relief_respects_anti_affinity_at_destination():
+    neighbours = [_vm("batch", vcpu=4, mem_gb=8, priority=50, group="batch")]
+    cluster = _saturated_cluster(neighbours, _capacity(32, 128, 16, 64))
+    cluster["10.0.0.2"]["vms"] = [_vm("batch-2", group="batch")]
+    plan = placement.plan_relief(cluster, "10.0.0.1", "target", need_vcpu=2, need_mem_kb=4 * GB)
+    assert plan["uuid"] == "target"
+
+
+def test_plan_relief_unknown_target():
+    cluster = _saturated_cluster([], _capacity(32, 128, 16, 64))
+    assert placement.plan_relief(cluster, "10.0.0.1", "missing", need_vcpu=2) is None
@@ -0,0 +1,151 @@
+# utils/leader.py
+import fcntl
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(BASE_DIR, "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+LEADER_CONFIG = CONFIG.get('leader', {}) or {}
+
+
+class FileLeaderLock:
+    """
+    基于 flock 的领导者锁，适用于同一台机器上的多个 worker 进程（如 gunicorn）。
+    锁随进程退出由内核自动释放，无需续期。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def renew(self):
+        return self._fd is not None
+
+
+class RedisLeaderLock:
+    """
+    基于 Redis SET NX PX 的领导者锁，适用于跨机器部署；持有者需在 ttl 内续期，
+    续期用 Lua 脚本比较持有者标识，锁过期被他人取得后不会误续。
+    """
+
+    RENEW_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, client, key, ttl):
+        self.client = client
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._renew = client.register_script(self.RENEW_SCRIPT)
+
+    def acquire(self):
+        return bool(self.client.set(self.key, self.token, nx=True, px=self.ttl_ms))
+
+    def renew(self):
+        return bool(self._renew(keys=[self.key], args=[self.token, self.ttl_ms]))
+
+
+class LeaderElector:
+    """
+    在多个 worker 之间选出唯一的领导者，只有领导者运行后台采集等有副作用的任务。
+    - 非领导者每 retry_interval 秒尝试获取锁
+    - 领导者每 retry_interval 秒续期，续期失败即卸任
+    - 当选 / 卸任时依次调用注册的回调
+    """
+
+    def __init__(self, lock, retry_interval=5):
+        self.lock = lock
+        self.retry_interval = retry_interval
+        self._leader = False
+        self._on_elected = []
+        self._on_demoted = []
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def on_elected(self, callback):
+        self._on_elected.append(callback)
+
+    def on_demoted(self, callback):
+        self._on_demoted.append(callback)
+
+    def is_leader(self):
+        return self._leader
+
+    def _notify(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"Leader callback {callback} failed: {e}")
+
+    def _tick(self):
+        try:
+            held = self.lock.renew() if self._leader else self.lock.acquire()
+        except Exception as e:
+            logger.warning(f"Leader lock error: {e}")
+            held = False
+        if held and not self._leader:
+            self._leader = True
+            logger.info(f"Process {os.getpid()} elected as collector leader")
+            self._notify(self._on_elected)
+        elif not held and self._leader:
+            self._leader = False
+            logger.warning(f"Process {os.getpid()} lost collector leadership")
+            self._notify(self._on_demoted)
+
+    def _run(self):
+        while True:
+            self._tick()
+            time.sleep(self.retry_interval)
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        # 先同步尝试一次，单进程部署启动后立即成为领导者
+        self._tick()
+        threading.Thread(target=self._run, name="leader-elector", daemon=True).start()
+
+
+def _build_lock():
+    if LEADER_CONFIG.get('backend', 'file') == 'redis':
+        import redis
+
+        client = redis.StrictRedis.from_url(LEADER_CONFIG.get('redis_url', 'redis://localhost:6379/0'))
+        return RedisLeaderLock(client, LEADER_CONFIG.get('redis_key', 'kvm_scale:leader'),
+                               LEADER_CONFIG.get('ttl', 15))
+    return FileLeaderLock(os.path.join(BASE_DIR, LEADER_CONFIG.get('lock_path', 'data/leader.lock')))
+
+
+LEADER = LeaderElector(_build_lock(), retry_interval=LEADER_CONFIG.get('retry_interval', 5))
@@ -1,13 +1,169 @@
+# utils/queue_manager.py
 import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
-priority_queue = []
+import yaml
 
-def add_to_queue(item, priority):
-    heapq.heappush(priority_queue, (priority, item))
+logger = logging.getLogger(__name__)
 
-def process_queue():
-    while priority_queue:
-        priority, item = heapq.heappop(priority_queue)
-        instance_ip, alert = item
-        # 示例：动态增加 CPU 和内存
-        adjust_kvm_resources(instance_ip, cpu=4, memory="8G")
+# 加载一次配置，避免重复读取
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+JOBS_CONFIG = CONFIG.get('jobs', {}) or {}
+
+
+class JobQueue:
+    """
+    线程安全的优先级任务队列，由有界工作线程池消费。
+    - priority 数值越小越先执行
+    - 同一 key（如同一台 VM）的同类任务同时只保留一个待执行任务，新提交的任务合并进去
+    - 同一 key 的任务（不论类型）不会并发执行：正在执行时，新任务等它完成后再派发
+    - 已完成任务保留最近 history_size 条，供状态查询
+    """
+
+    def __init__(self, workers=4, history_size=1000):
+        self.workers = workers
+        self.history_size = history_size
+        self._handlers = {}
+        self._cond = threading.Condition()
+        self._heap = []  # (priority, seq, job_id)
+        self._seq = itertools.count()
+        self._jobs = OrderedDict()  # job_id -> job
+        self._pending = {}  # (kind, key) -> job_id（仍在排队的任务）
+        self._running_keys = set()
+        self._deferred = {}  # key -> [job_id, ...]（等待同 key 任务执行完毕）
+        self._started = False
+
+    def register_handler(self, kind, handler):
+        """
+        注册任务处理函数 handler(payload) -> result
+        """
+        self._handlers[kind] = handler
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, kind, key, payload, priority=5, merge=None):
+        """
+        提交任务。若同一 key 已有排队中的同类任务，用 merge(old_payload, new_payload) 合并并沿用原任务，
+        优先级取两者中更高（数值更小）的一个。返回任务字典（含 id）。
+        """
+        self.start()
+        with self._cond:
+            job_id = self._pending.get((kind, key))
+            if job_id is not None:
+                job = self._jobs[job_id]
+                job["payload"] = merge(job["payload"], payload) if merge else payload
+                job["merged"] += 1
+                if priority < job["priority"]:
+                    job["priority"] = priority
+                    # 旧的堆条目在出队时按优先级不一致丢弃
+                    if job_id not in self._deferred.get(key, ()):
+                        heapq.heappush(self._heap, (priority, next(self._seq), job_id))
+                        self._cond.notify()
+                return dict(job)
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "id": job_id,
+                "kind": kind,
+                "key": key,
+                "priority": priority,
+                "status": "queued",
+                "payload": payload,
+                "merged": 0,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            self._jobs[job_id] = job
+            self._pending[(kind, key)] = job_id
+            heapq.heappush(self._heap, (priority, next(self._seq), job_id))
+            self._cond.notify()
+            return dict(job)
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"workers": self.workers, "jobs": counts}
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    priority, _, job_id = heapq.heappop(self._heap)
+                    job = self._jobs.get(job_id)
+                    # 跳过被合并提优先级后遗留的旧条目
+                    if job is None or job["status"] != "queued" or job["priority"] != priority:
+                        continue
+                    if job["key"] in self._running_keys:
+                        deferred = self._deferred.setdefault(job["key"], [])
+                        if job_id not in deferred:
+                            deferred.append(job_id)
+                        continue
+                    self._pending.pop((job["kind"], job["key"]), None)
+                    self._running_keys.add(job["key"])
+                    job["status"] = "running"
+                    job["started_at"] = time.time()
+                    return job
+                self._cond.wait()
+
+    def _finish(self, job, status, result=None, error=None):
+        with self._cond:
+            job["status"] = status
+            job["result"] = result
+            job["error"] = error
+            job["finished_at"] = time.time()
+            self._running_keys.discard(job["key"])
+            for deferred_id in self._deferred.pop(job["key"], []):
+                deferred = self._jobs[deferred_id]
+                heapq.heappush(self._heap, (deferred["priority"], next(self._seq), deferred_id))
+                self._cond.notify()
+            self._trim()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"]]
+        for job_id in finished[:max(len(finished) - self.history_size, 0)]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            handler = self._handlers.get(job["kind"])
+            if handler is None:
+                self._finish(job, "failed", error=f"No handler for job kind '{job['kind']}'")
+                continue
+            try:
+                result = handler(job["payload"])
+                self._finish(job, "succeeded", result=result)
+            except Exception as e:
+                logger.exception(f"Job {job['id']} ({job['kind']}) failed: {e}")
+                self._finish(job, "failed", error=str(e))
+
+
+JOB_QUEUE = JobQueue(
+    workers=JOBS_CONFIG.get('workers', 4),
+    history_size=JOBS_CONFIG.get('history_size', 1000),
+)
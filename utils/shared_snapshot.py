@@ -0,0 +1,231 @@
+# utils/shared_snapshot.py
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(BASE_DIR, "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+LEADER_CONFIG = CONFIG.get('leader', {}) or {}
+
+# 文件头：seq（写入中为奇数）、数据长度、写入时间
+HEADER = struct.Struct('<QQd')
+MIN_SIZE = 64 * 1024
+
+
+class MmapSnapshot:
+    """
+    领导者写、其他 worker 读的共享快照，存放在 mmap 文件中，适用于同一台机器上的多个 worker。
+    采用 seqlock：写入前后各递增一次 seq，读者看到奇数或前后 seq 不一致时重读。
+    读者按 seq 缓存解析结果，数据未变化时直接返回缓存，不再复制和解析。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._fd = None
+        self._cached_seq = None
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def _map(self, create=False):
+        if self._fd is None:
+            if not create and not os.path.exists(self.path):
+                return False
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            if not create:
+                return False
+            os.ftruncate(self._fd, MIN_SIZE)
+            size = MIN_SIZE
+        if self._mm is None or len(self._mm) != size:
+            if self._mm is not None:
+                self._mm.close()
+            self._mm = mmap.mmap(self._fd, size)
+        return True
+
+    def publish(self, obj):
+        payload = json.dumps(obj, separators=(',', ':')).encode()
+        with self._lock:
+            self._map(create=True)
+            needed = HEADER.size + len(payload)
+            if needed > len(self._mm):
+                # 按 2 的幂扩容，读者发现文件变大后重新映射
+                size = len(self._mm)
+                while size < needed:
+                    size *= 2
+                os.ftruncate(self._fd, size)
+                self._map(create=True)
+            # 接着文件中已有的 seq 递增，领导者切换后读者仍能发现变化
+            seq = HEADER.unpack_from(self._mm, 0)[0]
+            seq += 2 if seq % 2 == 0 else 1
+            HEADER.pack_into(self._mm, 0, seq - 1, 0, 0.0)
+            self._mm[HEADER.size:needed] = payload
+            HEADER.pack_into(self._mm, 0, seq, len(payload), time.time())
+
+    def read(self, retries=10):
+        """
+        返回最近一次发布的对象，没有数据时返回 None
+        """
+        with self._lock:
+            if not self._map():
+                return None
+            for _ in range(retries):
+                seq, length, _ = HEADER.unpack_from(self._mm, 0)
+                if seq == self._cached_seq or seq == 0:
+                    return self._cached
+                if seq % 2:
+                    time.sleep(0.001)
+                    continue
+                if HEADER.size + length > len(self._mm):
+                    # 文件已被领导者扩容
+                    self._map()
+                    continue
+                payload = self._mm[HEADER.size:HEADER.size + length]
+                if HEADER.unpack_from(self._mm, 0)[0] != seq:
+                    continue
+                self._cached_seq = seq
+                self._cached = json.loads(payload)
+                return self._cached
+            logger.debug(f"Snapshot {self.path} busy, returning previous copy")
+            return self._cached
+
+
+class RedisSnapshot:
+    """
+    基于 Redis 的共享快照，适用于 worker 分布在多台机器上的部署。
+    快照与版本号分开存放，读者只在版本号变化时才取回并解析快照。
+    """
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self._cached_seq = None
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def publish(self, obj):
+        pipe = self.client.pipeline()
+        pipe.set(self.key, json.dumps(obj, separators=(',', ':')))
+        pipe.incr(f"{self.key}:seq")
+        pipe.execute()
+
+    def read(self):
+        with self._lock:
+            seq = self.client.get(f"{self.key}:seq")
+            if seq is None:
+                return None
+            if seq != self._cached_seq:
+                payload = self.client.get(self.key)
+                if payload is not None:
+                    self._cached = json.loads(payload)
+                    self._cached_seq = seq
+            return self._cached
+
+
+def build_snapshot(name):
+    """
+    按 leader.backend 创建共享快照：file 使用 mmap 文件，redis 使用 Redis 键
+    """
+    if LEADER_CONFIG.get('backend', 'file') == 'redis':
+        import redis
+
+        client = redis.StrictRedis.from_url(LEADER_CONFIG.get('redis_url', 'redis://localhost:6379/0'))
+        return RedisSnapshot(client, f"kvm_scale:snapshot:{name}")
+    snapshot_dir = os.path.join(BASE_DIR, LEADER_CONFIG.get('snapshot_dir', 'data'))
+    return MmapSnapshot(os.path.join(snapshot_dir, f"{name}.snapshot"))
+
+
+class LocalSharedState:
+    """
+    进程内的可变共享状态，用于单进程部署与测试。transaction() 在锁内产出状态字典，原地修改即可
+    """
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self._state
+
+
+class FileSharedState:
+    """
+    所有 worker 都可读写的共享状态，存为 JSON 文件，适用于同一台机器上的多个 worker。
+    transaction() 在 flock 排他锁内读出状态、产出给调用方修改、再整体写回；
+    文件损坏（如写入中途进程被杀）时记录告警并从空状态开始
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r") as f:
+                    raw = f.read()
+                try:
+                    state = json.loads(raw) if raw else {}
+                except ValueError as e:
+                    logger.warning(f"Shared state {self.path} is corrupt, starting empty: {e}")
+                    state = {}
+                yield state
+                payload = json.dumps(state, separators=(',', ':')).encode()
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, payload, 0)
+            finally:
+                os.close(fd)  # 关闭即释放 flock
+
+
+class RedisSharedState:
+    """
+    基于 Redis 的共享状态，适用于 worker 分布在多台机器上的部署。
+    transaction() 持有 Redis 锁（SET NX PX，超时自动释放）期间读出、修改并写回状态
+    """
+
+    def __init__(self, client, key, lock_timeout=10):
+        self.client = client
+        self.key = key
+        self.lock_timeout = lock_timeout
+
+    @contextmanager
+    def transaction(self):
+        with self.client.lock(f"{self.key}:lock", timeout=self.lock_timeout, blocking_timeout=self.lock_timeout):
+            raw = self.client.get(self.key)
+            state = json.loads(raw) if raw else {}
+            yield state
+            self.client.set(self.key, json.dumps(state, separators=(',', ':')))
+
+
+def build_shared_state(name):
+    """
+    按 leader.backend 创建所有 worker 共同读写的状态：file 使用加 flock 的 JSON 文件，redis 使用 Redis 键
+    """
+    if LEADER_CONFIG.get('backend', 'file') == 'redis':
+        import redis
+
+        client = redis.StrictRedis.from_url(LEADER_CONFIG.get('redis_url', 'redis://localhost:6379/0'))
+        return RedisSharedState(client, f"kvm_scale:state:{name}")
+    snapshot_dir = os.path.join(BASE_DIR, LEADER_CONFIG.get('snapshot_dir', 'data'))
+    return FileSharedState(os.path.join(snapshot_dir, f"{name}.state.json"))
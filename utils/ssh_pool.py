@@ -0,0 +1,122 @@
+# utils/ssh_pool.py
+import asyncio
+import os
+import threading
+import time
+
+import asyncssh
+import yaml
+
+# 加载一次配置，避免重复读取
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = yaml.safe_load(f)
+
+POOL_CONFIG = CONFIG.get('ssh_pool', {}) or {}
+
+
+class AsyncSSHPool:
+    """
+    每台宿主机一条长期复用的 asyncssh 连接。
+    - 同一主机的多条命令作为独立 channel 在同一连接上并发执行，不再重复握手
+    - 连接空闲超过 idle_timeout 后关闭，下次使用时自动重建
+    - 执行时发现连接已断开，丢弃后重建一次再执行
+    """
+
+    def __init__(self, username, key_path, idle_timeout=300, keepalive_interval=30,
+                 connect_timeout=10, command_timeout=30):
+        self.username = username
+        self.key_path = key_path
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        # { (host, port): {"conn": SSHClientConnection, "last_used": float} }
+        self._conns = {}
+        self._locks = {}
+
+    def _lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def _get_conn(self, host, port):
+        key = (host, port)
+        async with self._lock(key):
+            entry = self._conns.get(key)
+            if entry is not None and not entry["conn"].is_closed():
+                entry["last_used"] = time.monotonic()
+                return entry["conn"]
+
+            conn = await asyncio.wait_for(asyncssh.connect(
+                host, port=port,
+                username=self.username,
+                client_keys=[self.key_path],
+                known_hosts=None,
+                keepalive_interval=self.keepalive_interval,
+                keepalive_count_max=3
+            ), timeout=self.connect_timeout)
+            self._conns[key] = {"conn": conn, "last_used": time.monotonic()}
+            return conn
+
+    def _discard(self, host, port, conn):
+        key = (host, port)
+        entry = self._conns.get(key)
+        if entry is not None and entry["conn"] is conn:
+            del self._conns[key]
+        conn.close()
+
+    async def run(self, host, command, port=22, timeout=None):
+        """
+        在宿主机上执行命令并返回 stdout。连接失效时重建一次后重试。
+        """
+        timeout = timeout or self.command_timeout
+        for attempt in range(2):
+            conn = await self._get_conn(host, port)
+            try:
+                result = await conn.run(command, check=True, timeout=timeout)
+                return result.stdout
+            except (asyncssh.ConnectionLost, asyncssh.ChannelOpenError, asyncssh.DisconnectError, OSError):
+                self._discard(host, port, conn)
+                if attempt == 1:
+                    raise
+
+    async def close_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self._conns.items()):
+            if now - entry["last_used"] > self.idle_timeout:
+                del self._conns[key]
+                entry["conn"].close()
+
+    async def reap_forever(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout // 2, 1))
+            await self.close_idle()
+
+
+SSH_POOL = AsyncSSHPool(
+    CONFIG.get('default_ssh_username', 'root'),
+    os.path.expanduser(CONFIG.get('default_ssh_key_path', '~/.ssh/id_rsa')),
+    idle_timeout=POOL_CONFIG.get('idle_timeout', 300),
+    keepalive_interval=POOL_CONFIG.get('keepalive_interval', 30),
+    connect_timeout=POOL_CONFIG.get('connect_timeout', 10),
+    command_timeout=POOL_CONFIG.get('command_timeout', 30),
+)
+
+# asyncssh 连接绑定在创建它的事件循环上，因此所有采集都跑在这一个常驻循环里
+_LOOP = asyncio.new_event_loop()
+
+
+def _run_loop():
+    asyncio.set_event_loop(_LOOP)
+    _LOOP.create_task(SSH_POOL.reap_forever())
+    _LOOP.run_forever()
+
+
+threading.Thread(target=_run_loop, name="ssh-pool-loop", daemon=True).start()
+
+
+def get_loop():
+    return _LOOP